@@ -0,0 +1,66 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+# libusb example program to measure the per-call cost of the transfer
+# populating helpers (libusb.fill_*_transfer() and friends) called directly
+# from Python versus called through their C-callable ('_cfunc') variants,
+# which were the only ones available before.
+
+import sys
+import timeit
+import ctypes as ct
+
+import libusb as usb
+
+NUMBER = 100_000
+
+
+@usb.transfer_cb_fn
+def cb_xfr(xfr):
+    pass
+
+
+def main(argv=sys.argv[1:]):
+
+    number = int(argv[0]) if argv else NUMBER
+
+    xfr = usb.alloc_transfer(16)
+    if not xfr:
+        print("Error allocating transfer", file=sys.stderr)
+        return 1
+
+    try:
+        buf = (ct.c_ubyte * 2048)()
+
+        benchmarks = {
+            "fill_bulk_transfer": lambda fill_bulk_transfer:
+                fill_bulk_transfer(xfr, None, 0x82, buf, ct.sizeof(buf), cb_xfr, None, 0),
+            "fill_interrupt_transfer": lambda fill_interrupt_transfer:
+                fill_interrupt_transfer(xfr, None, 0x81, buf, 64, cb_xfr, None, 0),
+            "fill_iso_transfer": lambda fill_iso_transfer:
+                fill_iso_transfer(xfr, None, 0x86, buf, ct.sizeof(buf), 16, cb_xfr, None, 0),
+            "set_iso_packet_lengths": lambda set_iso_packet_lengths:
+                set_iso_packet_lengths(xfr, ct.sizeof(buf) // 16),
+            "fill_control_setup": lambda fill_control_setup:
+                fill_control_setup(buf, 0xC0, 0x01, 0x0000, 0x0000, 64),
+            "fill_control_transfer": lambda fill_control_transfer:
+                fill_control_transfer(xfr, None, buf, cb_xfr, None, 1000),
+        }
+
+        print("{:<26} {:>14} {:>14} {:>8}".format(
+              "helper", "cfunc [ns]", "python [ns]", "speedup"))
+        for name, call in benchmarks.items():
+            py_func = getattr(usb, name)
+            c_func  = getattr(usb, name + "_cfunc")
+            c_time  = min(timeit.repeat(lambda: call(c_func),  number=number, repeat=3))
+            py_time = min(timeit.repeat(lambda: call(py_func), number=number, repeat=3))
+            print("{:<26} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+                  name, c_time / number * 1e9, py_time / number * 1e9, c_time / py_time))
+    finally:
+        usb.free_transfer(xfr)
+
+    return 0
+
+
+if __name__.rpartition(".")[-1] == "__main__":
+    sys.exit(main())
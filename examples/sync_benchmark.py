@@ -0,0 +1,97 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+# libusb example program to measure the rate of small (64-byte) synchronous
+# transactions done with the raw libusb.bulk_transfer() (a pointer cast and
+# a byref per call, as in xusb.py) versus the libusb.write()/read_into()
+# helpers, which take buffer-protocol objects as they are.
+#
+# Usage: sync_benchmark.py VID:PID [OUT_EP [IN_EP [INTERFACE [NUMBER]]]]
+# (e.g. a loopback device echoing the OUT data on the IN endpoint).
+
+import sys
+import time
+import ctypes as ct
+
+import libusb as usb
+
+NUMBER  = 10_000
+SIZE    = 64
+TIMEOUT = 1000
+
+
+def rate(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return number / (time.perf_counter() - start)
+
+
+def main(argv=sys.argv[1:]):
+
+    if not argv:
+        print("usage: sync_benchmark.py VID:PID [OUT_EP [IN_EP [INTERFACE [NUMBER]]]]",
+              file=sys.stderr)
+        return 1
+    vid, pid = (int(x, 16) for x in argv[0].split(":"))
+    ep_out = int(argv[1], 0) if len(argv) > 1 else 0x01
+    ep_in  = int(argv[2], 0) if len(argv) > 2 else 0x81
+    iface  = int(argv[3], 0) if len(argv) > 3 else 0
+    number = int(argv[4])    if len(argv) > 4 else NUMBER
+
+    r = usb.init(None)
+    if r < 0:
+        print("failed to initialise libusb {} - {}".format(r, usb.error_name(r)),
+              file=sys.stderr)
+        return 1
+    try:
+        handle = usb.open_device_with_vid_pid(None, vid, pid)
+        if not handle:
+            print("device {:04x}:{:04x} not found".format(vid, pid), file=sys.stderr)
+            return 1
+        try:
+            usb.set_auto_detach_kernel_driver(handle, 1)
+            r = usb.claim_interface(handle, iface)
+            if r < 0:
+                print("usb_claim_interface error {}".format(usb.error_name(r)),
+                      file=sys.stderr)
+                return 1
+
+            data = bytes(range(SIZE))
+            buf  = (ct.c_ubyte * SIZE).from_buffer_copy(data)
+            rbuf = bytearray(SIZE)
+            size = ct.c_int()
+
+            def raw_write():
+                usb.bulk_transfer(handle, ep_out, ct.cast(ct.pointer(buf),
+                                  ct.POINTER(ct.c_ubyte)), SIZE, ct.byref(size), TIMEOUT)
+
+            def raw_read():
+                rb = (ct.c_ubyte * SIZE).from_buffer(rbuf)
+                usb.bulk_transfer(handle, ep_in, ct.cast(ct.pointer(rb),
+                                  ct.POINTER(ct.c_ubyte)), SIZE, ct.byref(size), TIMEOUT)
+
+            def write():
+                usb.write(handle, ep_out, data, TIMEOUT)
+
+            def read_into():
+                usb.read_into(handle, ep_in, rbuf, TIMEOUT)
+
+            print("{:<28} {:>14}".format("transaction", "calls/s"))
+            for name, func in (("bulk_transfer() OUT", raw_write),
+                               ("write()",             write),
+                               ("bulk_transfer() OUT+IN", lambda: (raw_write(), raw_read())),
+                               ("write()+read_into()",    lambda: (write(), read_into()))):
+                print("{:<28} {:>14.0f}".format(name, rate(func, number)))
+
+            usb.release_interface(handle, iface)
+        finally:
+            usb.close(handle)
+    finally:
+        usb.exit(None)
+
+    return 0
+
+
+if __name__.rpartition(".")[-1] == "__main__":
+    sys.exit(main())
@@ -8,3 +8,13 @@ from . import __config__ ; del __config__
 from .__config__ import set_config as config  # type: ignore[attr-defined]
 
 from ._libusb import * ; del _libusb  # type: ignore[name-defined]
+from ._error  import * ; del _error   # type: ignore[name-defined]
+from ._stream import * ; del _stream  # type: ignore[name-defined]
+from ._pool   import * ; del _pool    # type: ignore[name-defined]
+from ._devmem import * ; del _devmem  # type: ignore[name-defined]
+from ._events import * ; del _events  # type: ignore[name-defined]
+from ._sync   import * ; del _sync    # type: ignore[name-defined]
+from ._tune   import * ; del _tune    # type: ignore[name-defined]
+from ._instrument import * ; del _instrument  # type: ignore[name-defined]
+from ._metrics import * ; del _metrics  # type: ignore[name-defined]
+from ._log     import * ; del _log     # type: ignore[name-defined]
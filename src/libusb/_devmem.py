@@ -0,0 +1,141 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('DeviceMemory',)
+
+from typing_extensions import Self
+from collections import deque
+import threading
+import mmap
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+
+
+class DeviceMemory:
+    """Allocator of fixed-size transfer buffers in device memory.
+
+    Gets regions of up to region_size bytes with libusb.dev_mem_alloc()
+    (on Linux: memory mmapped from usbfs, which spares the kernel a copy
+    of the data of every transfer) and carves them into num_buffers
+    buffers of buffer_size bytes. If the backend does not provide device
+    memory (libusb.dev_mem_alloc() returns NULL), the buffers are carved
+    from ordinary page-aligned memory instead and is_dma is False.
+
+    acquire() returns a buffer as a writable byte-formatted memoryview,
+    which (ctypes.c_ubyte * len(buffer)).from_buffer(buffer) turns into
+    the buffer of a transfer. release() and close() release (see
+    memoryview.release()) the buffers given back or still acquired, so
+    they cannot be used once their memory may be reused or freed. Objects
+    made of a buffer (such ctypes arrays, slices) are not tracked and must
+    not be used after that.
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle],
+                 buffer_size: int, num_buffers: int,
+                 region_size: int = 4 * 1024 * 1024) -> None:
+        if buffer_size <= 0:
+            raise ValueError("buffer_size must be positive")
+        if num_buffers <= 0:
+            raise ValueError("num_buffers must be positive")
+        self.dev_handle  = dev_handle
+        self.buffer_size = buffer_size
+        self.num_buffers = num_buffers
+        #: True if all buffers are in device memory.
+        self.is_dma = True
+        self._lock = threading.Lock()
+        self._closed = False
+        # Device memory regions (pointer, length) and the fallback ones.
+        self._dma_regions: list[tuple[ctx.POINTER[ct.c_ubyte], int]] = []
+        self._mmap_regions: list[mmap.mmap] = []
+        self._buffers: list[ct.Array[ct.c_ubyte]] = []
+        self._free: deque[ct.Array[ct.c_ubyte]] = deque()
+        # Acquired buffers and their memory, by id of the buffer.
+        self._acquired: dict[int, tuple[memoryview, ct.Array[ct.c_ubyte]]] = {}
+        per_region = max(1, region_size // buffer_size)
+        try:
+            remaining = num_buffers
+            while remaining:
+                count = min(per_region, remaining)
+                self._buffers.extend(self._alloc_region(count))
+                remaining -= count
+        except BaseException:
+            self._free_regions()
+            raise
+        self._free.extend(self._buffers)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    @property
+    def num_free(self) -> int:
+        """Number of buffers available to acquire()."""
+        return len(self._free)
+
+    def acquire(self) -> memoryview:
+        """Get a free buffer (raises MemoryError if all are in use)."""
+        with self._lock:
+            if self._closed:
+                raise ValueError("acquire from a closed DeviceMemory")
+            if not self._free:
+                raise MemoryError("all device memory buffers are in use")
+            memory = self._free.popleft()
+            buffer = memoryview(memory).cast("B")
+            self._acquired[id(buffer)] = (buffer, memory)
+            return buffer
+
+    def release(self, buffer: memoryview) -> None:
+        """Return a buffer got from acquire(). The buffer is released
+        (see memoryview.release()) and cannot be used anymore."""
+        with self._lock:
+            if self._closed:
+                raise ValueError("release to a closed DeviceMemory")
+            acquired = self._acquired.get(id(buffer))
+            if acquired is None or acquired[0] is not buffer:
+                raise ValueError("buffer is not acquired from this DeviceMemory")
+            buffer.release()
+            del self._acquired[id(buffer)]
+            self._free.append(acquired[1])
+
+    def close(self) -> None:
+        """Release the memory of all buffers. The buffers still acquired
+        are released (see memoryview.release()) and cannot be used anymore."""
+        with self._lock:
+            if self._closed: return
+            for buffer, _ in self._acquired.values():
+                buffer.release()
+            self._closed = True
+            self._acquired.clear()
+            self._free.clear()
+            self._free_regions()
+
+    def _alloc_region(self, count: int) -> list[ct.Array[ct.c_ubyte]]:
+        length = count * self.buffer_size
+        region = usb.dev_mem_alloc(self.dev_handle, length)
+        if region:
+            self._dma_regions.append((region, length))
+            address = ct.addressof(region.contents)
+        else:
+            self.is_dma = False
+            memory = mmap.mmap(-1, length)
+            self._mmap_regions.append(memory)
+            address = ct.addressof(ct.c_char.from_buffer(memory))
+        buffer_type = ct.c_ubyte * self.buffer_size
+        return [buffer_type.from_address(address + index * self.buffer_size)
+                for index in range(count)]
+
+    def _free_regions(self) -> None:
+        self._buffers.clear()
+        for region, length in self._dma_regions:
+            usb.dev_mem_free(self.dev_handle, region, length)
+        self._dma_regions.clear()
+        for memory in self._mmap_regions:
+            memory.close()
+        self._mmap_regions.clear()
@@ -0,0 +1,65 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('USBError', 'TransferError', 'TransferTimeoutError',
+           'TransferCancelledError', 'TransferStallError',
+           'TransferNoDeviceError', 'TransferOverflowError')
+
+from . import _libusb as usb
+
+
+class USBError(IOError):
+    """libusb call failed with a LIBUSB_ERROR_* code."""
+
+    def __init__(self, code: int) -> None:
+        self.code = code
+        super().__init__(f"{usb.error_name(code).decode()}: "
+                         f"{usb.strerror(code).decode()}")
+
+
+class TransferError(IOError):
+    """Transfer finished with a status other than LIBUSB_TRANSFER_COMPLETED.
+
+    TransferError.for_status() returns the exception of the subclass
+    matching the libusb.transfer_status, if there is one.
+    """
+
+    def __init__(self, status: int) -> None:
+        self.status = status
+        super().__init__(usb.error_name(status).decode())
+
+    @classmethod
+    def for_status(cls, status: int) -> TransferError:
+        return _transfer_errors.get(status, TransferError)(status)
+
+
+class TransferTimeoutError(TransferError, TimeoutError):
+    """Transfer timed out (LIBUSB_TRANSFER_TIMED_OUT)."""
+
+
+class TransferCancelledError(TransferError):
+    """Transfer was cancelled (LIBUSB_TRANSFER_CANCELLED)."""
+
+
+class TransferStallError(TransferError):
+    """Endpoint halted or control request not supported
+    (LIBUSB_TRANSFER_STALL)."""
+
+
+class TransferNoDeviceError(TransferError):
+    """Device was disconnected (LIBUSB_TRANSFER_NO_DEVICE)."""
+
+
+class TransferOverflowError(TransferError):
+    """Device sent more data than requested (LIBUSB_TRANSFER_OVERFLOW)."""
+
+
+_transfer_errors: dict[int, type[TransferError]] = {
+    usb.LIBUSB_TRANSFER_TIMED_OUT: TransferTimeoutError,
+    usb.LIBUSB_TRANSFER_CANCELLED: TransferCancelledError,
+    usb.LIBUSB_TRANSFER_STALL:     TransferStallError,
+    usb.LIBUSB_TRANSFER_NO_DEVICE: TransferNoDeviceError,
+    usb.LIBUSB_TRANSFER_OVERFLOW:  TransferOverflowError,
+}
@@ -0,0 +1,374 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('CompletionQueue', 'EventThread', 'TransferScheduler')
+
+from typing_extensions import Self
+from collections.abc import Callable
+from collections import deque
+import threading
+import heapq
+import itertools
+import time
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+from ._platform import CFUNC
+from ._platform import timeval
+from ._error import USBError
+
+# Same as libusb.transfer_cb_fn, but the transfer is passed as a plain
+# address (no ctypes pointer object is created per completion).
+_record_cb_fn = CFUNC(None, ct.c_void_p)
+
+
+class CompletionQueue:
+    """Queue of completed transfers, to be processed in batches.
+
+    Transfers filled with queue.callback as their callback are not
+    processed while libusb handles events: the callback only records the
+    address of the completed transfer in a preallocated ring of capacity
+    entries (completions beyond that wait in an overflow list, in order).
+    The consumer then takes them in batches with drain(), either right
+    after handling events (see handle_events()) or from a worker thread
+    (see wait()), so its Python code does not run with libusb's event
+    lock held.
+
+        queue = CompletionQueue()
+        usb.fill_bulk_transfer(transfer, dev_handle, 0x82, buffer, size,
+                               queue.callback, None, 0)
+        ...
+        for transfer in queue.handle_events(0.1):
+            ...
+
+    The callback still enters Python (for a few bytecodes) per transfer;
+    the transfers' user_data can be used to tell the consumers apart.
+    """
+
+    def __init__(self, capacity: int = 1024,
+                 ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.ctx = ctx
+        #: Number of completions recorded so far and how many of them
+        #: did not fit into the ring.
+        self.num_completed = 0
+        self.num_overflows = 0
+        self._ring: list[int] = [0] * capacity
+        # Number of completions put into and taken from the ring so far
+        # (written only by the producer and the consumer, respectively).
+        self._head = 0
+        self._tail = 0
+        self._overflow: deque[int] = deque()
+        self._ready = threading.Event()
+        self._record_cb = _record_cb_fn(self._record)
+        #: The callback to fill transfers with (libusb.transfer_cb_fn).
+        self.callback = ct.cast(self._record_cb, usb.transfer_cb_fn)
+
+    def __len__(self) -> int:
+        return self._tail - self._head + len(self._overflow)
+
+    def drain(self, max_items: int | None = None) -> list[ctx.POINTER[usb.transfer]]:
+        """Take (up to max_items of) the completed transfers, oldest first."""
+        addresses: list[int] = []
+        ring, capacity = self._ring, self.capacity
+        head, tail = self._head, self._tail
+        if max_items is not None:
+            tail = min(tail, head + max_items)
+        start, end = head % capacity, (tail - 1) % capacity + 1
+        if head < tail:
+            if start < end:
+                addresses += ring[start:end]
+            else:
+                addresses += ring[start:]
+                addresses += ring[:end]
+        self._head = tail
+        overflow = self._overflow
+        while overflow and (max_items is None or len(addresses) < max_items):
+            addresses.append(overflow.popleft())
+        if not len(self):
+            self._ready.clear()
+            if len(self):  # completed meanwhile
+                self._ready.set()
+        transfer_p = ct.POINTER(usb.transfer)
+        return [ct.cast(address, transfer_p) for address in addresses]
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait (without handling events) until there are completed
+        transfers; returns False on timeout."""
+        return self._ready.wait(timeout)
+
+    def handle_events(self, timeout: float = 0.0) -> list[ctx.POINTER[usb.transfer]]:
+        """Handle libusb events (waiting at most timeout seconds for some)
+        and return all completed transfers."""
+        if not len(self):
+            tv = timeval(int(timeout), int((timeout % 1) * 1_000_000))
+            rc = _transport.handle_events_timeout_completed(self.ctx, tv, None)
+            if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+                raise USBError(rc)
+        return self.drain()
+
+    def _record(self, address: int) -> None:
+        self.num_completed += 1
+        tail = self._tail
+        if self._overflow or tail - self._head >= self.capacity:
+            self.num_overflows += 1
+            self._overflow.append(address)
+        else:
+            self._ring[tail % self.capacity] = address
+            self._tail = tail + 1
+        if not self._ready.is_set():
+            self._ready.set()
+
+
+class EventThread(threading.Thread):
+    """Thread handling the libusb events of a context.
+
+    Runs libusb.handle_events_timeout_completed() in a loop, tick seconds
+    at most per call, until stop(), which wakes it up at once with
+    libusb.interrupt_event_handler(). Other threads should not handle
+    events of the context meanwhile, but wait for what they need with
+    wait_until(), which sleeps on libusb's event waiters lock (the
+    documented multi-thread protocol) instead of polling:
+
+        with EventThread(ctx) as events:
+            usb.submit_transfer(transfer)
+            events.wait_until(lambda: done, timeout=1.0)
+
+    An error returned by libusb stops the thread and is re-raised by
+    stop() (and by wait_until()).
+    """
+
+    def __init__(self, ctx: ctx.POINTER[usb.context] | None = None,
+                 tick: float = 1.0, name: str | None = None) -> None:
+        if tick <= 0:
+            raise ValueError("tick must be positive")
+        super().__init__(name=name or "libusb-events", daemon=True)
+        self.ctx  = ctx
+        self.tick = tick
+        self.error: USBError | None = None
+        self._running = False
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._running = True
+        super().start()
+
+    def run(self) -> None:
+        tick = self.tick
+        tv = timeval(int(tick), int((tick % 1) * 1_000_000))
+        while self._running:
+            rc = _transport.handle_events_timeout_completed(self.ctx, tv, None)
+            if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+                self.error = USBError(rc)
+                self._running = False
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stop handling events and wait for the thread to end."""
+        self._running = False
+        if self.is_alive():
+            usb.interrupt_event_handler(self.ctx)
+            self.join(timeout)
+        self._raise_error()
+
+    def wait_until(self, done: Callable[[], bool], timeout: float | None = None) -> bool:
+        """Wait until done() is true (it is checked every time an event is
+        handled); returns False on timeout.
+
+        Raises RuntimeError if the thread is not running.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        usb.lock_event_waiters(self.ctx)
+        try:
+            while not done():
+                if not self._running:
+                    self._raise_error()
+                    raise RuntimeError("event thread is not running")
+                wait = self.tick
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                tv = timeval(int(wait), int((wait % 1) * 1_000_000))
+                usb.wait_for_event(self.ctx, ct.byref(tv))
+        finally:
+            usb.unlock_event_waiters(self.ctx)
+        return True
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+
+class _Scheduled:
+    # A transfer submitted through a TransferScheduler.
+
+    __slots__ = ('seq', 'transfer', 'callback', 'deadline', 'tag', 'expired')
+
+    def __init__(self, seq: int, transfer: ctx.POINTER[usb.transfer],
+                 callback: usb.transfer_cb_fn, deadline: float | None, tag: object) -> None:
+        self.seq      = seq
+        self.transfer = transfer
+        self.callback = callback
+        self.deadline = deadline
+        self.tag      = tag
+        self.expired  = False
+
+
+class TransferScheduler:
+    """Tracker of submitted transfers with deadlines and group cancelling.
+
+    Transfers submitted with submit() may have an absolute deadline (in
+    time.monotonic() seconds) and a tag. A transfer not completed by its
+    deadline is cancelled by handle_events() and is called back with the
+    LIBUSB_TRANSFER_TIMED_OUT status. cancel() cancels all in-flight
+    transfers of a device, an endpoint and/or a tag at once and
+    cancel_and_wait() also waits until all of them have called back:
+
+        scheduler = TransferScheduler(ctx)
+        for transfer in transfers:
+            scheduler.submit(transfer, time.monotonic() + 0.5, tag="stream")
+        ...
+        scheduler.cancel_and_wait(tag="stream")
+
+    While a transfer is in flight its callback field is replaced by the
+    scheduler's one, which restores it and calls the original callback.
+    The scheduler is meant to be used by the thread handling the events.
+    """
+
+    def __init__(self, ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        self.ctx = ctx
+        self._scheduled: dict[int, _Scheduled] = {}
+        self._deadlines: list[tuple[float, int, int]] = []
+        self._counter = itertools.count()
+        self._callback = usb.transfer_cb_fn(self._transfer_cb)
+
+    def __len__(self) -> int:
+        """Number of transfers in flight."""
+        return len(self._scheduled)
+
+    def submit(self, transfer: ctx.POINTER[usb.transfer], deadline: float | None = None,
+               tag: object = None) -> None:
+        """Submit a transfer (raises USBError if that failed)."""
+        transf = transfer[0]
+        address = ct.addressof(transf)
+        # A copy of the callback pointer (the field value shares its memory).
+        callback = ct.cast(transf.callback, ct.c_void_p).value
+        callback = usb.transfer_cb_fn(callback) if callback else usb.transfer_cb_fn()
+        entry = _Scheduled(next(self._counter), transfer, callback, deadline, tag)
+        transf.callback = self._callback
+        rc = _transport.submit_transfer(transfer)
+        if rc < 0:
+            transf.callback = entry.callback
+            raise USBError(rc)
+        self._scheduled[address] = entry
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, entry.seq, address))
+
+    def cancel(self, dev_handle: ctx.POINTER[usb.device_handle] | None = None,
+               endpoint: int | None = None, tag: object = None) -> list[int]:
+        """Cancel the in-flight transfers of dev_handle, endpoint and tag
+        (None matches all) and return their addresses."""
+        addresses = self._select(dev_handle, endpoint, tag)
+        for address in addresses:
+            _transport.cancel_transfer(self._scheduled[address].transfer)
+        return addresses
+
+    def cancel_and_wait(self, dev_handle: ctx.POINTER[usb.device_handle] | None = None,
+                        endpoint: int | None = None, tag: object = None,
+                        timeout: float | None = None) -> None:
+        """Cancel the transfers as cancel() does and wait until all of them
+        have called back (raises TimeoutError if that did not happen within
+        timeout seconds)."""
+        addresses = self.cancel(dev_handle, endpoint, tag)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        scheduled = self._scheduled
+        while any(address in scheduled for address in addresses):
+            wait = 1.0
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise TimeoutError("timed out waiting for cancelled transfers")
+            self.handle_events(wait)
+
+    def next_timeout(self) -> float | None:
+        """Seconds until the nearest deadline or libusb's next internal
+        timeout (None if there is none), for use in external poll loops."""
+        timeout = None
+        tv = timeval()
+        if _transport.get_next_timeout(self.ctx, tv) == 1:
+            timeout = tv.tv_sec + tv.tv_usec / 1_000_000
+        deadline = self._next_deadline()
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0.0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def handle_events(self, timeout: float = 1.0) -> None:
+        """Handle libusb events for at most timeout seconds (less if some
+        deadline comes earlier) and cancel the transfers past deadline."""
+        self._expire()
+        deadline = self._next_deadline()
+        if deadline is not None:
+            timeout = max(min(timeout, deadline - time.monotonic()), 0.0)
+        tv = timeval(int(timeout), int((timeout % 1) * 1_000_000))
+        rc = _transport.handle_events_timeout_completed(self.ctx, tv, None)
+        if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+            raise USBError(rc)
+        self._expire()
+
+    def _select(self, dev_handle: ctx.POINTER[usb.device_handle] | None,
+                endpoint: int | None, tag: object) -> list[int]:
+        device = (None if dev_handle is None else
+                  ct.cast(dev_handle, ct.c_void_p).value)
+        selected = []
+        for address, entry in self._scheduled.items():
+            transf = entry.transfer[0]
+            if ((device is None or ct.cast(transf.dev_handle, ct.c_void_p).value == device)
+                and (endpoint is None or transf.endpoint == endpoint)
+                and (tag is None or entry.tag == tag)):
+                selected.append(address)
+        return selected
+
+    def _next_deadline(self) -> float | None:
+        # Drops the deadlines of the transfers which are not in flight anymore.
+        deadlines = self._deadlines
+        while deadlines and not self._is_current(deadlines[0]):
+            heapq.heappop(deadlines)
+        return deadlines[0][0] if deadlines else None
+
+    def _is_current(self, item: tuple[float, int, int]) -> bool:
+        entry = self._scheduled.get(item[2])
+        return entry is not None and entry.seq == item[1]
+
+    def _expire(self) -> None:
+        deadlines = self._deadlines
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            item = heapq.heappop(deadlines)
+            if self._is_current(item):
+                entry = self._scheduled[item[2]]
+                entry.expired = True
+                _transport.cancel_transfer(entry.transfer)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        entry = self._scheduled.pop(ct.addressof(transf))
+        transf.callback = entry.callback
+        if entry.expired and transf.status == usb.LIBUSB_TRANSFER_CANCELLED:
+            transf.status = usb.LIBUSB_TRANSFER_TIMED_OUT
+        if entry.callback:
+            entry.callback(transfer)
@@ -0,0 +1,461 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('LatencyHistogram', 'LatencyStats', 'TransferLatency',
+           'TraceRecord', 'TransferTrace')
+
+from typing import NamedTuple, Protocol, TextIO
+from typing_extensions import Self
+from os import PathLike
+import threading
+import csv
+import array
+import time
+import abc
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+
+# Instrumentation of the transfer layer.
+#
+# While any observer is installed, _submit_transfer() is the submit hook
+# of the engines of this package (see _transport): it timestamps the
+# transfer and puts the _transfer_cb() trampoline in place of its
+# callback. The trampoline restores the original callback, calls it and
+# reports the completion to the observers (telling them whether the
+# callback resubmitted the transfer). The copies of the original callbacks
+# are kept by callback address, so that a submission costs no ctypes
+# object, only its entry in _in_flight. Without observers the engines submit
+# with the plain libusb function again, so the instrumentation costs
+# nothing.
+
+# (bus number, device address) of a device, or None for a NULL handle.
+Device = tuple[int, int] | None
+
+
+class _Observer(Protocol):
+
+    def _completed(self, key: tuple[Device, int, int], status: int,
+                   length: int, actual_length: int,
+                   submitted: int, completed: int, returned: int,
+                   resubmitted: bool) -> None: ...
+
+
+_lock = threading.Lock()
+_observers: tuple[_Observer, ...] = ()
+# Submission time (ns) and original callback of the instrumented transfers
+# in flight, by transfer address.
+_in_flight: dict[int, tuple[int, usb.transfer_cb_fn]] = {}
+# Copies of the original callbacks (function pointers), by their address.
+_callbacks: dict[int, usb.transfer_cb_fn] = {}
+# Device of the device handles seen (with the address of their libusb
+# device), by device handle address.
+_devices: dict[int, tuple[int, Device]] = {}
+
+
+def _submit_transfer(transfer: ctx.POINTER[usb.transfer]) -> int:
+    transf = transfer[0]
+    callback_address = ct.cast(transf.callback, ct.c_void_p).value
+    if not callback_address or callback_address == _callback_address:
+        return _transport.backend_submit_transfer(transfer)
+    callback = _callbacks.get(callback_address)
+    if callback is None:
+        # A copy of the function pointer (the field's value shares its memory).
+        callback = _callbacks[callback_address] = usb.transfer_cb_fn(callback_address)
+    address = ct.addressof(transf)
+    _in_flight[address] = (time.perf_counter_ns(), callback)
+    transf.callback = _callback
+    rc = _transport.backend_submit_transfer(transfer)
+    if rc < 0:
+        transf.callback = callback
+        del _in_flight[address]
+    return rc
+
+
+def _transfer_cb(transfer: ctx.POINTER[usb.transfer]) -> None:
+    completed = time.perf_counter_ns()
+    transf = transfer[0]
+    address = ct.addressof(transf)
+    submitted, callback = _in_flight.pop(address)
+    transf.callback = callback
+    # Read before the callback (it may free or resubmit the transfer).
+    key = (_device(transf.dev_handle), transf.endpoint, transf.type)
+    status, length, actual_length = transf.status, transf.length, transf.actual_length
+    if transf.type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS:
+        actual_length = sum(desc.actual_length for desc in usb._iso_packet_desc(transf))
+    callback(transfer)
+    returned = time.perf_counter_ns()
+    resubmitted = address in _in_flight
+    for observer in _observers:
+        observer._completed(key, status, length, actual_length,
+                            submitted, completed, returned, resubmitted)
+
+# Must be kept alive for as long as any instrumented transfer may call back.
+_callback = usb.transfer_cb_fn(_transfer_cb)
+_callback_address = ct.cast(_callback, ct.c_void_p).value
+
+
+def _device(dev_handle: ctx.POINTER[usb.device_handle]) -> Device:
+    # A closed handle's address may be reused by a handle of another device,
+    # so the cached device is only taken if the libusb device is the same.
+    if not dev_handle:
+        return None
+    dev = usb.get_device(dev_handle)
+    dev_address = ct.addressof(dev.contents)
+    address = ct.addressof(dev_handle.contents)
+    entry = _devices.get(address)
+    if entry is None or entry[0] != dev_address:
+        entry = _devices[address] = (dev_address, (usb.get_bus_number(dev),
+                                                   usb.get_device_address(dev)))
+    return entry[1]
+
+
+def _install(observer: _Observer) -> None:
+    global _observers
+    with _lock:
+        if observer in _observers: return
+        if not _observers:
+            _transport.set_submit_hook(_submit_transfer)
+        _observers += (observer,)
+
+
+def _uninstall(observer: _Observer) -> None:
+    global _observers
+    with _lock:
+        if observer not in _observers: return
+        _observers = tuple(item for item in _observers if item is not observer)
+        if not _observers:
+            _transport.set_submit_hook(None)
+            _callbacks.clear()
+            _devices.clear()
+
+
+class _Instrument(abc.ABC):
+    # Base of the observers (enabled in a with block or between enable()
+    # and disable()).
+
+    def __enter__(self) -> Self:
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.disable()
+
+    def enable(self) -> None:
+        """Start collecting."""
+        _install(self)
+
+    def disable(self) -> None:
+        """Stop collecting (the data collected are kept)."""
+        _uninstall(self)
+
+    @abc.abstractmethod
+    def _completed(self, key: tuple[Device, int, int], status: int,
+                   length: int, actual_length: int,
+                   submitted: int, completed: int, returned: int,
+                   resubmitted: bool) -> None:
+        """Called on completion of an instrumented transfer."""
+
+
+class LatencyHistogram:
+    """Histogram of durations (in nanoseconds) in a fixed array of
+    logarithmic buckets: four per power of two, so a percentile is within
+    25% of the real value. Durations of 7 * 2**38 ns (about 32 minutes)
+    and longer fall into the last bucket."""
+
+    num_buckets = 4 * 40
+
+    def __init__(self) -> None:
+        self.buckets = array.array("Q", bytes(8 * self.num_buckets))
+        #: Number of durations added, their sum and maximum.
+        self.count = 0
+        self.total = 0
+        self.max   = 0
+
+    def add(self, duration: int) -> None:
+        """Add a duration in nanoseconds."""
+        duration = max(0, duration)
+        if duration < 4:
+            index = duration
+        else:
+            exponent = duration.bit_length() - 1
+            index = min(4 * (exponent - 1) + ((duration >> (exponent - 2)) & 3),
+                        self.num_buckets - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self) -> float:
+        """Mean duration in nanoseconds (0 if empty)."""
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> int:
+        """Return the upper bound (in nanoseconds, capped by the maximum) of
+        the bucket holding the given fraction (0.5 for the median) of the
+        durations, 0 if empty."""
+        if not self.count:
+            return 0
+        rank = max(1, min(self.count, int(fraction * self.count + 0.5)))
+        for index, count in enumerate(self.buckets):
+            rank -= count
+            if rank <= 0:
+                return min(self._upper_bound(index), self.max)
+        return self.max  # pragma: no cover
+
+    def copy(self) -> LatencyHistogram:
+        """Return a copy of the histogram."""
+        histogram = LatencyHistogram.__new__(LatencyHistogram)
+        histogram.buckets = array.array("Q", self.buckets)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max   = self.max
+        return histogram
+
+    @staticmethod
+    def _upper_bound(index: int) -> int:
+        if index < 4:
+            return index
+        exponent, fraction = divmod(index, 4)
+        return ((4 + fraction + 1) << (exponent - 1)) - 1
+
+
+class LatencyStats(NamedTuple):
+    """Latency histograms of the transfers of one endpoint."""
+
+    #: From submission to the start of the transfer callback.
+    completion: LatencyHistogram
+    #: Run time of the transfer callback.
+    callback: LatencyHistogram
+
+
+class TransferLatency(_Instrument):
+    """Per-endpoint latency histograms of the transfers.
+
+    While enabled (in a with block or between enable() and disable()),
+    every transfer submitted by the engines of this package (BulkReader,
+    IsoStream, libusb.aio, writev(), ...) is timestamped
+    at submission and when its callback is called and returns. The time
+    from submission to the callback (spent in the device, the kernel and
+    libusb) and the run time of the callback (spent in Python) feed two
+    LatencyHistogram-s per (device, endpoint, transfer type), where device
+    is (bus number, device address). Cancelled transfers are not counted.
+
+        with libusb.TransferLatency() as latency:
+            ...
+            for (device, endpoint, transfer_type), stats in latency.snapshot().items():
+                print(endpoint, stats.completion.percentile(0.99))
+
+    When disabled, the submissions are not instrumented at all (the
+    engines submit with the plain libusb.submit_transfer()) and the
+    devices of the device handles seen are forgotten.
+    The histograms are updated from the threads handling libusb events,
+    which libusb serializes.
+    """
+
+    def __init__(self) -> None:
+        self._stats: dict[tuple[Device, int, int], LatencyStats] = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> dict[tuple[Device, int, int], LatencyStats]:
+        """Return a copy of the histograms by (device, endpoint, transfer
+        type)."""
+        with self._lock:
+            return {key: LatencyStats(stats.completion.copy(), stats.callback.copy())
+                    for key, stats in self._stats.items()}
+
+    def reset(self) -> None:
+        """Drop all histograms."""
+        with self._lock:
+            self._stats = {}
+
+    def _completed(self, key: tuple[Device, int, int], status: int,
+                   length: int, actual_length: int,
+                   submitted: int, completed: int, returned: int,
+                   resubmitted: bool) -> None:
+        if status == usb.LIBUSB_TRANSFER_CANCELLED:
+            return
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, LatencyStats(LatencyHistogram(),
+                                                                 LatencyHistogram()))
+        stats.completion.add(completed - submitted)
+        stats.callback.add(returned - completed)
+
+
+_transfer_type_names = {
+    usb.LIBUSB_TRANSFER_TYPE_CONTROL:     "CONTROL",
+    usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS: "ISOCHRONOUS",
+    usb.LIBUSB_TRANSFER_TYPE_BULK:        "BULK",
+    usb.LIBUSB_TRANSFER_TYPE_INTERRUPT:   "INTERRUPT",
+    usb.LIBUSB_TRANSFER_TYPE_BULK_STREAM: "BULK_STREAM",
+}
+
+_transfer_status_names = {
+    usb.LIBUSB_TRANSFER_COMPLETED: "COMPLETED",
+    usb.LIBUSB_TRANSFER_ERROR:     "ERROR",
+    usb.LIBUSB_TRANSFER_TIMED_OUT: "TIMED_OUT",
+    usb.LIBUSB_TRANSFER_CANCELLED: "CANCELLED",
+    usb.LIBUSB_TRANSFER_STALL:     "STALL",
+    usb.LIBUSB_TRANSFER_NO_DEVICE: "NO_DEVICE",
+    usb.LIBUSB_TRANSFER_OVERFLOW:  "OVERFLOW",
+}
+
+
+class TraceRecord(NamedTuple):
+    """Completion of a transfer recorded by TransferTrace."""
+
+    #: Time of the completion (as time.time()).
+    time: float
+    #: (bus number, device address) of the device, None for a NULL handle.
+    device: Device
+    endpoint: int
+    transfer_type: int
+    length: int
+    actual_length: int
+    status: int
+
+
+class TransferTrace(_Instrument):
+    """Ring of the last size transfer completions for post-mortem
+    debugging.
+
+    While enabled, the completion of every transfer submitted by the
+    engines of this package is recorded as (time, device, endpoint,
+    transfer type, length, actual length, status) in a preallocated
+    array of integers, overwriting the oldest record when full. The ring
+    itself keeps no object per record; the instrumentation shared with
+    TransferLatency still creates a few small ones per transfer (the entry
+    of the transfer in flight and the key of its completion), which is
+    cheap enough to keep the trace on in production.
+
+    dump() writes the records as CSV, oldest first. With dump_file given
+    they are also dumped there (by a separate thread, the file being
+    overwritten) when burst transfers end with LIBUSB_TRANSFER_NO_DEVICE
+    or LIBUSB_TRANSFER_STALL within burst_interval seconds.
+    """
+
+    #: Statuses counted for the dump on a burst.
+    fatal_statuses = frozenset((usb.LIBUSB_TRANSFER_NO_DEVICE, usb.LIBUSB_TRANSFER_STALL))
+
+    # Integers per record (time, device, endpoint, transfer_type, length,
+    # actual_length, status).
+    _fields = 7
+
+    def __init__(self, size: int = 4096,
+                 dump_file: str | PathLike[str] | None = None,
+                 burst: int = 8, burst_interval: float = 1.0) -> None:
+        if size <= 0:
+            raise ValueError("size must be positive")
+        if burst <= 0:
+            raise ValueError("burst must be positive")
+        self.size = size
+        self.dump_file = dump_file
+        self.burst = burst
+        self.burst_interval = burst_interval
+        #: Number of dumps done on a burst.
+        self.num_burst_dumps = 0
+        self._ring = array.array("q", bytes(8 * self._fields * size))
+        self._count = 0  # of the records ever written
+        # Times (ns) of the last burst fatal completions (a ring as well).
+        self._fatal = array.array("q", bytes(8 * burst))
+        self._fatal_count = 0
+        # Offset of time.time_ns() from time.perf_counter_ns().
+        self._time_offset = time.time_ns() - time.perf_counter_ns()
+        self._dump_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self._count, self.size)
+
+    def records(self) -> list[TraceRecord]:
+        """Return the records, oldest first."""
+        count, ring = self._count, array.array("q", self._ring)
+        return self._records(count, ring)
+
+    def dump(self, file: str | PathLike[str] | TextIO | None = None) -> int:
+        """Write the records as CSV to file (a path or a text file; dump_file
+        by default) and return their number."""
+        return self._dump(file, self._count, array.array("q", self._ring))
+
+    def clear(self) -> None:
+        """Drop all records."""
+        self._count = 0
+        self._fatal_count = 0
+
+    def _completed(self, key: tuple[Device, int, int], status: int,
+                   length: int, actual_length: int,
+                   submitted: int, completed: int, returned: int,
+                   resubmitted: bool) -> None:
+        device, endpoint, transfer_type = key
+        ring = self._ring
+        index = (self._count % self.size) * self._fields
+        ring[index]     = completed
+        ring[index + 1] = -1 if device is None else device[0] << 8 | device[1]
+        ring[index + 2] = endpoint
+        ring[index + 3] = transfer_type
+        ring[index + 4] = length
+        ring[index + 5] = actual_length
+        ring[index + 6] = status
+        self._count += 1
+        if status in self.fatal_statuses:
+            fatal, count = self._fatal, self._fatal_count
+            fatal[count % self.burst] = completed
+            self._fatal_count = count = count + 1
+            # The oldest of the last burst fatal completions.
+            if (count >= self.burst and
+                completed - fatal[count % self.burst] <= self.burst_interval * 1e9):
+                self._fatal_count = 0
+                if self.dump_file is not None:
+                    self.num_burst_dumps += 1
+                    threading.Thread(target=self._dump, name="TransferTrace dump",
+                                     args=(self.dump_file, self._count,
+                                           array.array("q", ring)), daemon=True).start()
+
+    def _records(self, count: int, ring: array.array[int]) -> list[TraceRecord]:
+        fields, size, offset = self._fields, self.size, self._time_offset
+        records = []
+        for number in range(max(0, count - size), count):
+            index = (number % size) * fields
+            (timestamp, device, endpoint, transfer_type,
+             length, actual_length, status) = ring[index:index + fields]
+            records.append(TraceRecord((timestamp + offset) / 1_000_000_000,
+                                       None if device < 0 else (device >> 8, device & 0xFF),
+                                       endpoint, transfer_type, length, actual_length,
+                                       status))
+        return records
+
+    def _dump(self, file: str | PathLike[str] | TextIO | None,
+              count: int, ring: array.array[int]) -> int:
+        if file is None:
+            file = self.dump_file
+            if file is None:
+                raise ValueError("no file to dump to")
+        records = self._records(count, ring)
+        with self._dump_lock:
+            if isinstance(file, (str, PathLike)):
+                with open(file, "w", encoding="utf-8", newline="") as stream:
+                    self._write(stream, records)
+            else:
+                self._write(file, records)
+        return len(records)
+
+    @staticmethod
+    def _write(stream: TextIO, records: list[TraceRecord]) -> None:
+        writer = csv.writer(stream)
+        writer.writerow(("time", "bus", "address", "endpoint", "transfer_type",
+                         "length", "actual_length", "status"))
+        for record in records:
+            bus, address = record.device or ("", "")
+            writer.writerow((f"{record.time:.6f}", bus, address, f"0x{record.endpoint:02x}",
+                             _transfer_type_names.get(record.transfer_type,
+                                                      record.transfer_type),
+                             record.length, record.actual_length,
+                             _transfer_status_names.get(record.status, record.status)))
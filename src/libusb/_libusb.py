@@ -28,6 +28,8 @@ from __future__ import annotations
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import typing
+import array
+import struct
 from typing import TYPE_CHECKING, TypeVar, TypeAlias
 from collections.abc import Callable
 import ctypes as ct
@@ -40,6 +42,10 @@ from ._platform import defined
 from ._platform import limits
 from ._dll      import dll
 
+if TYPE_CHECKING:
+    from _ctypes import CFuncPtr as _CFuncPtr
+    import numpy
+
 intptr_t = (ct.c_int32 if ct.sizeof(ct.c_void_p) == ct.sizeof(ct.c_int32) else ct.c_int64)
 
 _F = TypeVar("_F", bound=Callable[..., object])
@@ -176,6 +182,18 @@ cpu_to_le16 = CFUNC(ct.c_uint16, ct.c_uint16)(cpu_to_le16)
 
 le16_to_cpu = cpu_to_le16
 
+# Plain Python counterparts of libusb.cpu_to_le16() and libusb.le16_to_cpu()
+# for the internal use of the inline helpers below (no ctypes callback thunk
+# on the hot path).
+
+if ct.c_uint16.__ctype_le__ is ct.c_uint16:
+    def _cpu_to_le16(x: int) -> int:
+        return x
+else:  # pragma: no cover
+    def _cpu_to_le16(x: int) -> int:
+        return ((x & 0xFF) << 8) | ((x >> 8) & 0xFF)
+_le16_to_cpu = _cpu_to_le16
+
 ### standard USB stuff ###
 
 # \ingroup libusb::desc
@@ -1579,6 +1597,45 @@ transfer._fields_ = [
     ("iso_packet_desc", (iso_packet_descriptor * 0)),
 ]
 
+# The iso_packet_desc member is a C flexible array member, declared above
+# as a zero-length array. This returns the array of iso packet descriptors
+# of the transfer sized to its num_iso_packets field.
+
+def _iso_packet_desc(transf: transfer) -> ct.Array[iso_packet_descriptor]:
+    descs: ct.Array[iso_packet_descriptor] = (
+        iso_packet_descriptor * transf.num_iso_packets).from_address(
+            ct.addressof(transf) + _iso_packet_desc_offset)
+    return descs
+_iso_packet_desc_offset: int = transfer.iso_packet_desc.offset
+
+# Types of the buffer, callback and user_data arguments of the
+# libusb.fill_*_transfer() helpers.
+
+if TYPE_CHECKING:
+    transfer_buffer_type: TypeAlias = ctx.POINTER[ct.c_ubyte] | ct.Array[ct.c_ubyte]
+    transfer_callback_type: TypeAlias = _CFuncPtr | transfer_cb_fn_type | None
+    transfer_user_data_type: TypeAlias = (int | ct.c_void_p | ctx.POINTER[typing.Any] |
+                                          ct.Array[typing.Any] | None)
+
+# Sets the callback of a transfer populated by the libusb.fill_*_transfer()
+# helpers. A libusb.transfer_cb_fn is set as is (the caller keeps it alive
+# while the transfer is submitted) and None as the NULL function pointer.
+# Any other callable is wrapped in a new libusb.transfer_cb_fn, referenced
+# (by the address of the transfer) until the transfer is populated again
+# or freed by libusb.free_transfer(), since the transfer itself may be
+# reached through a temporary pointer.
+
+def _set_callback(transf: transfer, callback: transfer_callback_type) -> None:
+    if callback is None:
+        callback = _null_callback
+    if isinstance(callback, transfer_cb_fn):
+        if _callbacks: _callbacks.pop(ct.addressof(transf), None)
+        transf.callback = callback
+    else:
+        transf.callback = _callbacks[ct.addressof(transf)] = transfer_cb_fn(callback)
+_null_callback = transfer_cb_fn()
+_callbacks: dict[int, _CFuncPtr] = {}
+
 # \ingroup libusb::misc
 # Capabilities supported by an instance of libusb on the current running
 # platform. Test if the loaded library supports a given capability by calling
@@ -2287,6 +2344,11 @@ except: pass  # pragma: no cover
 
 ## async I/O ##
 
+# The libusb.fill_*_transfer(), libusb.fill_control_setup() and
+# libusb.set_iso_packet_lengths() helpers (static inline in C) are plain
+# Python functions. Their C-callable (ctypes function pointer) variants
+# are available under the same names suffixed with '_cfunc'.
+
 # \ingroup libusb::asyncio
 # Get the data section of a control transfer. This convenience function is here
 # to remind you that the data does not start until 8 bytes into the actual
@@ -2302,7 +2364,8 @@ except: pass  # pragma: no cover
 # static inline
 def control_transfer_get_data(transfer: ctx.POINTER[transfer]) -> ctx.POINTER[ct.c_ubyte]:
     transf = transfer[0]
-    return ct.cast(transf.buffer + LIBUSB_CONTROL_SETUP_SIZE, ct.POINTER(ct.c_ubyte))
+    return typing.cast("ctx.POINTER[ct.c_ubyte]",
+                       ctx.c_ptr_add(transf.buffer, LIBUSB_CONTROL_SETUP_SIZE))
 # control_transfer_get_data = CFUNC(ct.POINTER(ct.c_ubyte),
 #                                   ct.POINTER(transfer))(control_transfer_get_data)
 
@@ -2325,6 +2388,41 @@ def control_transfer_get_setup(transfer: ctx.POINTER[transfer]) -> ctx.POINTER[c
 # control_transfer_get_setup = CFUNC(ct.POINTER(control_setup),
 #                                    ct.POINTER(transfer))(control_transfer_get_setup)
 
+# \ingroup libusb::asyncio
+# Get the data received (or sent) by a completed transfer, without copying.
+# This is a Python extension (there is no such function in libusb).
+#
+# The returned memoryview refers directly to the transfer buffer and is
+# valid only as long as the buffer is, so it should be consumed (or copied)
+# before the transfer is resubmitted or freed.
+#
+# :param transfer: a transfer
+# :returns: a read-only memoryview of the first
+# \ref libusb.transfer::actual_length "actual_length" bytes of the buffer
+
+def transfer_get_data(transfer: ctx.POINTER[transfer]) -> memoryview:
+    transf = transfer[0]
+    return _buffer_view(transf.buffer, transf.actual_length).toreadonly()
+
+# \ingroup libusb::asyncio
+# Get a writable view over the whole buffer of a transfer (e.g. to fill the
+# data of an OUT transfer in place). This is a Python extension (there is
+# no such function in libusb).
+#
+# :param transfer: a transfer
+# :returns: a memoryview of the \ref libusb.transfer::length "length" bytes
+# of the buffer
+
+def transfer_get_buffer(transfer: ctx.POINTER[transfer]) -> memoryview:
+    transf = transfer[0]
+    return _buffer_view(transf.buffer, transf.length)
+
+def _buffer_view(buffer: ctx.POINTER[ct.c_ubyte], length: int) -> memoryview:
+    address = ct.cast(buffer, ct.c_void_p).value or 0
+    if not address and length:
+        raise ValueError("transfer has no buffer")
+    return memoryview((ct.c_ubyte * length).from_address(address)).cast("B")
+
 # \ingroup libusb::asyncio
 # Helper function to populate the setup packet (first 8 bytes of the data
 # buffer) for a control transfer. The wIndex, wValue and wLength values should
@@ -2349,17 +2447,36 @@ def control_transfer_get_setup(transfer: ctx.POINTER[transfer]) -> ctx.POINTER[c
 # \ref libusb.control_setup
 
 # static inline
-def fill_control_setup(buffer: ctx.POINTER[ct.c_ubyte], bmRequestType: ct.c_uint8,
-                       bRequest: ct.c_uint8, wValue: ct.c_uint16, wIndex: ct.c_uint16,
-                       wLength: ct.c_uint16) -> None:
+def fill_control_setup(buffer: transfer_buffer_type, bmRequestType: int, bRequest: int,
+                       wValue: int, wIndex: int, wLength: int) -> None:
     setup = ct.cast(buffer, ct.POINTER(control_setup))[0]
     setup.bmRequestType = bmRequestType
     setup.bRequest      = bRequest
-    setup.wValue        = cpu_to_le16(wValue)
-    setup.wIndex        = cpu_to_le16(wIndex)
-    setup.wLength       = cpu_to_le16(wLength)
-fill_control_setup = CFUNC(None, ct.POINTER(ct.c_ubyte), ct.c_uint8, ct.c_uint8,
-                           ct.c_uint16, ct.c_uint16, ct.c_uint16)(fill_control_setup)
+    setup.wValue        = _cpu_to_le16(wValue)
+    setup.wIndex        = _cpu_to_le16(wIndex)
+    setup.wLength       = _cpu_to_le16(wLength)
+fill_control_setup_cfunc = CFUNC(None, ct.POINTER(ct.c_ubyte), ct.c_uint8, ct.c_uint8, ct.c_uint16,
+                                 ct.c_uint16, ct.c_uint16)(fill_control_setup)
+
+# \ingroup libusb::asyncio
+# Faster variant of libusb.fill_control_setup() for Python callers, packing
+# the whole setup packet at once (in little-endian byte order) into any
+# writable buffer (a ctypes array, a bytearray, ...) at the given offset.
+# This is a Python extension (there is no such function in libusb).
+#
+# :param buffer: buffer to output the setup packet into
+# :param bmRequestType: see libusb.fill_control_setup()
+# :param bRequest: see libusb.fill_control_setup()
+# :param wValue: see libusb.fill_control_setup()
+# :param wIndex: see libusb.fill_control_setup()
+# :param wLength: see libusb.fill_control_setup()
+# :param offset: position of the setup packet in the buffer
+
+def pack_control_setup(buffer: typing.Any, bmRequestType: int, bRequest: int,
+                       wValue: int, wIndex: int, wLength: int, offset: int = 0) -> None:
+    _control_setup_struct.pack_into(buffer, offset,
+                                    bmRequestType, bRequest, wValue, wIndex, wLength)
+_control_setup_struct = struct.Struct("<BBHHH")
 
 alloc_transfer = CFUNC(ct.POINTER(transfer),
     ct.c_int)(
@@ -2376,11 +2493,18 @@ cancel_transfer = CFUNC(ct.c_int,
     ("libusb_cancel_transfer", dll), (
     (1, "transfer"),))
 
-free_transfer = CFUNC(None,
+_free_transfer = CFUNC(None,
     ct.POINTER(transfer))(
     ("libusb_free_transfer", dll), (
     (1, "transfer"),))
 
+def free_transfer(transfer: ctx.POINTER[transfer] | None) -> None:
+    # Drops the callback wrapped for the transfer by the fill_*_transfer()
+    # helpers along with the transfer.
+    if transfer and _callbacks:
+        _callbacks.pop(ct.addressof(transfer.contents), None)
+    _free_transfer(transfer)
+
 transfer_get_stream_id = CFUNC(ct.c_uint32,
     ct.POINTER(transfer))(
     ("libusb_transfer_get_stream_id", dll), (
@@ -2421,23 +2545,26 @@ transfer_set_stream_id = CFUNC(None,
 # :param timeout: timeout for the transfer in milliseconds
 
 # static inline
-def fill_control_transfer(transfer: ctx.POINTER[transfer], dev_handle: ctx.POINTER[device_handle],
-                          buffer: ctx.POINTER[ct.c_ubyte], callback: transfer_cb_fn_type,
-                          user_data: ct.c_void_p, timeout: ct.c_uint) -> None:
+def fill_control_transfer(transfer: ctx.POINTER[transfer],
+                          dev_handle: ctx.POINTER[device_handle] | None,
+                          buffer: transfer_buffer_type | None, callback: transfer_callback_type,
+                          user_data: transfer_user_data_type, timeout: int) -> None:
     transf = transfer[0]
-    setup_ptr = ct.cast(buffer, ct.POINTER(control_setup))
     transf.dev_handle = dev_handle
     transf.endpoint   = 0
     transf.type       = LIBUSB_TRANSFER_TYPE_CONTROL
     transf.timeout    = timeout
     transf.buffer     = buffer
-    if setup_ptr:
-        transf.length = ct.c_int(LIBUSB_CONTROL_SETUP_SIZE + le16_to_cpu(setup_ptr[0].wLength))
-    transf.user_data  = user_data
-    transf.callback   = callback
-fill_control_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
-                              ct.POINTER(ct.c_ubyte), transfer_cb_fn, ct.c_void_p,
-                              ct.c_uint)(fill_control_transfer)
+    if buffer is not None:
+        setup_ptr = ct.cast(buffer, ct.POINTER(control_setup))
+        if setup_ptr:
+            transf.length = LIBUSB_CONTROL_SETUP_SIZE + _le16_to_cpu(setup_ptr[0].wLength)
+    transf.user_data = (user_data if user_data is None or isinstance(user_data, int) else
+                        ct.cast(user_data, ct.c_void_p))
+    _set_callback(transf, callback)
+fill_control_transfer_cfunc = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
+                                    ct.POINTER(ct.c_ubyte), transfer_cb_fn, ct.c_void_p,
+                                    ct.c_uint)(fill_control_transfer)
 
 # \ingroup libusb::asyncio
 # Helper function to populate the required \ref libusb.transfer fields
@@ -2453,10 +2580,11 @@ fill_control_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_hand
 # :param timeout: timeout for the transfer in milliseconds
 
 # static inline
-def fill_bulk_transfer(transfer: ctx.POINTER[transfer], dev_handle: ctx.POINTER[device_handle],
-                       endpoint: ct.c_ubyte, buffer: ctx.POINTER[ct.c_ubyte], length: ct.c_int,
-                       callback: transfer_cb_fn_type, user_data: ct.c_void_p,
-                       timeout: ct.c_uint) -> None:
+def fill_bulk_transfer(transfer: ctx.POINTER[transfer],
+                       dev_handle: ctx.POINTER[device_handle] | None, endpoint: int,
+                       buffer: transfer_buffer_type | None, length: int,
+                       callback: transfer_callback_type, user_data: transfer_user_data_type,
+                       timeout: int) -> None:
     transf = transfer[0]
     transf.dev_handle = dev_handle
     transf.endpoint   = endpoint
@@ -2464,11 +2592,12 @@ def fill_bulk_transfer(transfer: ctx.POINTER[transfer], dev_handle: ctx.POINTER[
     transf.timeout    = timeout
     transf.buffer     = buffer
     transf.length     = length
-    transf.user_data  = user_data
-    transf.callback   = callback
-fill_bulk_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle), ct.c_ubyte,
-                           ct.POINTER(ct.c_ubyte), ct.c_int, transfer_cb_fn, ct.c_void_p,
-                           ct.c_uint)(fill_bulk_transfer)
+    transf.user_data = (user_data if user_data is None or isinstance(user_data, int) else
+                        ct.cast(user_data, ct.c_void_p))
+    _set_callback(transf, callback)
+fill_bulk_transfer_cfunc = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle), ct.c_ubyte,
+                                 ct.POINTER(ct.c_ubyte), ct.c_int, transfer_cb_fn, ct.c_void_p,
+                                 ct.c_uint)(fill_bulk_transfer)
 
 # \ingroup libusb::asyncio
 # Helper function to populate the required \ref libusb.transfer fields
@@ -2488,19 +2617,19 @@ fill_bulk_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle)
 
 # static inline
 def fill_bulk_stream_transfer(transfer: ctx.POINTER[transfer],
-                              dev_handle: ctx.POINTER[device_handle], endpoint: ct.c_ubyte,
-                              stream_id: ct.c_uint32, buffer: ctx.POINTER[ct.c_ubyte],
-                              length: ct.c_int, callback: transfer_cb_fn_type,
-                              user_data: ct.c_void_p, timeout: ct.c_uint) -> None:
+                              dev_handle: ctx.POINTER[device_handle] | None, endpoint: int,
+                              stream_id: int, buffer: transfer_buffer_type | None,
+                              length: int, callback: transfer_callback_type,
+                              user_data: transfer_user_data_type, timeout: int) -> None:
     fill_bulk_transfer(transfer, dev_handle, endpoint,
                        buffer, length, callback, user_data, timeout)
     transf = transfer[0]
     transf.type = LIBUSB_TRANSFER_TYPE_BULK_STREAM
     transfer_set_stream_id(transfer, stream_id)
-fill_bulk_stream_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
-                                  ct.c_ubyte, ct.c_uint32, ct.POINTER(ct.c_ubyte),
-                                  ct.c_int, transfer_cb_fn, ct.c_void_p,
-                                  ct.c_uint)(fill_bulk_stream_transfer)
+fill_bulk_stream_transfer_cfunc = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
+                                        ct.c_ubyte, ct.c_uint32, ct.POINTER(ct.c_ubyte), ct.c_int,
+                                        transfer_cb_fn, ct.c_void_p,
+                                        ct.c_uint)(fill_bulk_stream_transfer)
 
 # \ingroup libusb::asyncio
 # Helper function to populate the required \ref libusb.transfer fields
@@ -2517,10 +2646,10 @@ fill_bulk_stream_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_
 
 # static inline
 def fill_interrupt_transfer(transfer: ctx.POINTER[transfer],
-                            dev_handle: ctx.POINTER[device_handle], endpoint: ct.c_ubyte,
-                            buffer: ctx.POINTER[ct.c_ubyte], length: ct.c_int,
-                            callback: transfer_cb_fn_type, user_data: ct.c_void_p,
-                            timeout: ct.c_uint) -> None:
+                            dev_handle: ctx.POINTER[device_handle] | None, endpoint: int,
+                            buffer: transfer_buffer_type | None, length: int,
+                            callback: transfer_callback_type, user_data: transfer_user_data_type,
+                            timeout: int) -> None:
     transf = transfer[0]
     transf.dev_handle = dev_handle
     transf.endpoint   = endpoint
@@ -2528,11 +2657,12 @@ def fill_interrupt_transfer(transfer: ctx.POINTER[transfer],
     transf.timeout    = timeout
     transf.buffer     = buffer
     transf.length     = length
-    transf.user_data  = user_data
-    transf.callback   = callback
-fill_interrupt_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
-                                ct.c_ubyte, ct.POINTER(ct.c_ubyte), ct.c_int, transfer_cb_fn,
-                                ct.c_void_p, ct.c_uint)(fill_interrupt_transfer)
+    transf.user_data = (user_data if user_data is None or isinstance(user_data, int) else
+                        ct.cast(user_data, ct.c_void_p))
+    _set_callback(transf, callback)
+fill_interrupt_transfer_cfunc = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
+                                      ct.c_ubyte, ct.POINTER(ct.c_ubyte), ct.c_int, transfer_cb_fn,
+                                      ct.c_void_p, ct.c_uint)(fill_interrupt_transfer)
 
 # \ingroup libusb::asyncio
 # Helper function to populate the required \ref libusb.transfer fields
@@ -2549,10 +2679,11 @@ fill_interrupt_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_ha
 # :param timeout: timeout for the transfer in milliseconds
 
 # static inline
-def fill_iso_transfer(transfer: ctx.POINTER[transfer], dev_handle: ctx.POINTER[device_handle],
-                      endpoint: ct.c_ubyte, buffer: ctx.POINTER[ct.c_ubyte], length: ct.c_int,
-                      num_iso_packets: ct.c_int, callback: transfer_cb_fn_type,
-                      user_data: ct.c_void_p, timeout: ct.c_uint) -> None:
+def fill_iso_transfer(transfer: ctx.POINTER[transfer],
+                      dev_handle: ctx.POINTER[device_handle] | None, endpoint: int,
+                      buffer: transfer_buffer_type | None, length: int, num_iso_packets: int,
+                      callback: transfer_callback_type, user_data: transfer_user_data_type,
+                      timeout: int) -> None:
     transf = transfer[0]
     transf.dev_handle      = dev_handle
     transf.endpoint        = endpoint
@@ -2561,11 +2692,12 @@ def fill_iso_transfer(transfer: ctx.POINTER[transfer], dev_handle: ctx.POINTER[d
     transf.buffer          = buffer
     transf.length          = length
     transf.num_iso_packets = num_iso_packets
-    transf.user_data       = user_data
-    transf.callback        = callback
-fill_iso_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
-                          ct.c_ubyte, ct.POINTER(ct.c_ubyte), ct.c_int, ct.c_int,
-                          transfer_cb_fn, ct.c_void_p, ct.c_uint)(fill_iso_transfer)
+    transf.user_data = (user_data if user_data is None or isinstance(user_data, int) else
+                        ct.cast(user_data, ct.c_void_p))
+    _set_callback(transf, callback)
+fill_iso_transfer_cfunc = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle), ct.c_ubyte,
+                                ct.POINTER(ct.c_ubyte), ct.c_int, ct.c_int, transfer_cb_fn,
+                                ct.c_void_p, ct.c_uint)(fill_iso_transfer)
 
 # \ingroup libusb::asyncio
 # Convenience function to set the length of all packets in an isochronous
@@ -2576,11 +2708,44 @@ fill_iso_transfer = CFUNC(None, ct.POINTER(transfer), ct.POINTER(device_handle),
 # \see libusb.get_max_packet_size()
 
 # static inline
-def set_iso_packet_lengths(transfer: ctx.POINTER[transfer], length: ct.c_uint) -> None:
+def set_iso_packet_lengths(transfer: ctx.POINTER[transfer], length: int) -> None:
     transf = transfer[0]
-    for i in range(transf.num_iso_packets):
-        transf.iso_packet_desc[i].length = length
-set_iso_packet_lengths = CFUNC(None, ct.POINTER(transfer), ct.c_uint)(set_iso_packet_lengths)
+    descs = _iso_packet_desc_words(transf)
+    descs[0::3] = array.array("I", (length,)) * transf.num_iso_packets
+set_iso_packet_lengths_cfunc = CFUNC(None, ct.POINTER(transfer), ct.c_uint)(set_iso_packet_lengths)
+
+# \ingroup libusb::asyncio
+# Convenience function to set the lengths of all packets in an isochronous
+# transfer from a sequence (e.g. a list, an array.array or a NumPy array) of
+# num_iso_packets lengths, with a single write to the packet descriptors.
+# This is a Python extension (there is no such function in libusb).
+#
+# :param transfer: a transfer
+# :param lengths: the lengths to set in the isochronous packet descriptors
+# :param reset: if true, the actual_length and status of every packet
+# are zeroed as well
+
+def set_iso_packet_lengths_from(transfer: ctx.POINTER[transfer],
+                                lengths: typing.Iterable[int],
+                                reset: bool = False) -> None:
+    transf = transfer[0]
+    values = array.array("I", lengths)
+    if len(values) != transf.num_iso_packets:
+        raise ValueError(f"expected {transf.num_iso_packets} lengths, "
+                         f"got {len(values)}")
+    descs = _iso_packet_desc_words(transf)
+    if reset:
+        packed = array.array("I", bytes(descs.nbytes))
+        packed[0::3] = values
+        descs[:] = packed
+    else:
+        descs[0::3] = values
+
+# The iso packet descriptors of a transfer as a view of unsigned ints (three
+# per descriptor: length, actual_length and status).
+
+def _iso_packet_desc_words(transf: transfer) -> memoryview:
+    return memoryview(_iso_packet_desc(transf)).cast("B").cast("I")
 
 # \ingroup libusb::asyncio
 # Convenience function to locate the position of an isochronous packet
@@ -2600,8 +2765,8 @@ set_iso_packet_lengths = CFUNC(None, ct.POINTER(transfer), ct.c_uint)(set_iso_pa
 
 # static inline
 def get_iso_packet_buffer(transfer: ctx.POINTER[transfer],
-                          packet: ct.c_uint) -> ctx.POINTER[ct.c_ubyte]:
-    packet_no: int = packet.value
+                          packet: ct.c_uint | int) -> ctx.POINTER[ct.c_ubyte]:
+    packet_no: int = packet if isinstance(packet, int) else packet.value
 
     # oops..slight bug in the API. packet is an unsigned int, but we use
     # signed integers almost everywhere else. range-check and convert to
@@ -2614,11 +2779,10 @@ def get_iso_packet_buffer(transfer: ctx.POINTER[transfer],
     if packet_no >= transf.num_iso_packets:
         return ct.POINTER(ct.c_ubyte)()
 
-    offset = 0
-    for i in range(packet_no):
-        offset += transf.iso_packet_desc[i].length
+    offset = sum(desc.length for desc in _iso_packet_desc(transf)[:packet_no])
 
-    return ct.cast(transf.buffer + offset, ct.POINTER(ct.c_ubyte))
+    return typing.cast("ctx.POINTER[ct.c_ubyte]",
+                       ctx.c_ptr_add(transf.buffer, offset))
 # get_iso_packet_buffer = CFUNC(ct.POINTER(ct.c_ubyte), ct.POINTER(transfer),
 #                               ct.c_uint)(get_iso_packet_buffer)
 
@@ -2643,8 +2807,8 @@ def get_iso_packet_buffer(transfer: ctx.POINTER[transfer],
 
 # static inline
 def get_iso_packet_buffer_simple(transfer: ctx.POINTER[transfer],
-                                 packet: ct.c_uint) -> ctx.POINTER[ct.c_ubyte]:
-    packet_no: int = packet.value
+                                 packet: ct.c_uint | int) -> ctx.POINTER[ct.c_ubyte]:
+    packet_no: int = packet if isinstance(packet, int) else packet.value
 
     # oops..slight bug in the API. packet is an unsigned int, but we use
     # signed integers almost everywhere else. range-check and convert to
@@ -2657,12 +2821,78 @@ def get_iso_packet_buffer_simple(transfer: ctx.POINTER[transfer],
     if packet_no >= transf.num_iso_packets:
         return ct.POINTER(ct.c_ubyte)()
 
-    return ct.cast(transf.buffer
-                   + ct.c_int(transf.iso_packet_desc[0].length).value * packet_no,
-                   ct.POINTER(ct.c_ubyte))
+    packet_length = ct.c_int(_iso_packet_desc(transf)[0].length).value
+    return typing.cast("ctx.POINTER[ct.c_ubyte]",
+                       ctx.c_ptr_add(transf.buffer, packet_length * packet_no))
 # get_iso_packet_buffer_simple = CFUNC(ct.POINTER(ct.c_ubyte), ct.POINTER(transfer),
 #                                      ct.c_uint)(get_iso_packet_buffer_simple)
 
+# \ingroup libusb::asyncio
+# Describes an isochronous packet of a transfer, as returned by
+# libusb.get_iso_packets(). This is a Python extension (there is no such
+# structure in libusb).
+
+class iso_packet(typing.NamedTuple):
+    # Position of the packet buffer inside the transfer buffer
+    offset: int
+    # Length of data requested in this packet
+    length: int
+    # Amount of data that was actually transferred
+    actual_length: int
+    # Status code for this packet
+    status: int
+    # Data actually transferred in this packet (a view of the transfer buffer)
+    data: memoryview
+
+# \ingroup libusb::asyncio
+# Describe all isochronous packets of a transfer in one pass through their
+# descriptors (unlike calling libusb.get_iso_packet_buffer() for each packet,
+# which loops through all preceding packets every time).
+# This is a Python extension (there is no such function in libusb).
+#
+# The data views refer directly to the transfer buffer and are valid only
+# as long as the buffer is.
+#
+# :param transfer: a transfer
+# :returns: list of \ref libusb.iso_packet, one for every packet
+
+def get_iso_packets(transfer: ctx.POINTER[transfer]) -> list[iso_packet]:
+    transf = transfer[0]
+    descs  = _iso_packet_desc(transf)
+    buffer = _buffer_view(transf.buffer, sum(desc.length for desc in descs))
+    packets = []
+    offset = 0
+    for desc in descs:
+        length = desc.length
+        actual_length = desc.actual_length
+        packets.append(iso_packet(offset, length, actual_length, desc.status,
+                                  buffer[offset:offset + actual_length]))
+        offset += length
+    return packets
+
+# \ingroup libusb::asyncio
+# NumPy form of libusb.get_iso_packets() (requires NumPy to be installed).
+# This is a Python extension (there is no such function in libusb).
+#
+# :param transfer: a transfer
+# :returns: numpy structured array with the offset, length, actual_length
+# and status fields, one element for every packet
+
+def get_iso_packets_array(transfer: ctx.POINTER[transfer]) -> numpy.ndarray:
+    import numpy
+    transf = transfer[0]
+    packets = numpy.zeros(transf.num_iso_packets,
+                          dtype=[("offset",        numpy.intp),
+                                 ("length",        numpy.uintc),
+                                 ("actual_length", numpy.uintc),
+                                 ("status",        numpy.intc)])
+    if not len(packets): return packets
+    descs = numpy.ctypeslib.as_array(_iso_packet_desc(transf))
+    for name in ("length", "actual_length", "status"):
+        packets[name] = descs[name]
+    numpy.cumsum(packets["length"][:-1], out=packets["offset"][1:])
+    return packets
+
 ## sync I/O ##
 
 control_transfer = CFUNC(ct.c_int,
@@ -3122,20 +3352,19 @@ _set_option_log_cb = CFUNC(ct.c_int,
     (1, "option"),
     (1, "value"),))
 
-def set_option(ctx: ctx.POINTER[context], option: option,
-               *values: ct.c_int | log_cb_type) -> ct.c_int:
+def set_option(ctx: ctx.POINTER[context] | None, option: int,
+               *values: int | log_cb_type) -> int:
     # LIBUSB_CALLV
-    opt = typing.cast(int, option)
-    if opt == LIBUSB_OPTION_LOG_LEVEL:
-        result = _set_option_int(ctx, opt, values[0])
-    elif opt == LIBUSB_OPTION_LOG_CB:
-        result = _set_option_log_cb(ctx, opt, values[0])
-    elif opt in [LIBUSB_OPTION_USE_USBDK,
-                 LIBUSB_OPTION_NO_DEVICE_DISCOVERY]:
-        result = _set_option_int(ctx, opt, 0)
+    if option == LIBUSB_OPTION_LOG_LEVEL:
+        result = _set_option_int(ctx, option, values[0])
+    elif option == LIBUSB_OPTION_LOG_CB:
+        result = _set_option_log_cb(ctx, option, values[0])
+    elif option in [LIBUSB_OPTION_USE_USBDK,
+                    LIBUSB_OPTION_NO_DEVICE_DISCOVERY]:
+        result = _set_option_int(ctx, option, 0)
     else:
-        result = _set_option_int(ctx, opt, 0)
-    return typing.cast(ct.c_int, result)
+        result = _set_option_int(ctx, option, 0)
+    return typing.cast(int, result)
 
 # if defined("ENABLE_LOGGING") and not defined("ENABLE_DEBUG_LOGGING"):
 context._fields_ = [
@@ -0,0 +1,192 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('LogBridge',)
+
+from typing_extensions import Self
+from collections import deque
+import threading
+import logging
+import time
+import re
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from ._error import USBError
+
+# Python logging levels of the libusb log levels and vice versa.
+_logging_levels = {
+    usb.LIBUSB_LOG_LEVEL_ERROR:   logging.ERROR,
+    usb.LIBUSB_LOG_LEVEL_WARNING: logging.WARNING,
+    usb.LIBUSB_LOG_LEVEL_INFO:    logging.INFO,
+    usb.LIBUSB_LOG_LEVEL_DEBUG:   logging.DEBUG,
+}
+
+# The "[ timestamp] [threadID] " header of libusb's debug messages.
+_header = re.compile(r"\[\s*[\d.]+\] \[[0-9a-fA-F]+\] ")
+
+
+def _libusb_level(level: int) -> int:
+    # The libusb log level producing the messages of a logging level.
+    if level <= logging.DEBUG:    return usb.LIBUSB_LOG_LEVEL_DEBUG
+    if level <= logging.INFO:     return usb.LIBUSB_LOG_LEVEL_INFO
+    if level <= logging.WARNING:  return usb.LIBUSB_LOG_LEVEL_WARNING
+    if level <= logging.CRITICAL: return usb.LIBUSB_LOG_LEVEL_ERROR
+    return usb.LIBUSB_LOG_LEVEL_NONE
+
+
+class LogBridge:
+    """Bridge of libusb's log messages into the logging module.
+
+    Installs a log callback (libusb.set_log_cb(), or the
+    LIBUSB_OPTION_LOG_CB option) which does nothing but append the message
+    to a bounded deque (an atomic operation which takes no lock; if the
+    deque is full the oldest message is dropped and counted). A daemon
+    thread drains the deque every interval seconds into logger, so libusb
+    never waits for the logging handlers.
+
+    The thread also keeps LIBUSB_OPTION_LOG_LEVEL matching the effective
+    level of logger, so messages which logger would filter out are not
+    even produced by libusb. The logging module tells nobody about level
+    changes, so the thread picks a change up within interval seconds;
+    call sync_level() after changing the level to push it at once.
+    Repetitions of a message within rate_limit seconds are suppressed (and
+    counted in the next one logged).
+
+        with libusb.LogBridge(ctx, logging.getLogger("usb")):
+            ...
+
+    Messages from contexts other than ctx are bridged too if ctx is None
+    (a global log callback). The LIBUSB_DEBUG environment variable, if set,
+    takes precedence over the level set. libusb cannot tell the level set
+    before, so close() resets it to LIBUSB_LOG_LEVEL_NONE (libusb's
+    default), lest libusb keep logging to stderr.
+    """
+
+    def __init__(self, ctx: ctx.POINTER[usb.context] | None = None,
+                 logger: logging.Logger | str = "libusb", capacity: int = 1024,
+                 rate_limit: float = 1.0, interval: float = 0.1) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.ctx = ctx
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.capacity   = capacity
+        self.rate_limit = rate_limit
+        self.interval   = interval
+        #: Numbers of messages dropped (the queue being full) and suppressed
+        #: as repetitions.
+        self.dropped    = 0
+        self.suppressed = 0
+        self._queue: deque[tuple[int, bytes]] = deque(maxlen=capacity)
+        # Time logged and number of suppressed repetitions, by message.
+        self._recent: dict[str, tuple[float, int]] = {}
+        self._level: int | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        # Must be kept alive for as long as the callback is installed.
+        self._callback = usb.log_cb(self._log_cb)
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """Install the log callback and start the draining thread."""
+        if self._thread is not None:
+            raise RuntimeError("bridge already started")
+        self._set_callback(self._callback)
+        self.sync_level()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="libusb log bridge",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Uninstall the log callback, reset LIBUSB_OPTION_LOG_LEVEL to
+        LIBUSB_LOG_LEVEL_NONE, log the queued messages and stop the
+        thread."""
+        if self._thread is None: return
+        self._set_callback(usb.log_cb())  # NULL
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._level = None
+        rc = usb.set_option(self.ctx, usb.LIBUSB_OPTION_LOG_LEVEL, usb.LIBUSB_LOG_LEVEL_NONE)
+        self.drain()
+        if rc < 0:
+            raise USBError(rc)
+
+    def sync_level(self) -> int:
+        """Set LIBUSB_OPTION_LOG_LEVEL to the effective level of the logger
+        (if it has changed) and return it.
+
+        Called by the draining thread every interval seconds; call it
+        directly to apply a change of the logger's level at once.
+        """
+        level = _libusb_level(self.logger.getEffectiveLevel())
+        if level != self._level:
+            rc = usb.set_option(self.ctx, usb.LIBUSB_OPTION_LOG_LEVEL, level)
+            if rc < 0:
+                raise USBError(rc)
+            self._level = level
+        return level
+
+    def drain(self) -> int:
+        """Log the queued messages now and return their number."""
+        queue, logger = self._queue, self.logger
+        recent, rate_limit = self._recent, self.rate_limit
+        count = 0
+        while queue:
+            try:
+                level, data = queue.popleft()
+            except IndexError:  # pragma: no cover
+                break
+            count += 1
+            message = data.decode("utf-8", "replace").rstrip()
+            if rate_limit > 0:
+                now = time.monotonic()
+                key = _header.sub("", message, count=1)
+                last, repeated = recent.get(key, (None, 0))
+                if last is not None and now - last < rate_limit:
+                    recent[key] = (last, repeated + 1)
+                    self.suppressed += 1
+                    continue
+                recent[key] = (now, 0)
+                if repeated:
+                    message += f" ({repeated} repetitions suppressed)"
+                if len(recent) > 2 * self.capacity:
+                    self._recent = recent = {key: value for key, value in recent.items()
+                                             if now - value[0] < rate_limit}
+            logger.log(_logging_levels.get(level, logging.DEBUG), "%s", message)
+        return count
+
+    def _set_callback(self, callback: usb.log_cb) -> None:
+        set_log_cb = getattr(usb, "set_log_cb", None)
+        if set_log_cb is not None:
+            set_log_cb(self.ctx, callback, usb.LIBUSB_LOG_CB_GLOBAL if self.ctx is None
+                                           else usb.LIBUSB_LOG_CB_CONTEXT)
+        else:
+            rc = usb.set_option(self.ctx, usb.LIBUSB_OPTION_LOG_CB, callback)
+            if rc < 0:
+                raise USBError(rc)
+
+    def _log_cb(self, ctx: ctx.POINTER[usb.context], level: int, message: bytes) -> None:
+        # Called by libusb (possibly holding its locks): just queue.
+        queue = self._queue
+        if len(queue) == self.capacity:
+            self.dropped += 1
+        queue.append((level, message))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.drain()
+            try:
+                self.sync_level()
+            except USBError as exc:  # pragma: no cover
+                self.logger.error("cannot set the libusb log level: %s", exc)
@@ -0,0 +1,186 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('TransferMetrics',)
+
+from typing import TextIO
+from os import PathLike
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import os
+
+from . import _libusb as usb
+from ._instrument import _Instrument, Device, _transfer_status_names
+
+# Layout of the counters of an endpoint: the numbers of transfers completed
+# with each status (indexed by status), then the numbers of bytes transferred
+# and of resubmits.
+_NUM_STATUSES = len(_transfer_status_names)
+_BYTES     = _NUM_STATUSES
+_RESUBMITS = _NUM_STATUSES + 1
+_NUM_COUNTERS = _NUM_STATUSES + 2
+
+_errors = frozenset(_transfer_status_names) - {usb.LIBUSB_TRANSFER_COMPLETED,
+                                               usb.LIBUSB_TRANSFER_CANCELLED}
+
+
+class TransferMetrics(_Instrument):
+    """Per-device and per-endpoint transfer counters exported in the
+    OpenMetrics (Prometheus) text format.
+
+    While enabled, the completions of the transfers submitted by the
+    engines of this package are counted per (device, endpoint), where
+    device is (bus number, device address): transfers by status, bytes
+    transferred, errors by status, cancellations, timeouts and resubmits
+    (completions whose callback submitted the transfer again).
+
+    Every thread handling libusb events counts in its own counters, so
+    the counting takes no lock; the counters of all threads are summed up
+    by counters() and render(). The metrics can be written to a file (e.g.
+    for the textfile collector of the Prometheus node exporter) by write()
+    or served over HTTP:
+
+        metrics = libusb.TransferMetrics()
+        metrics.enable()
+        server = metrics.serve(9464)  # http://127.0.0.1:9464/metrics
+        ...
+        server.shutdown()
+    """
+
+    #: Content type of render()'s output.
+    content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, prefix: str = "libusb") -> None:
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Counters of every thread, by (device, endpoint).
+        self._shards: list[dict[tuple[Device, int], list[int]]] = []
+
+    def counters(self) -> dict[tuple[Device, int], dict[str, int]]:
+        """Return the counters by (device, endpoint) and name ('bytes',
+        'resubmits' and the lowercase names of the transfer statuses)."""
+        with self._lock:
+            shards = [list(shard.items()) for shard in self._shards]
+        totals: dict[tuple[Device, int], list[int]] = {}
+        for shard in shards:
+            for key, counters in shard:
+                total = totals.setdefault(key, [0] * _NUM_COUNTERS)
+                for index, value in enumerate(counters):
+                    total[index] += value
+        result = {}
+        for key in sorted(totals, key=lambda key: (key[0] or (-1, -1), key[1])):
+            total = totals[key]
+            counts = {name.lower(): total[status]
+                      for status, name in _transfer_status_names.items()}
+            counts["bytes"]     = total[_BYTES]
+            counts["resubmits"] = total[_RESUBMITS]
+            result[key] = counts
+        return result
+
+    def reset(self) -> None:
+        """Zero all counters."""
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+
+    def render(self) -> str:
+        """Return the metrics in the OpenMetrics text format."""
+        prefix = self.prefix
+        counters = self.counters()
+        families = (
+            ("transfers", "Transfers completed, by status.",
+             lambda counts: [(name, counts[name.lower()])
+                             for name in _transfer_status_names.values()]),
+            ("transfer_bytes", "Bytes transferred.",
+             lambda counts: [(None, counts["bytes"])]),
+            ("transfer_errors", "Transfers failed, by status.",
+             lambda counts: [(_transfer_status_names[status],
+                              counts[_transfer_status_names[status].lower()])
+                             for status in sorted(_errors)]),
+            ("transfer_cancellations", "Transfers cancelled.",
+             lambda counts: [(None, counts["cancelled"])]),
+            ("transfer_timeouts", "Transfers timed out.",
+             lambda counts: [(None, counts["timed_out"])]),
+            ("transfer_resubmits", "Transfers resubmitted by their callback.",
+             lambda counts: [(None, counts["resubmits"])]),
+        )
+        lines = []
+        for name, description, samples in families:
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            for (device, endpoint), counts in counters.items():
+                device_label = "" if device is None else f"{device[0]:03d}-{device[1]:03d}"
+                labels = f'device="{device_label}",endpoint="0x{endpoint:02x}"'
+                for status, value in samples(counts):
+                    status_label = "" if status is None else f',status="{status.lower()}"'
+                    lines.append(f"{prefix}_{name}_total{{{labels}{status_label}}} {value}")
+        lines.append("# EOF\n")
+        return "\n".join(lines)
+
+    def write(self, file: str | PathLike[str] | TextIO) -> None:
+        """Write the metrics to file (a path or a text file). A path is
+        replaced atomically, so readers never see a partial file."""
+        text = self.render()
+        if isinstance(file, (str, PathLike)):
+            temp_file = f"{os.fspath(file)}.{os.getpid()}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as stream:
+                stream.write(text)
+            os.replace(temp_file, file)
+        else:
+            file.write(text)
+
+    def handler_class(self) -> type[BaseHTTPRequestHandler]:
+        """Return an http.server request handler class serving the metrics
+        on GET /metrics."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", metrics.content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        return MetricsHandler
+
+    def serve(self, port: int = 0, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve the metrics over HTTP on host:port (an unused port if 0)
+        from a daemon thread and return the server (to be shut down with
+        its shutdown() and server_close())."""
+        server = ThreadingHTTPServer((host, port), self.handler_class())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="TransferMetrics server",
+                         daemon=True).start()
+        return server
+
+    def _completed(self, key: tuple[Device, int, int], status: int,
+                   length: int, actual_length: int,
+                   submitted: int, completed: int, returned: int,
+                   resubmitted: bool) -> None:
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        device, endpoint, _ = key
+        counters = shard.get((device, endpoint))
+        if counters is None:
+            counters = shard[(device, endpoint)] = [0] * _NUM_COUNTERS
+        if 0 <= status < _NUM_STATUSES:
+            counters[status] += 1
+        counters[_BYTES] += actual_length
+        if resubmitted:
+            counters[_RESUBMITS] += 1
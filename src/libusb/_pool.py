@@ -0,0 +1,170 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('TransferPool',)
+
+from typing_extensions import Self
+import threading
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from ._error import USBError
+
+
+class TransferPool:
+    """Pool of pre-allocated libusb.transfer structures with attached buffers.
+
+    acquire() hands out an idle transfer allocated earlier for the same
+    number of isochronous packets (or allocates a new one) and release()
+    resets it and keeps it for reuse, so that repeated operations do not
+    pay for libusb.alloc_transfer()/libusb.free_transfer() each time.
+    At most max_idle transfers per number of isochronous packets are kept,
+    the surplus is freed.
+
+    Every transfer handed out has a buffer of buffer_size bytes owned by
+    the pool in its buffer/length fields (no buffer if buffer_size is 0).
+
+    A transfer submitted with the LIBUSB_TRANSFER_FREE_TRANSFER flag is
+    freed by libusb right after its callback returns, so it must be
+    released from within that callback (the pool then just forgets it);
+    the LIBUSB_TRANSFER_FREE_BUFFER flag is cleared on release if the
+    buffer belongs to the pool.
+    """
+
+    def __init__(self, buffer_size: int = 0, max_idle: int = 16) -> None:
+        if buffer_size < 0:
+            raise ValueError("buffer_size must not be negative")
+        if max_idle < 0:
+            raise ValueError("max_idle must not be negative")
+        self.buffer_size = buffer_size
+        self.max_idle    = max_idle
+        #: Number of acquire() calls served from the pool/by allocation.
+        self.hits   = 0
+        self.misses = 0
+        #: Number of transfers currently handed out and its maximum so far.
+        self.in_use     = 0
+        self.high_water = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._idle: dict[int, list[ctx.POINTER[usb.transfer]]] = {}
+        # Number of isochronous packets and buffer of the transfers owned by
+        # the pool and the transfers handed out, by transfer address.
+        self._owned: dict[int, tuple[int, ct.Array[ct.c_ubyte] | None]] = {}
+        self._lent:  set[int] = set()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    @property
+    def num_idle(self) -> int:
+        """Number of transfers kept in the pool for reuse."""
+        return sum(len(idle) for idle in self._idle.values())
+
+    def acquire(self, num_iso_packets: int = 0) -> ctx.POINTER[usb.transfer]:
+        """Get a transfer with num_iso_packets isochronous packet descriptors.
+
+        The transfer has all its fields zeroed except of num_iso_packets
+        and the buffer/length of the pool's buffer.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("acquire from a closed pool")
+            idle = self._idle.get(num_iso_packets)
+            if idle:
+                transfer = idle.pop()
+                self.hits += 1
+            else:
+                transfer = None
+                self.misses += 1
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+        if transfer is None:
+            try:
+                transfer = self._alloc(num_iso_packets)
+            except BaseException:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+        with self._lock:
+            self._lent.add(ct.addressof(transfer.contents))
+        return transfer
+
+    def release(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        """Return a transfer got from acquire() to the pool.
+
+        The transfer must not be submitted anymore (i.e. it has been
+        called back or was never submitted).
+        """
+        transf = transfer[0]
+        address = ct.addressof(transf)
+        with self._lock:
+            if address not in self._lent:
+                raise ValueError("transfer was not acquired from the pool")
+            self._lent.remove(address)
+            self.in_use -= 1
+            num_iso_packets, buffer = self._owned[address]
+            if (buffer is not None and
+                ct.addressof(buffer) == ct.cast(transf.buffer, ct.c_void_p).value):
+                transf.flags &= ~usb.LIBUSB_TRANSFER_FREE_BUFFER
+            if transf.flags & usb.LIBUSB_TRANSFER_FREE_TRANSFER:
+                # Will be freed by libusb once the callback returns.
+                del self._owned[address]
+                return
+            idle = self._idle.setdefault(num_iso_packets, [])
+            keep = not self._closed and len(idle) < self.max_idle
+            if keep:
+                self._reset(transf, num_iso_packets, buffer)
+                idle.append(transfer)
+            else:
+                del self._owned[address]
+        if not keep:
+            usb.free_transfer(transfer)
+
+    def clear(self) -> None:
+        """Free all idle transfers."""
+        self._clear()
+
+    def close(self) -> None:
+        """Free all idle transfers; transfers still in use are freed when
+        released."""
+        self._clear(close=True)
+
+    def _clear(self, close: bool = False) -> None:
+        with self._lock:
+            # Closed along with taking the idle transfers, so that no
+            # acquire() can hand out one of them any more.
+            if close: self._closed = True
+            idle = [transfer for transfers in self._idle.values()
+                    for transfer in transfers]
+            self._idle.clear()
+            for transfer in idle:
+                del self._owned[ct.addressof(transfer.contents)]
+        for transfer in idle:
+            usb.free_transfer(transfer)
+
+    def _alloc(self, num_iso_packets: int) -> ctx.POINTER[usb.transfer]:
+        transfer: ctx.POINTER[usb.transfer] = usb.alloc_transfer(num_iso_packets)
+        if not transfer:
+            raise USBError(usb.LIBUSB_ERROR_NO_MEM)
+        buffer = (ct.c_ubyte * self.buffer_size)() if self.buffer_size else None
+        self._reset(transfer[0], num_iso_packets, buffer)
+        with self._lock:
+            self._owned[ct.addressof(transfer.contents)] = (num_iso_packets, buffer)
+        return transfer
+
+    @staticmethod
+    def _reset(transf: usb.transfer, num_iso_packets: int,
+               buffer: ct.Array[ct.c_ubyte] | None) -> None:
+        ct.memset(ct.addressof(transf), 0, usb._iso_packet_desc_offset
+                  + num_iso_packets * ct.sizeof(usb.iso_packet_descriptor))
+        transf.num_iso_packets = num_iso_packets
+        if buffer is not None:
+            transf.buffer = ct.cast(buffer, ct.POINTER(ct.c_ubyte))
+            transf.length = len(buffer)
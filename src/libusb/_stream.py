@@ -0,0 +1,1159 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('BulkReader', 'BulkWriter', 'IsoStream', 'IsoGap', 'StreamMux',
+           'ControlPipeline', 'ControlRequest', 'InterruptPoller')
+
+from typing import Any, NamedTuple
+from typing_extensions import Self, Buffer
+from collections.abc import Iterator, Iterable, Sequence, Callable
+from collections import deque
+import time
+import abc
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+from ._platform import timeval
+from ._error import USBError, TransferError
+
+
+def _ubyte_buffer(view: memoryview, start: int = 0,
+                  stop: int | None = None) -> ct.Array[ct.c_ubyte] | ctx.POINTER[ct.c_ubyte]:
+    # Returns view[start:stop] of a byte-formatted memoryview as a
+    # libusb.transfer buffer (keeping its memory alive), without copying if
+    # possible: a writable buffer is shared and so is a read-only one if
+    # view is the whole content of a bytes object (the buffer then points
+    # into it). Other read-only buffers are copied.
+    piece = view[start:stop]
+    try:
+        return (ct.c_ubyte * len(piece)).from_buffer(piece)
+    except TypeError:  # read-only buffer
+        data = view.obj
+        if not isinstance(data, bytes) or len(data) != len(view):
+            data, start = piece.tobytes(), 0
+        buffer = ct.cast(ct.c_char_p(data), ct.POINTER(ct.c_ubyte))
+        return ctx.c_ptr_add(buffer, start) if start else buffer
+
+
+class _TransferQueue(abc.ABC):
+    """Base of the engines keeping a queue of transfers in flight on one
+    endpoint.
+
+    Owns the transfers and their buffers, keeps track of which of them are
+    submitted and takes care of cancelling and reaping them on close().
+    Transfers are identified in the completion callback by their slot
+    number, which is passed to libusb as the transfer's user_data.
+    """
+
+    _transfers: list[ctx.POINTER[usb.transfer]]
+    _buffers:   list[ct.Array[ct.c_ubyte]]
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 transfer_size: int, num_transfers: int, timeout: int = 0,
+                 ctx: ctx.POINTER[usb.context] | None = None,
+                 num_iso_packets: int = 0) -> None:
+        if transfer_size <= 0:
+            raise ValueError("transfer_size must be positive")
+        if num_transfers <= 0:
+            raise ValueError("num_transfers must be positive")
+        self.dev_handle    = dev_handle
+        self.endpoint      = endpoint
+        self.transfer_size = transfer_size
+        self.num_transfers = num_transfers
+        self.timeout       = timeout
+        self.ctx           = ctx
+        #: Number of bytes and transfers completed so far.
+        self.num_bytes = 0
+        self.num_xfers = 0
+        self._running  = False
+        self._closed   = False
+        self._error: Exception | None = None
+        self._in_flight = 0
+        self._pending   = [False] * num_transfers
+        self._transfers = []
+        self._buffers   = []
+        # Must be kept alive for as long as any transfer may call back.
+        self._callback = usb.transfer_cb_fn(self._transfer_cb)
+        try:
+            for slot in range(num_transfers):
+                transfer = usb.alloc_transfer(num_iso_packets)
+                if not transfer:
+                    raise USBError(usb.LIBUSB_ERROR_NO_MEM)
+                self._transfers.append(transfer)
+                self._buffers.append((ct.c_ubyte * transfer_size)())
+                self._fill(slot)
+        except BaseException:
+            self._free()
+            raise
+
+    def __enter__(self) -> Self:
+        if not self._running and not self._closed:
+            self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of transfers currently submitted."""
+        return self._in_flight
+
+    @abc.abstractmethod
+    def start(self) -> None:
+        """Submit the transfers."""
+
+    def stop(self) -> None:
+        """Cancel all submitted transfers and wait until all of them have
+        been called back."""
+        self._running = False
+        self._cancel_all()
+        while self._in_flight:
+            self._handle_events(0.1)
+
+    def close(self) -> None:
+        """Stop the engine and release its transfers."""
+        if self._closed: return
+        self.stop()
+        self._closed = True
+        self._free()
+
+    @abc.abstractmethod
+    def _fill(self, slot: int) -> None:
+        """Populate the transfer of the slot."""
+
+    @abc.abstractmethod
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        """Called back by libusb on completion of a transfer."""
+
+    def _submit(self, slot: int) -> bool:
+        rc = _transport.submit_transfer(self._transfers[slot])
+        if rc < 0:
+            self._fail(USBError(rc))
+            return False
+        self._pending[slot] = True
+        self._in_flight += 1
+        return True
+
+    def _completed(self, transfer: usb.transfer) -> int:
+        # Marks the transfer as not submitted anymore and returns its slot.
+        slot = transfer.user_data or 0
+        self._pending[slot] = False
+        self._in_flight -= 1
+        return slot
+
+    def _cancel_all(self) -> None:
+        for slot, pending in enumerate(self._pending):
+            if pending:
+                _transport.cancel_transfer(self._transfers[slot])
+
+    def _fail(self, exc: Exception) -> None:
+        if self._error is None:
+            self._error = exc
+        self._running = False
+        self._cancel_all()
+
+    def _raise_error(self) -> None:
+        exc, self._error = self._error, None
+        if exc is not None:
+            raise exc
+
+    def _wait_events(self, deadline: float | None, what: str) -> None:
+        # Handles events for at most a second, but not past the deadline.
+        if deadline is None:
+            self._handle_events(1.0)
+        else:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"timed out waiting for {what}")
+            self._handle_events(min(remaining, 1.0))
+
+    def _handle_events(self, timeout: float) -> None:
+        tv = timeval(int(timeout), int((timeout % 1) * 1_000_000))
+        rc = _transport.handle_events_timeout_completed(self.ctx, tv, None)
+        if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+            raise USBError(rc)
+
+    def _free(self) -> None:
+        for transfer in self._transfers:
+            usb.free_transfer(transfer)
+        self._transfers.clear()
+        self._buffers.clear()
+
+
+class BulkReader(_TransferQueue):
+    """Streaming reader of a bulk IN endpoint.
+
+    Keeps num_transfers bulk transfers of transfer_size bytes in flight on
+    the endpoint and resubmits each of them as soon as it completes, so the
+    host controller always has a transfer scheduled. The received data is
+    queued and handed to the consumer by read() or by iterating over the
+    reader:
+
+        with BulkReader(dev_handle, 0x82, 16384, 8) as reader:
+            for data in reader:
+                ...
+
+    read() handles libusb events by itself (it is safe to have another
+    thread handling them at the same time).
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 transfer_size: int = 16384, num_transfers: int = 8, timeout: int = 0,
+                 ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        if not endpoint & usb.LIBUSB_ENDPOINT_IN:
+            raise ValueError(f"0x{endpoint:02x} is not an IN endpoint")
+        self._queue: deque[bytes] = deque()
+        super().__init__(dev_handle, endpoint, transfer_size, num_transfers, timeout, ctx)
+
+    def start(self) -> None:
+        """Submit all transfers."""
+        if self._closed:
+            raise ValueError("reader is closed")
+        self._running = True
+        for slot, pending in enumerate(self._pending):
+            if not pending and not self._submit(slot):
+                self.stop()
+                self._raise_error()
+
+    def read(self, timeout: float | None = None) -> bytes:
+        """Return the data of the next completed transfer.
+
+        Raises TimeoutError if no data has been received within timeout
+        seconds, EOFError if the reader has been stopped and all received
+        data have been read, and the error which stopped the reader, if any.
+        """
+        queue = self._queue
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not queue:
+            if self._error is not None:
+                self._raise_error()
+            if not self._in_flight:
+                raise EOFError("reader is stopped")
+            self._wait_events(deadline, "data")
+        return queue.popleft()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            try:
+                yield self.read()
+            except EOFError:
+                return
+
+    def _fill(self, slot: int) -> None:
+        usb.fill_bulk_transfer(self._transfers[slot], self.dev_handle, self.endpoint,
+                               self._buffers[slot], self.transfer_size,
+                               self._callback, slot, self.timeout)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        if status == usb.LIBUSB_TRANSFER_COMPLETED or status == usb.LIBUSB_TRANSFER_TIMED_OUT:
+            # A timed out transfer may still have received some data.
+            length = transf.actual_length
+            if length or status == usb.LIBUSB_TRANSFER_COMPLETED:
+                self._queue.append(ct.string_at(transf.buffer, length))
+                self.num_bytes += length
+                self.num_xfers += 1
+            if self._running:
+                self._submit(slot)
+        elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+            self._fail(TransferError.for_status(status))
+
+
+class BulkWriter(_TransferQueue):
+    """Streaming writer of a bulk OUT endpoint.
+
+    Data passed to write() is copied into free transfers of transfer_size
+    bytes, which are submitted right away, so up to num_transfers of them
+    are queued on the endpoint at once. write() blocks (handling libusb
+    events) only while all the transfers are busy. With copy=False the
+    data is not copied but submitted in place as a single transfer, in
+    which case it must stay unmodified until the transfer completes
+    (e.g. until flush()).
+
+        with BulkWriter(dev_handle, 0x02, 16384, 4) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+    Leaving the with block (or close()) flushes all queued data, unless
+    the block is left by an exception or the writer has failed, in which
+    case the queued data are cancelled. A BulkWriter is meant to be fed by
+    a single producer thread.
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 transfer_size: int = 16384, num_transfers: int = 4, timeout: int = 0,
+                 ctx: ctx.POINTER[usb.context] | None = None, flags: int = 0) -> None:
+        if endpoint & usb.LIBUSB_ENDPOINT_IN:
+            raise ValueError(f"0x{endpoint:02x} is not an OUT endpoint")
+        self.flags = flags
+        self._free_slots: deque[int] = deque(range(num_transfers))
+        self._adopted: list[object] = [None] * num_transfers
+        super().__init__(dev_handle, endpoint, transfer_size, num_transfers, timeout, ctx)
+        self._views = [memoryview(buffer).cast("B") for buffer in self._buffers]
+
+    def start(self) -> None:
+        """Enable writing."""
+        if self._closed:
+            raise ValueError("writer is closed")
+        self._running = True
+
+    def write(self, data: Buffer, timeout: float | None = None, copy: bool = True) -> int:
+        """Queue data for sending and return its length.
+
+        Raises TimeoutError if no transfer got free within timeout seconds
+        and the error which stopped the writer, if any.
+        """
+        if not self._running:
+            self._raise_error()
+            raise ValueError("writer is not started")
+        view = memoryview(data).cast("B")
+        length = len(view)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not copy:
+            slot = self._acquire(deadline)
+            transf = self._transfers[slot][0]
+            buffer = _ubyte_buffer(view)
+            self._adopted[slot] = buffer
+            transf.buffer = buffer
+            transf.length = length
+            self._submit_or_release(slot)
+            return length
+        size = self.transfer_size
+        for offset in range(0, length, size):
+            chunk = view[offset:offset + size]
+            slot  = self._acquire(deadline)
+            self._views[slot][:len(chunk)] = chunk
+            self._transfers[slot][0].length = len(chunk)
+            self._submit_or_release(slot)
+        return length
+
+    def flush(self, timeout: float | None = None) -> None:
+        """Wait until all queued data have been sent.
+
+        Raises TimeoutError if that did not happen within timeout seconds
+        and the error which stopped the writer, if any.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._in_flight:
+            self._wait_events(deadline, "queued data to be sent")
+        self._raise_error()
+
+    def __exit__(self, *exc_info: object) -> None:
+        if exc_info[0] is not None:
+            self._running = False  # do not flush
+        self.close()
+
+    def close(self, timeout: float | None = None) -> None:
+        """Flush queued data, stop the writer and release its transfers.
+
+        Raises TimeoutError if the queued data have not been sent within
+        timeout seconds (they are cancelled then).
+        """
+        if self._closed: return
+        try:
+            if self._running and self._error is None:
+                self.flush(timeout)
+        finally:
+            super().close()
+
+    def _acquire(self, deadline: float | None) -> int:
+        # Returns the slot of a free transfer.
+        free_slots = self._free_slots
+        while not free_slots and self._error is None:
+            self._wait_events(deadline, "a free transfer")
+        if self._error is not None:
+            self._raise_error()
+        return free_slots.popleft()
+
+    def _submit_or_release(self, slot: int) -> None:
+        if not self._submit(slot):
+            self._release(slot)
+            self._raise_error()
+
+    def _release(self, slot: int) -> None:
+        if self._adopted[slot] is not None:
+            self._adopted[slot] = None
+            self._transfers[slot][0].buffer = self._buffers[slot]
+        self._free_slots.append(slot)
+
+    def _fill(self, slot: int) -> None:
+        usb.fill_bulk_transfer(self._transfers[slot], self.dev_handle, self.endpoint,
+                               self._buffers[slot], 0,
+                               self._callback, slot, self.timeout)
+        self._transfers[slot][0].flags = self.flags
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            self.num_bytes += transf.actual_length
+            self.num_xfers += 1
+        elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+            self._fail(TransferError.for_status(status))
+        self._release(slot)
+
+
+class IsoGap(NamedTuple):
+    """Packet of an IsoStream whose payload is missing or incomplete."""
+
+    #: time.monotonic() of the completion of the packet's transfer.
+    time: float
+    #: Sequence number of the packet in the stream (counted from 0).
+    packet: int
+    #: Position of the gap in the stream of data (in bytes).
+    position: int
+    #: Status of the packet.
+    status: int
+    #: Length requested and actually received.
+    length: int
+    actual_length: int
+    #: True if the payload was dropped because the ring buffer was full.
+    overrun: bool = False
+
+
+class IsoStream(_TransferQueue):
+    """Streaming reader of an isochronous IN endpoint.
+
+    Keeps num_transfers isochronous transfers of packets_per_transfer
+    packets of packet_size bytes in flight on the endpoint and resubmits
+    each of them as soon as it completes. The payloads of the packets are
+    copied in order into a ring buffer of buffer_size bytes, from which
+    they are read by read()/readinto() as one contiguous stream.
+
+    Packets which failed (their status is not LIBUSB_TRANSFER_COMPLETED),
+    came back short or did not fit into the ring buffer (the consumer is
+    too slow) are recorded as IsoGap's, the last max_gaps of which are
+    returned by pop_gaps(); num_gaps counts all of them. Such conditions
+    do not stop the stream, only a failure of a whole transfer does.
+
+        with IsoStream(dev_handle, 0x86, 1024) as stream:
+            while True:
+                data = stream.read()
+                for gap in stream.pop_gaps():
+                    ...
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 packet_size: int, packets_per_transfer: int = 32, num_transfers: int = 8,
+                 buffer_size: int = 1024 * 1024, timeout: int = 0,
+                 ctx: ctx.POINTER[usb.context] | None = None,
+                 max_gaps: int = 1024) -> None:
+        if not endpoint & usb.LIBUSB_ENDPOINT_IN:
+            raise ValueError(f"0x{endpoint:02x} is not an IN endpoint")
+        if packet_size <= 0:
+            raise ValueError("packet_size must be positive")
+        if packets_per_transfer <= 0:
+            raise ValueError("packets_per_transfer must be positive")
+        if buffer_size <= 0:
+            raise ValueError("buffer_size must be positive")
+        self.packet_size = packet_size
+        self.packets_per_transfer = packets_per_transfer
+        #: Number of packets completed and of gaps recorded so far.
+        self.num_packets = 0
+        self.num_gaps    = 0
+        self._ring = memoryview(bytearray(buffer_size))
+        # Number of bytes put into and taken from the ring buffer so far.
+        self._ring_in  = 0
+        self._ring_out = 0
+        self._gaps: deque[IsoGap] = deque(maxlen=max_gaps)
+        super().__init__(dev_handle, endpoint, packet_size * packets_per_transfer,
+                         num_transfers, timeout, ctx, packets_per_transfer)
+
+    @property
+    def available(self) -> int:
+        """Number of bytes available to read."""
+        return self._ring_in - self._ring_out
+
+    def start(self) -> None:
+        """Submit all transfers."""
+        if self._closed:
+            raise ValueError("stream is closed")
+        self._running = True
+        for slot, pending in enumerate(self._pending):
+            if not pending and not self._submit(slot):
+                self.stop()
+                self._raise_error()
+
+    def read(self, size: int = -1, timeout: float | None = None) -> bytes:
+        """Return up to size bytes (all available if size < 0) of the stream,
+        waiting for at least one.
+
+        Raises TimeoutError if no data has been received within timeout
+        seconds, EOFError if the stream has been stopped and all received
+        data have been read, and the error which stopped the stream, if any.
+        """
+        self._wait_data(timeout)
+        available = self.available
+        buffer = bytearray(available if size < 0 else min(size, available))
+        self._take(memoryview(buffer))
+        return bytes(buffer)
+
+    def readinto(self, buffer: Buffer, timeout: float | None = None) -> int:
+        """Like read(), but into buffer; returns the number of bytes read."""
+        view = memoryview(buffer).cast("B")
+        if not len(view): return 0
+        self._wait_data(timeout)
+        return self._take(view)
+
+    def pop_gaps(self) -> list[IsoGap]:
+        """Return (and forget) the gaps recorded so far."""
+        gaps = []
+        while self._gaps:
+            gaps.append(self._gaps.popleft())
+        return gaps
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            try:
+                yield self.read()
+            except EOFError:
+                return
+
+    def _wait_data(self, timeout: float | None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._ring_in == self._ring_out:
+            if self._error is not None:
+                self._raise_error()
+            if not self._in_flight:
+                raise EOFError("stream is stopped")
+            self._wait_events(deadline, "data")
+
+    def _take(self, view: memoryview) -> int:
+        # Moves data from the ring buffer to view (in at most two pieces).
+        ring, size = self._ring, len(self._ring)
+        length = min(len(view), self._ring_in - self._ring_out)
+        start = self._ring_out % size
+        first = min(length, size - start)
+        view[:first] = ring[start:start + first]
+        view[first:length] = ring[:length - first]
+        self._ring_out += length
+        return length
+
+    def _put(self, data: memoryview) -> bool:
+        # Appends data to the ring buffer if there is room for it.
+        ring, size = self._ring, len(self._ring)
+        length = len(data)
+        if self._ring_in + length - self._ring_out > size:
+            return False
+        start = self._ring_in % size
+        first = min(length, size - start)
+        ring[start:start + first] = data[:first]
+        ring[:length - first] = data[first:]
+        self._ring_in += length
+        return True
+
+    def _fill(self, slot: int) -> None:
+        transfer = self._transfers[slot]
+        usb.fill_iso_transfer(transfer, self.dev_handle, self.endpoint,
+                              self._buffers[slot], self.transfer_size,
+                              self.packets_per_transfer,
+                              self._callback, slot, self.timeout)
+        usb.set_iso_packet_lengths(transfer, self.packet_size)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            now = time.monotonic()
+            for packet in usb.get_iso_packets(transfer):
+                packet_no = self.num_packets
+                self.num_packets += 1
+                position = self._ring_in
+                data = packet.data
+                overrun = not self._put(data)
+                if not overrun:
+                    self.num_bytes += len(data)
+                if (overrun or packet.status != usb.LIBUSB_TRANSFER_COMPLETED
+                    or packet.actual_length < packet.length):
+                    self.num_gaps += 1
+                    self._gaps.append(IsoGap(now, packet_no, position, packet.status,
+                                             packet.length, packet.actual_length,
+                                             overrun))
+            self.num_xfers += 1
+            if self._running:
+                self._submit(slot)
+        elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+            self._fail(TransferError.for_status(status))
+
+
+class StreamMux(_TransferQueue):
+    """Multiplexer of USB 3 bulk streams.
+
+    Allocates num_streams stream IDs (1..num_streams; the device may grant
+    fewer, see the num_streams attribute) on each of the bulk endpoints
+    with libusb.alloc_streams() and keeps transfers_per_stream transfers
+    of transfer_size bytes per stream of each endpoint:
+
+    - on IN endpoints all of them are kept in flight; the data received on
+      a stream is passed to the consumer set for it with set_consumer()
+      (called as consumer(endpoint, stream_id, data) while handling libusb
+      events) or, if there is none, queued for read(endpoint, stream_id),
+    - on OUT endpoints they are used by write(endpoint, stream_id, data),
+      which blocks only while all the transfers of that stream are busy.
+
+    close() (or leaving the with block) flushes the queued OUT data,
+    cancels the IN transfers and frees the streams.
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle],
+                 endpoints: Sequence[int], num_streams: int,
+                 transfer_size: int = 16384, transfers_per_stream: int = 2,
+                 timeout: int = 0, ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        if not endpoints:
+            raise ValueError("no endpoints given")
+        if num_streams <= 0:
+            raise ValueError("num_streams must be positive")
+        if transfers_per_stream <= 0:
+            raise ValueError("transfers_per_stream must be positive")
+        self.endpoints = tuple(endpoints)
+        self._endpoints_array = (ct.c_ubyte * len(self.endpoints))(*self.endpoints)
+        rc = usb.alloc_streams(dev_handle, num_streams,
+                               self._endpoints_array, len(self.endpoints))
+        if rc < 0:
+            raise USBError(rc)
+        #: Number of streams allocated on each of the endpoints.
+        self.num_streams = num_streams = rc
+        self.transfers_per_stream = transfers_per_stream
+        # (endpoint, stream_id) of every slot.
+        self._keys = [(endpoint, stream_id)
+                      for endpoint in self.endpoints
+                      for stream_id in range(1, num_streams + 1)
+                      for _ in range(transfers_per_stream)]
+        self._consumers: dict[tuple[int, int], Callable[[int, int, bytes], object]] = {}
+        self._queues:     dict[tuple[int, int], deque[bytes]] = {}
+        self._free_slots: dict[tuple[int, int], deque[int]] = {}
+        for slot, key in enumerate(self._keys):
+            if key[0] & usb.LIBUSB_ENDPOINT_IN:
+                self._queues.setdefault(key, deque())
+            else:
+                self._free_slots.setdefault(key, deque()).append(slot)
+        self._out_in_flight = 0
+        try:
+            super().__init__(dev_handle, self.endpoints[0], transfer_size,
+                             len(self._keys), timeout, ctx)
+        except BaseException:
+            usb.free_streams(dev_handle, self._endpoints_array, len(self.endpoints))
+            raise
+        self._views = [memoryview(buffer).cast("B") for buffer in self._buffers]
+
+    def start(self) -> None:
+        """Submit the transfers of the IN endpoints and enable writing."""
+        if self._closed:
+            raise ValueError("multiplexer is closed")
+        self._running = True
+        for slot, pending in enumerate(self._pending):
+            if (not pending and self._keys[slot][0] & usb.LIBUSB_ENDPOINT_IN
+                and not self._submit(slot)):
+                self.stop()
+                self._raise_error()
+
+    def set_consumer(self, endpoint: int, stream_id: int,
+                     consumer: Callable[[int, int, bytes], object] | None) -> None:
+        """Set (or with None: remove) the consumer of the data received on
+        a stream of an IN endpoint."""
+        key = self._check_key(endpoint, stream_id, usb.LIBUSB_ENDPOINT_IN)
+        if consumer is None:
+            self._consumers.pop(key, None)
+        else:
+            self._consumers[key] = consumer
+
+    def read(self, endpoint: int, stream_id: int, timeout: float | None = None) -> bytes:
+        """Return the data of the next completed transfer of a stream of an
+        IN endpoint (which has no consumer set).
+
+        Raises TimeoutError if no data has been received within timeout
+        seconds, EOFError if the multiplexer has been stopped and all
+        received data have been read, and the error which stopped the
+        multiplexer, if any.
+        """
+        queue = self._queues[self._check_key(endpoint, stream_id, usb.LIBUSB_ENDPOINT_IN)]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not queue:
+            if self._error is not None:
+                self._raise_error()
+            if not self._in_flight:
+                raise EOFError("multiplexer is stopped")
+            self._wait_events(deadline, "data")
+        return queue.popleft()
+
+    def write(self, endpoint: int, stream_id: int, data: Buffer,
+              timeout: float | None = None) -> int:
+        """Queue data for sending on a stream of an OUT endpoint and return
+        its length.
+
+        Raises TimeoutError if no transfer of the stream got free within
+        timeout seconds and the error which stopped the multiplexer, if any.
+        """
+        free_slots = self._free_slots[self._check_key(endpoint, stream_id,
+                                                      usb.LIBUSB_ENDPOINT_OUT)]
+        if not self._running:
+            self._raise_error()
+            raise ValueError("multiplexer is not started")
+        view = memoryview(data).cast("B")
+        length = len(view)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        size = self.transfer_size
+        for offset in range(0, length, size):
+            chunk = view[offset:offset + size]
+            while not free_slots and self._error is None:
+                self._wait_events(deadline, "a free transfer")
+            self._raise_error()
+            slot = free_slots.popleft()
+            self._views[slot][:len(chunk)] = chunk
+            self._transfers[slot][0].length = len(chunk)
+            if not self._submit(slot):
+                free_slots.append(slot)
+                self._raise_error()
+            self._out_in_flight += 1
+        return length
+
+    def flush(self, timeout: float | None = None) -> None:
+        """Wait until all queued OUT data have been sent.
+
+        Raises TimeoutError if that did not happen within timeout seconds
+        and the error which stopped the multiplexer, if any.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._out_in_flight:
+            self._wait_events(deadline, "queued data to be sent")
+        self._raise_error()
+
+    def close(self) -> None:
+        """Flush queued OUT data, stop the multiplexer, release its transfers
+        and free the streams."""
+        if self._closed: return
+        try:
+            if self._running and self._error is None:
+                self.flush()
+        finally:
+            super().close()
+            usb.free_streams(self.dev_handle, self._endpoints_array, len(self.endpoints))
+
+    def _check_key(self, endpoint: int, stream_id: int, direction: int) -> tuple[int, int]:
+        if endpoint not in self.endpoints:
+            raise ValueError(f"0x{endpoint:02x} is not an endpoint of the multiplexer")
+        if endpoint & usb.LIBUSB_ENDPOINT_IN != direction:
+            raise ValueError(f"0x{endpoint:02x} is not an "
+                             f"{'IN' if direction else 'OUT'} endpoint")
+        if not 1 <= stream_id <= self.num_streams:
+            raise ValueError(f"invalid stream id: {stream_id}")
+        return (endpoint, stream_id)
+
+    def _fill(self, slot: int) -> None:
+        endpoint, stream_id = self._keys[slot]
+        length = self.transfer_size if endpoint & usb.LIBUSB_ENDPOINT_IN else 0
+        usb.fill_bulk_stream_transfer(self._transfers[slot], self.dev_handle,
+                                      endpoint, stream_id, self._buffers[slot], length,
+                                      self._callback, slot, self.timeout)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        key    = self._keys[slot]
+        if key[0] & usb.LIBUSB_ENDPOINT_IN:
+            if status == usb.LIBUSB_TRANSFER_COMPLETED or status == usb.LIBUSB_TRANSFER_TIMED_OUT:
+                length = transf.actual_length
+                if length or status == usb.LIBUSB_TRANSFER_COMPLETED:
+                    self.num_bytes += length
+                    self.num_xfers += 1
+                    data = ct.string_at(transf.buffer, length)
+                    consumer = self._consumers.get(key)
+                    if consumer is None:
+                        self._queues[key].append(data)
+                    else:
+                        try:
+                            consumer(key[0], key[1], data)
+                        except Exception as exc:
+                            self._fail(exc)
+                if self._running:
+                    self._submit(slot)
+            elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+                self._fail(TransferError.for_status(status))
+        else:
+            self._out_in_flight -= 1
+            if status == usb.LIBUSB_TRANSFER_COMPLETED:
+                self.num_bytes += transf.actual_length
+                self.num_xfers += 1
+            elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+                self._fail(TransferError.for_status(status))
+            self._free_slots[key].append(slot)
+
+
+class ControlRequest:
+    """A control request queued on a ControlPipeline."""
+
+    __slots__ = ('bmRequestType', 'bRequest', 'wValue', 'wIndex', 'data',
+                 'done', '_result', '_error')
+
+    def __init__(self, bmRequestType: int, bRequest: int, wValue: int, wIndex: int,
+                 data: memoryview | int) -> None:
+        self.bmRequestType = bmRequestType
+        self.bRequest = bRequest
+        self.wValue   = wValue
+        self.wIndex   = wIndex
+        #: Data to send or number of bytes to read.
+        self.data = data
+        #: True when the request has been processed.
+        self.done = False
+        self._result: bytes | int | None = None
+        self._error:  Exception | None = None
+
+    def result(self) -> bytes | int:
+        """Data read (for device-to-host requests) or number of bytes sent.
+
+        Raises the error of the request, if any.
+        """
+        if not self.done:
+            raise ValueError("request is not done")
+        if self._error is not None:
+            raise self._error
+        return self._result  # type: ignore[return-value]
+
+    def _finish(self, result: bytes | int | None, error: Exception | None = None) -> None:
+        self._result = result
+        self._error  = error
+        self.done    = True
+
+
+class ControlPipeline(_TransferQueue):
+    """Pipeline of asynchronous control requests to a device.
+
+    Requests queued with request() are sent as control transfers on the
+    default control endpoint, up to depth of them being submitted at once
+    (use depth=1 for devices which cannot take queued control requests).
+    The setup packets are packed with libusb.pack_control_setup() into
+    preallocated transfers with room for max_length data bytes.
+    flush() (or run()) processes them and returns their results in order:
+
+        with ControlPipeline(dev_handle, depth=8) as pipeline:
+            results = pipeline.run([(0xC0, 0x01, 0, index, 64)
+                                    for index in range(100)])
+
+    A failed request (e.g. a stalled, i.e. unsupported one) does not stop
+    the pipeline; its error is raised by its result() (and by flush()).
+    """
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], depth: int = 4,
+                 max_length: int = 256, timeout: int = 1000,
+                 ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        if max_length < 0 or max_length > 0xFFFF:
+            raise ValueError("max_length must be in range 0..65535")
+        self.max_length = max_length
+        self._free_slots: deque[int] = deque(range(depth))
+        self._requests: list[ControlRequest | None] = [None] * depth
+        self._waiting:  deque[ControlRequest] = deque()
+        self._issued:   list[ControlRequest] = []
+        super().__init__(dev_handle, 0x00, usb.LIBUSB_CONTROL_SETUP_SIZE + max_length,
+                         depth, timeout, ctx)
+        self._views = [memoryview(buffer).cast("B") for buffer in self._buffers]
+
+    def start(self) -> None:
+        """Enable sending."""
+        if self._closed:
+            raise ValueError("pipeline is closed")
+        self._running = True
+
+    def request(self, bmRequestType: int, bRequest: int, wValue: int, wIndex: int,
+                data: Buffer | int = 0) -> ControlRequest:
+        """Queue a control request.
+
+        For a device-to-host request (LIBUSB_ENDPOINT_IN set in bmRequestType)
+        data is the number of bytes to read, otherwise data are the bytes
+        to send.
+        """
+        if not self._running:
+            self._raise_error()
+            raise ValueError("pipeline is not started")
+        if bmRequestType & usb.LIBUSB_ENDPOINT_IN:
+            if not isinstance(data, int):
+                raise TypeError("data must be the number of bytes to read")
+            length = data
+        else:
+            if isinstance(data, int) and not data: data = b""
+            data = memoryview(data).cast("B")  # type: ignore[arg-type]
+            length = len(data)
+        if length > self.max_length:
+            raise ValueError(f"request data longer than max_length ({self.max_length})")
+        request = ControlRequest(bmRequestType, bRequest, wValue, wIndex, data)
+        self._issued.append(request)
+        self._waiting.append(request)
+        self._dispatch()
+        return request
+
+    def flush(self, timeout: float | None = None) -> list[bytes | int]:
+        """Wait until all queued requests have been processed and return
+        their results (as of ControlRequest.result()), in order.
+
+        Raises TimeoutError if that did not happen within timeout seconds,
+        the first error of the requests and the error which stopped the
+        pipeline, if any.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._waiting or self._in_flight:
+            if self._error is not None:
+                break
+            self._wait_events(deadline, "control requests")
+        issued, self._issued = self._issued, []
+        self._raise_error()
+        return [request.result() for request in issued]
+
+    def run(self, requests: Iterable[tuple[Any, ...]],
+            timeout: float | None = None) -> list[bytes | int]:
+        """Queue requests given as argument tuples of request() and return
+        their results as flush() does."""
+        for args in requests:
+            self.request(*args)
+        return self.flush(timeout)
+
+    def close(self) -> None:
+        """Process the queued requests, stop the pipeline and release its
+        transfers."""
+        if self._closed: return
+        try:
+            if self._running and self._error is None:
+                while self._waiting or self._in_flight:
+                    self._wait_events(None, "control requests")
+        finally:
+            self._issued.clear()
+            super().close()
+
+    def _dispatch(self) -> None:
+        # Submits waiting requests while there are free transfers.
+        waiting, free_slots = self._waiting, self._free_slots
+        while waiting and free_slots and self._error is None:
+            request = waiting.popleft()
+            slot = free_slots.popleft()
+            data = request.data
+            length = data if isinstance(data, int) else len(data)
+            view = self._views[slot]
+            usb.pack_control_setup(view, request.bmRequestType, request.bRequest,
+                                   request.wValue, request.wIndex, length)
+            if not isinstance(data, int):
+                view[usb.LIBUSB_CONTROL_SETUP_SIZE:usb.LIBUSB_CONTROL_SETUP_SIZE + length] = data
+            self._transfers[slot][0].length = usb.LIBUSB_CONTROL_SETUP_SIZE + length
+            self._requests[slot] = request
+            if not self._submit(slot):
+                self._requests[slot] = None
+                free_slots.append(slot)
+                request._finish(None, self._error)
+        if self._error is not None:
+            while waiting:
+                waiting.popleft()._finish(None, self._error)
+
+    def _fill(self, slot: int) -> None:
+        usb.fill_control_transfer(self._transfers[slot], self.dev_handle,
+                                  self._buffers[slot], self._callback, slot, self.timeout)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        request = self._requests[slot]
+        self._requests[slot] = None
+        self._free_slots.append(slot)
+        if request is None: return
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            length = transf.actual_length
+            self.num_bytes += length
+            self.num_xfers += 1
+            if request.bmRequestType & usb.LIBUSB_ENDPOINT_IN:
+                start = usb.LIBUSB_CONTROL_SETUP_SIZE
+                request._finish(self._views[slot][start:start + length].tobytes())
+            else:
+                request._finish(length)
+        else:
+            request._finish(None, TransferError.for_status(status))
+        if self._running:
+            self._dispatch()
+
+
+class _InterruptEndpoint(_TransferQueue):
+    # Interrupt IN transfers kept in flight on an endpoint of an
+    # InterruptPoller, queueing the received reports.
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 report_size: int, num_transfers: int, queue_size: int,
+                 ctx: ctx.POINTER[usb.context] | None) -> None:
+        self.reports: deque[bytes] = deque(maxlen=queue_size)
+        self.subscribers: list[Callable[[bytes], object]] = []
+        #: Number of reports dropped because the queue was full.
+        self.overruns = 0
+        super().__init__(dev_handle, endpoint, report_size, num_transfers, 0, ctx)
+
+    def start(self) -> None:
+        self._running = True
+        for slot, pending in enumerate(self._pending):
+            if not pending and not self._submit(slot):
+                self.stop()
+                return
+
+    def _fill(self, slot: int) -> None:
+        usb.fill_interrupt_transfer(self._transfers[slot], self.dev_handle, self.endpoint,
+                                    self._buffers[slot], self.transfer_size,
+                                    self._callback, slot, self.timeout)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            reports = self.reports
+            if len(reports) == reports.maxlen:
+                self.overruns += 1
+            reports.append(ct.string_at(transf.buffer, transf.actual_length))
+            self.num_bytes += transf.actual_length
+            self.num_xfers += 1
+            if self._running:
+                self._submit(slot)
+        elif status != usb.LIBUSB_TRANSFER_CANCELLED:
+            self._fail(TransferError.for_status(status))
+
+
+class InterruptPoller:
+    """Poller of interrupt IN endpoints (e.g. of HID devices) of any number
+    of devices, served by a single thread.
+
+    Every endpoint added with add() has num_transfers interrupt transfers
+    of report_size bytes kept in flight. The received reports are queued
+    per endpoint (up to queue_size of them; with coalesce=True only the
+    latest one is kept) and the reports dropped from a full queue are
+    counted as overruns. poll() handles the libusb events and then passes
+    the queued reports to the subscribers of their endpoint (outside of
+    libusb's event handling); the reports of endpoints without subscribers
+    wait for read():
+
+        with InterruptPoller() as poller:
+            for dev_handle in dev_handles:
+                poller.add(dev_handle, 0x81, 8, subscriber=on_report)
+            while True:
+                poller.poll(0.1)
+
+    An endpoint whose transfer failed (e.g. its device was disconnected)
+    stops polling; the error is passed to error_handler (if given) as
+    error_handler(dev_handle, endpoint, exc) and raised by read().
+    """
+
+    def __init__(self, ctx: ctx.POINTER[usb.context] | None = None,
+                 error_handler: Callable[[ctx.POINTER[usb.device_handle], int,
+                                          Exception], object] | None = None) -> None:
+        self.ctx = ctx
+        self.error_handler = error_handler
+        self._endpoints: dict[tuple[int | None, int], _InterruptEndpoint] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def add(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+            report_size: int, subscriber: Callable[[bytes], object] | None = None,
+            num_transfers: int = 2, coalesce: bool = False, queue_size: int = 64) -> None:
+        """Start polling an interrupt IN endpoint of a device."""
+        if not endpoint & usb.LIBUSB_ENDPOINT_IN:
+            raise ValueError(f"0x{endpoint:02x} is not an IN endpoint")
+        key = self._key(dev_handle, endpoint)
+        if key in self._endpoints:
+            raise ValueError(f"endpoint 0x{endpoint:02x} of the device is already polled")
+        poller = _InterruptEndpoint(dev_handle, endpoint, report_size, num_transfers,
+                                    1 if coalesce else queue_size, self.ctx)
+        if subscriber is not None:
+            poller.subscribers.append(subscriber)
+        poller.start()
+        if poller._error is not None:
+            poller.close()
+            poller._raise_error()
+        self._endpoints[key] = poller
+
+    def remove(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int) -> None:
+        """Stop polling an endpoint (its unread reports are discarded)."""
+        self._endpoints.pop(self._key(dev_handle, endpoint)).close()
+
+    def subscribe(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                  subscriber: Callable[[bytes], object]) -> None:
+        """Add a subscriber of the reports of an endpoint."""
+        self._get(dev_handle, endpoint).subscribers.append(subscriber)
+
+    def unsubscribe(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                    subscriber: Callable[[bytes], object]) -> None:
+        """Remove a subscriber of the reports of an endpoint."""
+        self._get(dev_handle, endpoint).subscribers.remove(subscriber)
+
+    def overruns(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int) -> int:
+        """Number of reports of an endpoint dropped (or coalesced) so far."""
+        return self._get(dev_handle, endpoint).overruns
+
+    def poll(self, timeout: float = 0.0) -> None:
+        """Handle libusb events for at most timeout seconds and deliver the
+        received reports to the subscribers."""
+        tv = timeval(int(timeout), int((timeout % 1) * 1_000_000))
+        rc = _transport.handle_events_timeout_completed(self.ctx, tv, None)
+        if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+            raise USBError(rc)
+        self._dispatch()
+
+    def read(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+             timeout: float | None = None) -> bytes:
+        """Return the next report of an endpoint without subscribers (the
+        latest one with coalesce=True).
+
+        Raises TimeoutError if no report has been received within timeout
+        seconds and the error which stopped polling the endpoint, if any.
+        """
+        poller = self._get(dev_handle, endpoint)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not poller.reports:
+            if poller._error is not None:
+                raise poller._error
+            if not poller.in_flight:
+                raise EOFError("endpoint is not polled")
+            wait = 1.0
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise TimeoutError("timed out waiting for a report")
+            self.poll(wait)
+        return poller.reports.popleft()
+
+    def close(self) -> None:
+        """Stop polling all endpoints."""
+        endpoints = list(self._endpoints.values())
+        self._endpoints.clear()
+        for poller in endpoints:
+            poller.close()
+
+    def _dispatch(self) -> None:
+        for poller in self._endpoints.values():
+            if poller.subscribers:
+                reports = poller.reports
+                while reports:
+                    report = reports.popleft()
+                    for subscriber in poller.subscribers:
+                        subscriber(report)
+            if poller._error is not None and not poller._closed and not poller.in_flight:
+                poller.close()
+                if self.error_handler is not None:
+                    self.error_handler(poller.dev_handle, poller.endpoint, poller._error)
+
+    def _get(self, dev_handle: ctx.POINTER[usb.device_handle],
+             endpoint: int) -> _InterruptEndpoint:
+        try:
+            return self._endpoints[self._key(dev_handle, endpoint)]
+        except KeyError:
+            raise ValueError(f"endpoint 0x{endpoint:02x} of the device is not polled") \
+                  from None
+
+    @staticmethod
+    def _key(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int) -> tuple[int | None, int]:
+        return (ct.cast(dev_handle, ct.c_void_p).value, endpoint)
@@ -0,0 +1,316 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('read_into', 'write', 'writev', 'control_in', 'control_out')
+
+from typing_extensions import Buffer
+from collections.abc import Iterable
+import threading
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+from ._platform import CFUNC
+from ._platform import timeval
+from ._dll      import dll
+from ._error    import USBError, TransferError
+from ._stream   import _ubyte_buffer
+
+# The synchronous I/O functions with the data passed as void* (which accepts
+# bytes as they are and ctypes arrays, so no pointer casts are needed).
+
+_bulk_transfer = CFUNC(ct.c_int,
+    ct.POINTER(usb.device_handle),
+    ct.c_ubyte,
+    ct.c_void_p,
+    ct.c_int,
+    ct.POINTER(ct.c_int),
+    ct.c_uint)(
+    ("libusb_bulk_transfer", dll), (
+    (1, "dev_handle"),
+    (1, "endpoint"),
+    (1, "data"),
+    (1, "length"),
+    (1, "actual_length"),
+    (1, "timeout"),))
+
+_interrupt_transfer = CFUNC(ct.c_int,
+    ct.POINTER(usb.device_handle),
+    ct.c_ubyte,
+    ct.c_void_p,
+    ct.c_int,
+    ct.POINTER(ct.c_int),
+    ct.c_uint)(
+    ("libusb_interrupt_transfer", dll), (
+    (1, "dev_handle"),
+    (1, "endpoint"),
+    (1, "data"),
+    (1, "length"),
+    (1, "actual_length"),
+    (1, "timeout"),))
+
+_control_transfer = CFUNC(ct.c_int,
+    ct.POINTER(usb.device_handle),
+    ct.c_uint8,
+    ct.c_uint8,
+    ct.c_uint16,
+    ct.c_uint16,
+    ct.c_void_p,
+    ct.c_uint16,
+    ct.c_uint)(
+    ("libusb_control_transfer", dll), (
+    (1, "dev_handle"),
+    (1, "bmRequestType"),
+    (1, "bRequest"),
+    (1, "wValue"),
+    (1, "wIndex"),
+    (1, "data"),
+    (1, "wLength"),
+    (1, "timeout"),))
+
+
+class _Transferred(threading.local):
+    # Per-thread transferred count (and a pointer to it) for the calls.
+
+    def __init__(self) -> None:
+        self.count = ct.c_int()
+        self.pointer = ct.pointer(self.count)
+
+_transferred = _Transferred()
+
+
+def _writable(buffer: Buffer) -> ct.Array[ct.c_char]:
+    view = memoryview(buffer)
+    if view.readonly:
+        raise TypeError("buffer is read-only")
+    return (ct.c_char * view.nbytes).from_buffer(view)
+
+
+def _readable(data: Buffer) -> tuple[bytes | ct.Array[ct.c_char], int]:
+    # Returns data passable as void* (without copying, except of read-only
+    # buffers other than bytes) and its length.
+    if type(data) is bytes:
+        return data, len(data)
+    view = memoryview(data)
+    if view.readonly:
+        data = view.tobytes()
+        return data, len(data)
+    return (ct.c_char * view.nbytes).from_buffer(view), view.nbytes
+
+
+def _check_wlength(length: int) -> None:
+    # wLength is 16-bit, a longer data stage would be silently truncated.
+    if not 0 <= length <= 0xFFFF:
+        raise ValueError(f"control transfer length {length} not in range 0..65535")
+
+
+def read_into(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+              buffer: Buffer, timeout: int = 1000, interrupt: bool = False) -> int:
+    """Read from an IN endpoint into a writable buffer (e.g. a bytearray or
+    a memoryview of one) and return the number of bytes read.
+
+    Performs a synchronous bulk (or, with interrupt=True, interrupt)
+    transfer; raises USBError on failure.
+    """
+    data = _writable(buffer)
+    transferred = _transferred
+    rc = (_interrupt_transfer if interrupt else _bulk_transfer)(
+          dev_handle, endpoint, data, len(data), transferred.pointer, timeout)
+    if rc < 0:
+        raise USBError(rc)
+    return transferred.count.value
+
+
+def write(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+          data: Buffer, timeout: int = 1000, interrupt: bool = False) -> int:
+    """Write data (bytes, bytearray, memoryview, ...) to an OUT endpoint and
+    return the number of bytes written.
+
+    Performs a synchronous bulk (or, with interrupt=True, interrupt)
+    transfer; raises USBError on failure.
+    """
+    data, length = _readable(data)
+    transferred = _transferred
+    rc = (_interrupt_transfer if interrupt else _bulk_transfer)(
+          dev_handle, endpoint, data, length, transferred.pointer, timeout)
+    if rc < 0:
+        raise USBError(rc)
+    return transferred.count.value
+
+
+def writev(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+           buffers: Iterable[Buffer], timeout: int = 1000,
+           max_packet_size: int | None = None, zero_packet: bool = True,
+           context: ctx.POINTER[usb.context] | None = None) -> int:
+    """Write the concatenation of buffers to a bulk OUT endpoint as one
+    pipelined operation and return the number of bytes written.
+
+    The data are split into transfers aligned to the endpoint's maximum
+    packet size (got from the device if max_packet_size is None), which
+    are all submitted at once. The aligned parts of writable buffers and
+    of bytes objects are sent in place; only the bytes straddling a
+    boundary between two buffers (less than a packet on each side) and
+    other read-only buffers are copied. With zero_packet the last transfer
+    sends a zero-length packet if the total length is a multiple of the
+    maximum packet size, so that the device sees the end of the data.
+
+    timeout applies to each transfer. Raises USBError if a transfer could
+    not be submitted or the events of context could not be handled, and
+    TransferError if a transfer failed (the remaining ones are cancelled).
+    """
+    if max_packet_size is None:
+        max_packet_size = usb.get_max_packet_size(usb.get_device(dev_handle), endpoint)
+        if max_packet_size < 0:
+            raise USBError(max_packet_size)
+    if max_packet_size <= 0:
+        raise ValueError("max_packet_size must be positive")
+
+    pieces = _packet_aligned(buffers, max_packet_size)
+    total = sum(stop - start for _, start, stop in pieces)
+    if not total:
+        return 0
+
+    remaining = 0
+    completed = ct.c_int(0)
+    errors: list[Exception] = []
+    transfers: list[ctx.POINTER[usb.transfer]] = []
+
+    def cancel_all() -> None:
+        for transfer in transfers:
+            _transport.cancel_transfer(transfer)
+
+    def transfer_cb(transfer: ctx.POINTER[usb.transfer]) -> None:
+        nonlocal remaining
+        remaining -= 1
+        if not remaining:
+            completed.value = 1
+        status = transfer[0].status
+        if status != usb.LIBUSB_TRANSFER_COMPLETED and not errors:
+            errors.append(TransferError.for_status(status))
+            cancel_all()
+
+    tv = timeval(1, 0)
+
+    def handle_events() -> int:
+        rc: int = _transport.handle_events_timeout_completed(context, tv,
+                                                             ct.byref(completed))
+        return 0 if rc == usb.LIBUSB_ERROR_INTERRUPTED else rc
+
+    callback = usb.transfer_cb_fn(transfer_cb)
+    keep_alive = []
+    try:
+        for view, start, stop in pieces:
+            transfer = usb.alloc_transfer(0)
+            if not transfer:
+                raise USBError(usb.LIBUSB_ERROR_NO_MEM)
+            transfers.append(transfer)
+            buffer = _ubyte_buffer(view, start, stop)
+            keep_alive.append(buffer)
+            usb.fill_bulk_transfer(transfer, dev_handle, endpoint, buffer, stop - start,
+                                   callback, None, timeout)
+        if zero_packet and total % max_packet_size == 0:
+            transfers[-1][0].flags |= usb.LIBUSB_TRANSFER_ADD_ZERO_PACKET
+        for transfer in transfers:
+            rc = _transport.submit_transfer(transfer)
+            if rc < 0:
+                errors.append(USBError(rc))
+                cancel_all()
+                break
+            remaining += 1
+        while remaining:
+            rc = handle_events()
+            if rc < 0:
+                # Reap the cancelled transfers before their callback and
+                # buffers go away.
+                cancel_all()
+                while remaining and handle_events() >= 0:
+                    pass
+                raise USBError(rc)
+        if errors:
+            raise errors[0]
+        return sum(transfer[0].actual_length for transfer in transfers)
+    finally:
+        if remaining:
+            # Still in flight (the events cannot be handled): the transfers,
+            # their callback and buffers must never be freed.
+            _orphaned.append((transfers, callback, keep_alive))
+        else:
+            for transfer in transfers:
+                usb.free_transfer(transfer)
+
+_orphaned: list[object] = []
+
+
+def _packet_aligned(buffers: Iterable[Buffer],
+                    max_packet_size: int) -> list[tuple[memoryview, int, int]]:
+    # Splits the concatenation of buffers into pieces of whole packets
+    # (except of the last one), copying only the packets that span buffers.
+    # The pieces are (view, start, stop), view being the whole byte view of
+    # a buffer (or of a copy).
+    pieces: list[tuple[memoryview, int, int]] = []
+    carry = bytearray()
+    for buffer in buffers:
+        view = memoryview(buffer).cast("B")
+        start = 0
+        if carry:
+            start = min(max_packet_size - len(carry), len(view))
+            carry += view[:start]
+            if len(carry) < max_packet_size:
+                continue
+            pieces.append((memoryview(carry), 0, len(carry)))
+            carry = bytearray()
+        stop = len(view) - (len(view) - start) % max_packet_size
+        if stop > start:
+            pieces.append((view, start, stop))
+        carry = bytearray(view[stop:])
+    if carry:
+        pieces.append((memoryview(carry), 0, len(carry)))
+    return pieces
+
+
+def control_in(dev_handle: ctx.POINTER[usb.device_handle],
+               bmRequestType: int, bRequest: int, wValue: int, wIndex: int,
+               buffer: Buffer | int, timeout: int = 1000) -> bytes | int:
+    """Perform a synchronous control transfer with a data stage from the
+    device (LIBUSB_ENDPOINT_IN is or-ed to bmRequestType).
+
+    buffer is either a writable buffer to read the data into, in which case
+    the number of bytes read is returned, or the number of bytes to read,
+    in which case the data read are returned. Raises ValueError if more
+    than 65535 bytes (wLength) are asked for and USBError on failure.
+    """
+    if isinstance(buffer, int):
+        _check_wlength(buffer)
+        data = ct.create_string_buffer(buffer)
+        length = buffer
+    else:
+        data = _writable(buffer)
+        length = len(data)
+        _check_wlength(length)
+    rc = _control_transfer(dev_handle, bmRequestType | usb.LIBUSB_ENDPOINT_IN,
+                           bRequest, wValue, wIndex, data, length, timeout)
+    if rc < 0:
+        raise USBError(rc)
+    return data.raw[:rc] if isinstance(buffer, int) else rc
+
+
+def control_out(dev_handle: ctx.POINTER[usb.device_handle],
+                bmRequestType: int, bRequest: int, wValue: int, wIndex: int,
+                data: Buffer = b"", timeout: int = 1000) -> int:
+    """Perform a synchronous control transfer with no data stage or a data
+    stage to the device (LIBUSB_ENDPOINT_IN is cleared in bmRequestType)
+    and return the number of bytes sent. Raises ValueError if data is
+    longer than 65535 bytes (wLength) and USBError on failure.
+    """
+    data, length = _readable(data)
+    _check_wlength(length)
+    rc: int = _control_transfer(dev_handle, bmRequestType & ~usb.LIBUSB_ENDPOINT_IN,
+                                bRequest, wValue, wIndex, data if length else None,
+                                length, timeout)
+    if rc < 0:
+        raise USBError(rc)
+    return rc
@@ -0,0 +1,86 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ()
+
+from typing import TYPE_CHECKING, Any, Protocol
+from collections.abc import Callable
+import threading
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from ._platform import timeval
+
+# Transfer calls of the engines of this package.
+#
+# The engines submit, cancel and complete their transfers through the
+# functions below rather than through the libusb ones, so that a backend
+# (an emulated device, see libusb.bench.EmulatedDevice) can take the place
+# of libusb for them and a submit hook (the instrumentation of the
+# transfer layer) can see every submission, without patching the libusb
+# module. The hook passes the transfers on to backend_submit_transfer().
+# Without a backend and a hook the functions are the libusb ones.
+
+if TYPE_CHECKING:
+    SubmitTransfer = Callable[[ctx.POINTER[usb.transfer]], int]
+
+
+class Backend(Protocol):
+
+    def submit_transfer(self, transfer: ctx.POINTER[usb.transfer]) -> int: ...
+
+    def cancel_transfer(self, transfer: ctx.POINTER[usb.transfer]) -> int: ...
+
+    def handle_events_timeout_completed(self, ctx: ctx.POINTER[usb.context] | None,
+                                        tv: timeval | None, completed: Any) -> int: ...
+
+    def get_next_timeout(self, ctx: ctx.POINTER[usb.context] | None,
+                         tv: timeval) -> int: ...
+
+
+_lock = threading.Lock()
+_backend: Backend | None = None
+_submit_hook: SubmitTransfer | None = None
+
+submit_transfer: SubmitTransfer = usb.submit_transfer
+backend_submit_transfer: SubmitTransfer = usb.submit_transfer
+cancel_transfer: SubmitTransfer = usb.cancel_transfer
+handle_events_timeout_completed: Callable[[ctx.POINTER[usb.context] | None,
+                                           timeval | None, Any], int] = \
+    usb.handle_events_timeout_completed
+get_next_timeout: Callable[[ctx.POINTER[usb.context] | None, timeval], int] = \
+    usb.get_next_timeout
+
+
+def set_backend(backend: Backend | None) -> Backend | None:
+    """Make backend (libusb if None) complete the transfers and return the
+    previous one."""
+    global _backend
+    with _lock:
+        previous, _backend = _backend, backend
+        _update()
+    return previous
+
+
+def set_submit_hook(hook: SubmitTransfer | None) -> SubmitTransfer | None:
+    """Route the submissions through hook (none if None) and return the
+    previous one."""
+    global _submit_hook
+    with _lock:
+        previous, _submit_hook = _submit_hook, hook
+        _update()
+    return previous
+
+
+def _update() -> None:
+    global submit_transfer, backend_submit_transfer, cancel_transfer
+    global handle_events_timeout_completed, get_next_timeout
+    backend: Any = usb if _backend is None else _backend
+    backend_submit_transfer = backend.submit_transfer
+    cancel_transfer = backend.cancel_transfer
+    handle_events_timeout_completed = backend.handle_events_timeout_completed
+    get_next_timeout = backend.get_next_timeout
+    submit_transfer = backend_submit_transfer if _submit_hook is None else _submit_hook
@@ -0,0 +1,299 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+from __future__ import annotations
+
+__all__ = ('TransferSettings', 'TransferTuner')
+
+from typing import NamedTuple
+from collections.abc import Iterable, Callable
+from os import PathLike
+import threading
+import time
+import json
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from ._error  import USBError
+from ._stream import BulkReader, BulkWriter
+
+
+class TransferSettings(NamedTuple):
+    """Transfer buffer size and number of transfers kept in flight on an
+    endpoint (and number of packets per transfer of an isochronous one)."""
+
+    transfer_size: int
+    num_transfers: int
+    num_iso_packets: int = 0
+    #: Measured throughput in bytes per second (None if not measured).
+    throughput: float | None = None
+
+
+# Transfer size and number of transfers of a bulk endpoint by device speed
+# (enough data in flight to cover a few milliseconds of the bus bandwidth).
+_bulk_settings = {
+    usb.LIBUSB_SPEED_UNKNOWN:       (16384, 8),
+    usb.LIBUSB_SPEED_LOW:           (64, 2),
+    usb.LIBUSB_SPEED_FULL:          (4096, 4),
+    usb.LIBUSB_SPEED_HIGH:          (16384, 8),
+    usb.LIBUSB_SPEED_SUPER:         (65536, 8),
+    usb.LIBUSB_SPEED_SUPER_PLUS:    (131072, 8),
+    usb.LIBUSB_SPEED_SUPER_PLUS_X2: (262144, 8),
+}
+
+# Service intervals (frames or microframes) per isochronous transfer.
+_iso_packets = {
+    usb.LIBUSB_SPEED_LOW:  8,
+    usb.LIBUSB_SPEED_FULL: 8,
+}
+
+
+class TransferTuner:
+    """Chooser of the transfer size and queue depth of an endpoint.
+
+    suggest() derives them from the capabilities of the endpoint (maximum
+    packet size, bytes per service interval of periodic endpoints, maximum
+    RAW_IO transfer size where the backend has one) and the device speed.
+    tune() additionally runs a short ramp over settings around the
+    suggested ones, measuring the throughput of each, and returns the best
+    one. The measured results are cached per VID:PID and endpoint (and
+    stored in cache_file as JSON, if given), so a device model is measured
+    only once:
+
+        tuner = TransferTuner("usb-tuning.json")
+        settings = tuner.tune(dev_handle, 0x82)
+        reader = BulkReader(dev_handle, 0x82, settings.transfer_size,
+                            settings.num_transfers)
+    """
+
+    def __init__(self, cache_file: str | PathLike[str] | None = None) -> None:
+        self.cache_file = cache_file
+        #: Throughput of every setting measured by tune(), by cache key.
+        self.results: dict[str, list[TransferSettings]] = {}
+        self._lock = threading.Lock()
+        self._cache: dict[str, TransferSettings] = {}
+        if cache_file is not None:
+            try:
+                with open(cache_file, encoding="utf-8") as file:
+                    cache = json.load(file)
+            except FileNotFoundError:
+                pass
+            else:
+                self._cache = {key: TransferSettings(*value)
+                               for key, value in cache.items()}
+
+    def suggest(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                interface: int | None = None, alt_setting: int = 0) -> TransferSettings:
+        """Return the settings for endpoint derived from its capabilities.
+
+        Bulk endpoints get transfers of a multiple of the maximum packet
+        size (capped by the maximum RAW_IO transfer size, if the backend has
+        one), sized and queued according to the device speed. Isochronous
+        endpoints get transfers of 8 (at low/full speed) or 32 service
+        intervals and interrupt ones transfers of one interval. The sizes
+        of a periodic endpoint are those of its alternate setting
+        alt_setting of interface, if interface is given, and of the current
+        alternate setting otherwise.
+        """
+        dev = usb.get_device(dev_handle)
+        speed = usb.get_device_speed(dev)
+        transfer_type = _endpoint_type(dev, endpoint, interface, alt_setting)
+        if transfer_type in (usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_ISOCHRONOUS,
+                             usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_INTERRUPT):
+            if interface is not None and hasattr(usb, "get_max_alt_packet_size"):
+                packet_size = usb.get_max_alt_packet_size(dev, interface,
+                                                          alt_setting, endpoint)
+            else:
+                packet_size = usb.get_max_iso_packet_size(dev, endpoint)
+            if packet_size < 0:
+                raise USBError(packet_size)
+            if transfer_type == usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_INTERRUPT:
+                return TransferSettings(packet_size, 4)
+            num_iso_packets = _iso_packets.get(speed, 32)
+            return TransferSettings(packet_size * num_iso_packets, 4, num_iso_packets)
+
+        packet_size = usb.get_max_packet_size(dev, endpoint)
+        if packet_size < 0:
+            raise USBError(packet_size)
+        transfer_size, num_transfers = _bulk_settings.get(
+            speed, _bulk_settings[usb.LIBUSB_SPEED_UNKNOWN])
+        transfer_size = self._bulk_size(dev_handle, endpoint, packet_size, transfer_size)
+        return TransferSettings(transfer_size, num_transfers)
+
+    def tune(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+             measure: Callable[[TransferSettings], float] | None = None,
+             duration: float = 0.25,
+             candidates: Iterable[tuple[int, int]] | None = None,
+             refresh: bool = False,
+             ctx: ctx.POINTER[usb.context] | None = None) -> TransferSettings:
+        """Return the settings with the best throughput on endpoint.
+
+        If the endpoint of the device model has been tuned before (and
+        refresh is false) the cached result is returned right away.
+        Otherwise each of candidates (pairs of transfer size and number of
+        transfers; by default transfer sizes from 1/4 to 4 times the
+        suggested one, then queue depths from 2 to 32 for the best of them)
+        is passed to measure, which returns the throughput in bytes per
+        second. By default a bulk IN endpoint is read and a bulk OUT one
+        written with zeros for duration seconds, so the device must be
+        ready to stream. Endpoints of other types get the suggested
+        settings unless measure is given (their bandwidth is reserved, it
+        does not depend on the settings).
+        """
+        dev = usb.get_device(dev_handle)
+        key = self._key(dev, endpoint)
+        if not refresh:
+            with self._lock:
+                cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+
+        suggested = self.suggest(dev_handle, endpoint)
+        if measure is None:
+            if (_endpoint_type(dev, endpoint) !=
+                usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_BULK):
+                return suggested
+            def measure(settings: TransferSettings) -> float:
+                return _measure_bulk(dev_handle, endpoint, settings, duration, ctx)
+
+        results: list[TransferSettings] = []
+
+        def run(transfer_size: int, num_transfers: int) -> TransferSettings:
+            settings = suggested._replace(transfer_size=transfer_size,
+                                          num_transfers=num_transfers)
+            settings = settings._replace(throughput=measure(settings))
+            results.append(settings)
+            return settings
+
+        if candidates is not None:
+            for transfer_size, num_transfers in candidates:
+                run(transfer_size, num_transfers)
+        else:
+            packet_size = max(1, usb.get_max_packet_size(dev, endpoint))
+            sizes = sorted({self._bulk_size(dev_handle, endpoint, packet_size,
+                                            suggested.transfer_size * factor // 4)
+                            for factor in (1, 2, 4, 8, 16)})
+            for transfer_size in sizes:
+                run(transfer_size, suggested.num_transfers)
+            best = max(results, key=_throughput)
+            for num_transfers in (2, 4, 8, 16, 32):
+                if num_transfers != suggested.num_transfers:
+                    run(best.transfer_size, num_transfers)
+        if not results:
+            raise ValueError("no candidate settings")
+
+        best = max(results, key=_throughput)
+        with self._lock:
+            self.results[key] = results
+            self._cache[key] = best
+        self._save()
+        return best
+
+    def cached(self, dev_handle: ctx.POINTER[usb.device_handle],
+               endpoint: int) -> TransferSettings | None:
+        """Return the cached result of tune() for endpoint, if any."""
+        key = self._key(usb.get_device(dev_handle), endpoint)
+        with self._lock:
+            return self._cache.get(key)
+
+    def clear(self) -> None:
+        """Forget all cached results."""
+        with self._lock:
+            self._cache.clear()
+            self.results.clear()
+        self._save()
+
+    @staticmethod
+    def _key(dev: ctx.POINTER[usb.device], endpoint: int) -> str:
+        desc = usb.device_descriptor()
+        rc = usb.get_device_descriptor(dev, ct.byref(desc))
+        if rc < 0:
+            raise USBError(rc)
+        return f"{desc.idVendor:04x}:{desc.idProduct:04x}/0x{endpoint:02x}"
+
+    @staticmethod
+    def _bulk_size(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                   packet_size: int, transfer_size: int) -> int:
+        # Rounds transfer_size to a multiple of packet_size within the
+        # backend's limit.
+        max_size = getattr(usb, "get_max_raw_io_transfer_size", None)
+        max_size = max_size(dev_handle, endpoint) if max_size is not None else -1
+        if max_size > 0:
+            transfer_size = min(transfer_size, max_size)
+        return max(packet_size, transfer_size - transfer_size % packet_size)
+
+    def _save(self) -> None:
+        if self.cache_file is None: return
+        with self._lock:
+            cache = {key: list(value) for key, value in self._cache.items()}
+        with open(self.cache_file, "w", encoding="utf-8") as file:
+            json.dump(cache, file, indent=2)
+
+
+def _throughput(settings: TransferSettings) -> float:
+    return settings.throughput or 0.0
+
+
+def _endpoint_type(dev: ctx.POINTER[usb.device], endpoint: int,
+                   interface: int | None = None, alt_setting: int = 0) -> int:
+    # Returns the transfer type of endpoint in the active configuration
+    # (in alt_setting of interface, if given); bulk if it is not found.
+    config = ct.POINTER(usb.config_descriptor)()
+    if usb.get_active_config_descriptor(dev, ct.byref(config)) < 0:
+        return usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_BULK
+    try:
+        for iface in config[0].interface[:config[0].bNumInterfaces]:
+            for altsetting in iface.altsetting[:iface.num_altsetting]:
+                if interface is not None and (
+                   altsetting.bInterfaceNumber != interface or
+                   altsetting.bAlternateSetting != alt_setting):
+                    continue
+                for ep in altsetting.endpoint[:altsetting.bNumEndpoints]:
+                    if ep.bEndpointAddress == endpoint:
+                        transfer_type: int = ep.bmAttributes & usb.LIBUSB_TRANSFER_TYPE_MASK
+                        return transfer_type
+    finally:
+        usb.free_config_descriptor(config)
+    return usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_BULK
+
+
+def _measure_bulk(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                  settings: TransferSettings, duration: float,
+                  ctx: ctx.POINTER[usb.context] | None) -> float:
+    # Returns the throughput (in bytes per second) of streaming on a bulk
+    # endpoint with settings for duration seconds.
+    total = 0
+    if endpoint & usb.LIBUSB_ENDPOINT_IN:
+        with BulkReader(dev_handle, endpoint, settings.transfer_size,
+                        settings.num_transfers, ctx=ctx) as reader:
+            start = time.perf_counter()
+            deadline = start + duration
+            while (now := time.perf_counter()) < deadline:
+                try:
+                    total += len(reader.read(deadline - now))
+                except TimeoutError:
+                    now = time.perf_counter()
+                    break
+    else:
+        data = bytes(settings.transfer_size)
+        with BulkWriter(dev_handle, endpoint, settings.transfer_size,
+                        settings.num_transfers, ctx=ctx) as writer:
+            start = time.perf_counter()
+            deadline = start + duration
+            while (now := time.perf_counter()) < deadline:
+                try:
+                    writer.write(data, deadline - now)
+                except TimeoutError:
+                    break
+            # The queued data get at most another duration to be sent; what
+            # is left then is cancelled (and not counted).
+            try:
+                writer.flush(duration)
+            except TimeoutError:
+                pass
+            now = time.perf_counter()
+            writer.stop()
+        total = writer.num_bytes
+    return total / max(now - start, 1e-9)
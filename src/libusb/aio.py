@@ -0,0 +1,370 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+"""asyncio integration of libusb event handling.
+
+libusb's file descriptors (libusb.get_pollfds()) are watched by the asyncio
+event loop, their addition and removal is tracked through the
+libusb.set_pollfd_notifiers() callbacks and, where libusb does not handle
+its timeouts through a file descriptor, a loop timer is armed from
+libusb.get_next_timeout(). Events are then handled with a zero timeout
+in the loop's thread, so no thread has to block in libusb.handle_events():
+
+    async with libusb.aio.EventHandler(ctx):
+        data = await libusb.aio.bulk_read(dev_handle, 0x82, 512)
+
+The transfer coroutines (bulk_read(), bulk_write(), interrupt_read(),
+interrupt_write(), control() and the lower level submit_transfer()) fill
+and submit a libusb.transfer and complete when it calls back. A transfer
+status other than LIBUSB_TRANSFER_COMPLETED is raised as the matching
+libusb.TransferError and cancelling the coroutine cancels the transfer.
+The callbacks may also be run by a thread handling the events outside of
+the event loop.
+"""
+
+from __future__ import annotations
+
+__all__ = ('EventHandler', 'submit_transfer',
+           'bulk_read', 'bulk_write', 'interrupt_read', 'interrupt_write', 'control')
+
+from typing_extensions import Self, Buffer
+from collections.abc import Callable
+import asyncio
+import threading
+import select
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+from ._platform import timeval
+from ._error import USBError, TransferError
+from ._stream import _ubyte_buffer
+
+POLLIN  = getattr(select, "POLLIN",  0x001)
+POLLOUT = getattr(select, "POLLOUT", 0x004)
+
+
+class EventHandler:
+    """Handles the events of a libusb context in an asyncio event loop.
+
+    On platforms where libusb does not provide pollable file descriptors
+    the events are polled every poll_interval seconds instead.
+    Only one EventHandler may be attached to a context at a time (libusb
+    has a single set of pollfd notifiers per context).
+    """
+
+    def __init__(self, ctx: ctx.POINTER[usb.context] | None = None,
+                 loop: asyncio.AbstractEventLoop | None = None,
+                 poll_interval: float = 0.01) -> None:
+        self.ctx = ctx
+        self.poll_interval = poll_interval
+        # Set for sure by attach().
+        self._loop: asyncio.AbstractEventLoop = loop  # type: ignore[assignment]
+        self._fds: dict[int, int] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._polling  = False
+        self._attached = False
+        self._loop_thread: int | None = None
+        self._zero_tv = timeval(0, 0)
+        # Must be kept alive for as long as they are set as notifiers.
+        self._added_cb   = usb.pollfd_added_cb(self._pollfd_added)
+        self._removed_cb = usb.pollfd_removed_cb(self._pollfd_removed)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop | None:
+        """The event loop the events are handled in."""
+        return self._loop
+
+    def __enter__(self) -> Self:
+        self.attach()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.detach()
+
+    async def __aenter__(self) -> Self:
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        self.__exit__(*exc_info)
+
+    def attach(self) -> None:
+        """Start handling the context's events in the event loop.
+
+        Must be called from the event loop's thread, or with the loop given
+        explicitly (then from any thread; the loop starts handling the
+        events once it runs).
+        """
+        if self._attached: return
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._loop_thread = threading.get_ident()
+        else:
+            # Learn the loop's thread in the loop (before anything else).
+            self._loop_thread = None
+            self._loop.call_soon_threadsafe(self._set_loop_thread)
+        usb.set_pollfd_notifiers(self.ctx, self._added_cb, self._removed_cb, None)
+        self._attached = True
+        _handlers.add(self)
+        pollfds = usb.get_pollfds(self.ctx)
+        if pollfds:
+            try:
+                i = 0
+                while pollfds[i]:
+                    pollfd = pollfds[i][0]
+                    self._call_in_loop(self._add_fd, pollfd.fd, pollfd.events)
+                    i += 1
+            finally:
+                usb.free_pollfds(pollfds)
+        else:
+            self._polling = True
+        self._call_in_loop(self.handle_events)
+
+    def detach(self) -> None:
+        """Stop handling the context's events in the event loop."""
+        if not self._attached: return
+        usb.set_pollfd_notifiers(self.ctx, usb.pollfd_added_cb(),
+                                 usb.pollfd_removed_cb(), None)
+        self._attached = False
+        _handlers.discard(self)
+        self._call_in_loop(self._remove_all)
+
+    def handle_events(self) -> None:
+        """Handle pending events without blocking and re-arm the timer.
+
+        Called by the event loop; call it also after submitting a transfer
+        with a timeout from outside of a transfer callback, so that the
+        timer follows the libusb's nearest timeout.
+        """
+        if not self._attached: return
+        rc = _transport.handle_events_timeout_completed(self.ctx, self._zero_tv, None)
+        if rc < 0 and rc != usb.LIBUSB_ERROR_INTERRUPTED:
+            self._loop.call_exception_handler({
+                "message": "libusb event handling failed",
+                "exception": USBError(rc),
+            })
+        self._arm_timer()
+
+    def _arm_timer(self) -> None:
+        # Without a timeout to handle by the timer (e.g. libusb handling its
+        # timeouts through a file descriptor) get_next_timeout() returns 0.
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        tv = timeval()
+        rc = _transport.get_next_timeout(self.ctx, tv)
+        if rc == 1:
+            delay = tv.tv_sec + tv.tv_usec / 1_000_000
+            if self._polling: delay = min(delay, self.poll_interval)
+        elif self._polling:
+            delay = self.poll_interval
+        else:
+            return
+        self._timer = self._loop.call_later(delay, self.handle_events)
+
+    def _add_fd(self, fd: int, events: int) -> None:
+        loop = self._loop
+        self._fds[fd] = events
+        if events & POLLIN:
+            loop.add_reader(fd, self.handle_events)
+        if events & POLLOUT:
+            loop.add_writer(fd, self.handle_events)
+
+    def _remove_fd(self, fd: int) -> None:
+        loop = self._loop
+        events = self._fds.pop(fd, 0)
+        if events & POLLIN:
+            loop.remove_reader(fd)
+        if events & POLLOUT:
+            loop.remove_writer(fd)
+
+    def _remove_all(self) -> None:
+        for fd in list(self._fds):
+            self._remove_fd(fd)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._polling = False
+
+    def _set_loop_thread(self) -> None:
+        self._loop_thread = threading.get_ident()
+
+    def _call_in_loop(self, func: Callable[..., object], *args: object) -> None:
+        # Calls func in the event loop's thread, now if already there.
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _pollfd_added(self, fd: int, events: int, user_data: int | None) -> None:
+        # libusb may call the notifiers from any thread using the context.
+        self._call_in_loop(self._add_fd, fd, events)
+
+    def _pollfd_removed(self, fd: int, user_data: int | None) -> None:
+        self._call_in_loop(self._remove_fd, fd)
+
+
+_handlers: set[EventHandler] = set()
+
+
+def _arm_timers(loop: asyncio.AbstractEventLoop) -> None:
+    # libusb's nearest timeout may have changed by a transfer submission.
+    for handler in _handlers:
+        if handler.loop is loop:
+            handler._arm_timer()
+
+
+class _Operation:
+    """A transfer submitted on behalf of a coroutine.
+
+    The transfer is freed in the event loop's thread, once it has called
+    back, whether or not the coroutine is still waiting for it.
+    """
+
+    __slots__ = ('transfer', 'buffer', 'future', 'loop', 'loop_thread', 'callback')
+
+    _pending: set[_Operation] = set()
+
+    def __init__(self, transfer: ctx.POINTER[usb.transfer], buffer: object) -> None:
+        self.transfer = transfer
+        self.buffer   = buffer
+        self.loop     = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.future: asyncio.Future[tuple[int, int]] = self.loop.create_future()
+        self.callback = usb.transfer_cb_fn(self._transfer_cb)
+        transfer[0].callback = self.callback
+
+    async def execute(self) -> int:
+        """Submit the transfer and return its actual length."""
+        rc = _transport.submit_transfer(self.transfer)
+        if rc < 0:
+            usb.free_transfer(self.transfer)
+            raise USBError(rc)
+        self._pending.add(self)
+        _arm_timers(self.loop)
+        try:
+            status, actual_length = await self.future
+        except asyncio.CancelledError:
+            if self in self._pending:
+                _transport.cancel_transfer(self.transfer)
+                _arm_timers(self.loop)
+            raise
+        if status != usb.LIBUSB_TRANSFER_COMPLETED:
+            raise TransferError.for_status(status)
+        return actual_length
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        if threading.get_ident() == self.loop_thread:
+            self._done(transf.status, transf.actual_length)
+        else:
+            self.loop.call_soon_threadsafe(self._done, transf.status, transf.actual_length)
+
+    def _done(self, status: int, actual_length: int) -> None:
+        self._pending.discard(self)
+        usb.free_transfer(self.transfer)
+        if not self.future.done():
+            self.future.set_result((status, actual_length))
+
+
+def _alloc_transfer() -> ctx.POINTER[usb.transfer]:
+    transfer: ctx.POINTER[usb.transfer] = usb.alloc_transfer(0)
+    if not transfer:
+        raise USBError(usb.LIBUSB_ERROR_NO_MEM)
+    return transfer
+
+
+async def submit_transfer(transfer: ctx.POINTER[usb.transfer],
+                          keep_alive: object = None) -> int:
+    """Submit a filled transfer and return its actual length on completion.
+
+    The transfer's callback is replaced and the transfer is freed once it
+    has completed (so it must not be freed by the caller). keep_alive is
+    kept referenced until then (e.g. the transfer's buffer).
+    """
+    return await _Operation(transfer, keep_alive).execute()
+
+
+async def _read(fill: Callable[..., None], dev_handle: ctx.POINTER[usb.device_handle],
+                endpoint: int, length: int, timeout: int) -> bytes:
+    buffer = (ct.c_ubyte * length)()
+    transfer = _alloc_transfer()
+    fill(transfer, dev_handle, endpoint | usb.LIBUSB_ENDPOINT_IN, buffer, length,
+         None, None, timeout)
+    actual_length = await _Operation(transfer, buffer).execute()
+    return ct.string_at(buffer, actual_length)
+
+
+async def _write(fill: Callable[..., None], dev_handle: ctx.POINTER[usb.device_handle],
+                 endpoint: int, data: Buffer, timeout: int) -> int:
+    view = memoryview(data).cast("B")
+    buffer = _ubyte_buffer(view)
+    transfer = _alloc_transfer()
+    fill(transfer, dev_handle, endpoint & ~usb.LIBUSB_ENDPOINT_IN, buffer, len(view),
+         None, None, timeout)
+    return await _Operation(transfer, buffer).execute()
+
+
+async def bulk_read(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                    length: int, timeout: int = 0) -> bytes:
+    """Read up to length bytes from a bulk IN endpoint."""
+    return await _read(usb.fill_bulk_transfer, dev_handle, endpoint, length, timeout)
+
+
+async def bulk_write(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                     data: Buffer, timeout: int = 0) -> int:
+    """Write data to a bulk OUT endpoint and return the number of bytes sent.
+
+    The data is not copied if it is writable or a bytes object.
+    """
+    return await _write(usb.fill_bulk_transfer, dev_handle, endpoint, data, timeout)
+
+
+async def interrupt_read(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                         length: int, timeout: int = 0) -> bytes:
+    """Read up to length bytes from an interrupt IN endpoint."""
+    return await _read(usb.fill_interrupt_transfer, dev_handle, endpoint, length, timeout)
+
+
+async def interrupt_write(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                          data: Buffer, timeout: int = 0) -> int:
+    """Write data to an interrupt OUT endpoint and return the number of bytes sent."""
+    return await _write(usb.fill_interrupt_transfer, dev_handle, endpoint, data, timeout)
+
+
+async def control(dev_handle: ctx.POINTER[usb.device_handle], bmRequestType: int,
+                  bRequest: int, wValue: int, wIndex: int,
+                  data: Buffer | int = 0, timeout: int = 1000) -> bytes | int:
+    """Perform a control transfer.
+
+    For a device-to-host request (LIBUSB_ENDPOINT_IN set in bmRequestType)
+    data is the number of bytes to read and the data read are returned,
+    otherwise data are the bytes to send and their sent count is returned.
+    """
+    setup_size = usb.LIBUSB_CONTROL_SETUP_SIZE
+    direction_in = bmRequestType & usb.LIBUSB_ENDPOINT_IN
+    if direction_in:
+        if not isinstance(data, int):
+            raise TypeError("data must be the number of bytes to read")
+        length = data
+        buffer = (ct.c_ubyte * (setup_size + length))()
+    else:
+        if isinstance(data, int) and not data: data = b""
+        view = memoryview(data).cast("B")  # type: ignore[arg-type]
+        length = len(view)
+        buffer = (ct.c_ubyte * (setup_size + length))()
+        memoryview(buffer).cast("B")[setup_size:] = view
+    usb.pack_control_setup(buffer, bmRequestType, bRequest, wValue, wIndex, length)
+    transfer = _alloc_transfer()
+    usb.fill_control_transfer(transfer, dev_handle, buffer, None, None, timeout)
+    actual_length = await _Operation(transfer, buffer).execute()
+    if direction_in:
+        return memoryview(buffer).cast("B")[setup_size:setup_size + actual_length].tobytes()
+    return actual_length
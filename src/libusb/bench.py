@@ -0,0 +1,447 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+"""Throughput and latency benchmark of the libusb transfer layer.
+
+Keeps num_transfers transfers of transfer_size bytes in flight on an
+endpoint for a while (resubmitting each of them as soon as it completes)
+and reports, for every combination of the transfer sizes and queue depths
+given, the throughput (MB/s and transfers/s), the CPU time used per MB
+and the p50/p99 completion latency (from submission to callback) as JSON:
+
+    python -m libusb.bench --device 1234:abcd --bulk-in 0x82 --bulk-out 0x02
+    python -m libusb.bench --sizes 4096,65536 --depths 1,8 --output bench.json
+
+Without --device the benchmark runs against an in-process EmulatedDevice
+(bulk IN 0x81, bulk OUT 0x02, interrupt IN 0x83, isochronous IN 0x84),
+which completes the transfers at a configurable bandwidth and latency, so
+the overhead of the Python side can be tracked without hardware (e.g. in
+CI).
+"""
+
+from __future__ import annotations
+
+__all__ = ('EmulatedDevice', 'run', 'main')
+
+from typing import Any
+from typing_extensions import Self
+from collections.abc import Callable, Sequence
+from collections import deque
+import argparse
+import platform
+import json
+import math
+import sys
+import time
+import ctypes as ct
+
+from utlx import ctypes as ctx
+
+from . import _libusb as usb
+from . import _transport
+from ._platform import timeval
+from ._error  import USBError, TransferError
+from ._stream import _TransferQueue
+
+_transfer_types = {
+    "bulk":        usb.LIBUSB_TRANSFER_TYPE_BULK,
+    "interrupt":   usb.LIBUSB_TRANSFER_TYPE_INTERRUPT,
+    "isochronous": usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS,
+}
+
+
+class EmulatedDevice:
+    """In-process device emulated at the level of the asynchronous transfer
+    API.
+
+    While active (in a with block) it takes the place of libusb for the
+    transfers of the engines of this package (of any device handle, e.g.
+    None), which are completed by event handling: one after another at
+    bandwidth bytes per second (at once if 0) and each latency seconds
+    after its data went over the bus.
+
+    IN transfers receive the data returned by source(endpoint, length)
+    (isochronous ones packet by packet); without a source they get all
+    the data requested and their buffers are left as they are. The data of
+    OUT transfers is consumed or, with record true, appended to
+    sink[endpoint] (sink[(endpoint, stream_id)] for bulk stream transfers).
+
+    The status of a transfer can be forced by putting it to statuses and
+    that of an isochronous packet by putting it to packet_statuses (the
+    packet then gets no data); submit_transfer() fails with submit_error
+    if set. While hold is true, submitted transfers are not completed
+    (cancelled ones still are). submitted holds the transfers in flight
+    and cancelled the ones cancelled but not completed yet.
+    """
+
+    def __init__(self, bandwidth: float = 0, latency: float = 0,
+                 source: Callable[[int, int], bytes] | None = None,
+                 record: bool = False) -> None:
+        self.bandwidth = bandwidth
+        self.latency   = latency
+        self.source    = source
+        self.record    = record
+        self.sink: dict[int | tuple[int, int], bytearray] = {}
+        self.statuses: deque[int] = deque()
+        self.packet_statuses: deque[int] = deque()
+        self.submit_error = 0
+        self.hold = False
+        self.submitted: deque[ctx.POINTER[usb.transfer]] = deque()
+        self.cancelled: list[ctx.POINTER[usb.transfer]] = []
+        # Completion times of the submitted transfers, in that order.
+        self._due: deque[float] = deque()
+        self._busy_until = 0.0
+        self._saved_backend: _transport.Backend | None = None
+
+    def __enter__(self) -> Self:
+        self._saved_backend = _transport.set_backend(self)
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        _transport.set_backend(self._saved_backend)
+        self._saved_backend = None
+
+    def submit_transfer(self, transfer: ctx.POINTER[usb.transfer]) -> int:
+        if self.submit_error:
+            return self.submit_error
+        done = self._busy_until = max(time.perf_counter(), self._busy_until)
+        if self.bandwidth:
+            done = self._busy_until = done + transfer[0].length / self.bandwidth
+        self.submitted.append(transfer)
+        self._due.append(done + self.latency)
+        return usb.LIBUSB_SUCCESS
+
+    def cancel_transfer(self, transfer: ctx.POINTER[usb.transfer]) -> int:
+        address = ct.addressof(transfer.contents)
+        for index, item in enumerate(self.submitted):
+            if ct.addressof(item.contents) == address:
+                del self.submitted[index]
+                del self._due[index]
+                self.cancelled.append(item)
+                return usb.LIBUSB_SUCCESS
+        return usb.LIBUSB_ERROR_NOT_FOUND
+
+    def handle_events_timeout_completed(self, ctx: ctx.POINTER[usb.context] | None,
+                                        tv: timeval | None, completed: Any) -> int:
+        cancelled, self.cancelled = self.cancelled, []
+        for transfer in cancelled:
+            self._complete(transfer, usb.LIBUSB_TRANSFER_CANCELLED)
+        submitted, due = self.submitted, self._due
+        if self.hold or not submitted:
+            return usb.LIBUSB_SUCCESS
+        now = time.perf_counter()
+        if due[0] > now and not cancelled:
+            timeout = 0.0 if tv is None else tv.tv_sec + tv.tv_usec / 1_000_000
+            time.sleep(min(timeout, due[0] - now))
+            now = time.perf_counter()
+        # Not the transfers resubmitted by the callbacks.
+        for _ in range(len(submitted)):
+            if not submitted or due[0] > now: break
+            transfer = submitted.popleft()
+            due.popleft()
+            status = (self.statuses.popleft() if self.statuses else
+                      usb.LIBUSB_TRANSFER_COMPLETED)
+            self._complete(transfer, status)
+        return usb.LIBUSB_SUCCESS
+
+    def get_next_timeout(self, ctx: ctx.POINTER[usb.context] | None, tv: timeval) -> int:
+        # The pending completions stand for libusb's internal timeouts, so
+        # that event handling driven by them (libusb.aio) completes them.
+        if self.cancelled:
+            timeout = 0.0
+        elif self._due and not self.hold:
+            timeout = max(0.0, self._due[0] - time.perf_counter())
+        else:
+            return 0
+        tv.tv_sec, tv.tv_usec = int(timeout), int((timeout % 1) * 1_000_000)
+        return 1
+
+    def _complete(self, transfer: ctx.POINTER[usb.transfer], status: int) -> None:
+        transf = transfer[0]
+        transf.status = status
+        transf.actual_length = 0
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            if transf.type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS:
+                self._complete_iso(transf)
+            else:
+                self._complete_data(transfer)
+        transf.callback(transfer)
+
+    def _complete_data(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        endpoint, buffer, length = transf.endpoint, transf.buffer, transf.length
+        if transf.type == usb.LIBUSB_TRANSFER_TYPE_CONTROL:
+            # The data stage follows the setup packet.
+            setup = usb.control_transfer_get_setup(transfer)[0]
+            if setup.bmRequestType & usb.LIBUSB_ENDPOINT_IN:
+                endpoint |= usb.LIBUSB_ENDPOINT_IN
+            buffer = usb.control_transfer_get_data(transfer)
+            length = setup.wLength
+        if endpoint & usb.LIBUSB_ENDPOINT_IN:
+            if self.source is not None:
+                data = self.source(endpoint, length)
+                ct.memmove(buffer, data, len(data))
+                length = len(data)
+        elif self.record:
+            key: int | tuple[int, int] = endpoint
+            if transf.type == usb.LIBUSB_TRANSFER_TYPE_BULK_STREAM:
+                key = (endpoint, usb.transfer_get_stream_id(transfer))
+            self.sink.setdefault(key, bytearray()).extend(ct.string_at(buffer, length))
+        transf.actual_length = length
+
+    def _complete_iso(self, transf: usb.transfer) -> None:
+        offset = 0
+        for desc in usb._iso_packet_desc(transf):
+            if self.packet_statuses:
+                desc.status = self.packet_statuses.popleft()
+                desc.actual_length = 0
+            else:
+                desc.status = usb.LIBUSB_TRANSFER_COMPLETED
+                desc.actual_length = desc.length
+                if self.source is not None:
+                    data = self.source(transf.endpoint, desc.length)
+                    ct.memmove(ctx.c_ptr_add(transf.buffer, offset), data, len(data))
+                    desc.actual_length = len(data)
+            offset += desc.length
+
+
+class _Benchmark(_TransferQueue):
+    # Keeps the transfers in flight, recording the completion latencies.
+
+    def __init__(self, dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+                 transfer_type: int, transfer_size: int, num_transfers: int,
+                 packet_size: int = 0, ctx: ctx.POINTER[usb.context] | None = None) -> None:
+        self.transfer_type = transfer_type
+        self.packet_size   = packet_size
+        self.num_errors = 0
+        self.latencies: list[float] = []
+        self._submitted = [0.0] * num_transfers
+        num_iso_packets = (transfer_size // packet_size
+                           if transfer_type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS else 0)
+        super().__init__(dev_handle, endpoint, transfer_size, num_transfers,
+                         ctx=ctx, num_iso_packets=num_iso_packets)
+
+    def start(self) -> None:
+        self._running = True
+        for slot in range(self.num_transfers):
+            if not self._submit(slot):
+                self.stop()
+                self._raise_error()
+
+    def _fill(self, slot: int) -> None:
+        transfer = self._transfers[slot]
+        args = (self.dev_handle, self.endpoint, self._buffers[slot], self.transfer_size)
+        if self.transfer_type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS:
+            num_iso_packets = self.transfer_size // self.packet_size
+            usb.fill_iso_transfer(transfer, *args, num_iso_packets,
+                                  self._callback, slot, self.timeout)
+            usb.set_iso_packet_lengths(transfer, self.packet_size)
+        elif self.transfer_type == usb.LIBUSB_TRANSFER_TYPE_INTERRUPT:
+            usb.fill_interrupt_transfer(transfer, *args, self._callback, slot, self.timeout)
+        else:
+            usb.fill_bulk_transfer(transfer, *args, self._callback, slot, self.timeout)
+
+    def _submit(self, slot: int) -> bool:
+        self._submitted[slot] = time.perf_counter()
+        return super()._submit(slot)
+
+    def _transfer_cb(self, transfer: ctx.POINTER[usb.transfer]) -> None:
+        transf = transfer[0]
+        slot   = self._completed(transf)
+        status = transf.status
+        if status == usb.LIBUSB_TRANSFER_CANCELLED:
+            return
+        self.latencies.append(time.perf_counter() - self._submitted[slot])
+        if status == usb.LIBUSB_TRANSFER_COMPLETED:
+            if self.transfer_type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS:
+                self.num_bytes += sum(desc.actual_length
+                                      for desc in usb._iso_packet_desc(transf))
+            else:
+                self.num_bytes += transf.actual_length
+            self.num_xfers += 1
+        else:
+            self.num_errors += 1
+            if status != usb.LIBUSB_TRANSFER_TIMED_OUT:
+                self._fail(TransferError.for_status(status))
+                return
+        if self._running:
+            self._submit(slot)
+
+
+def run(dev_handle: ctx.POINTER[usb.device_handle], endpoint: int,
+        transfer_type: int, transfer_size: int, num_transfers: int,
+        duration: float = 1.0, packet_size: int = 0,
+        ctx: ctx.POINTER[usb.context] | None = None) -> dict[str, Any]:
+    """Benchmark num_transfers transfers of transfer_size bytes kept in
+    flight on endpoint for duration seconds and return the results.
+
+    transfer_type is LIBUSB_TRANSFER_TYPE_BULK, _INTERRUPT or _ISOCHRONOUS;
+    isochronous transfers consist of packets of packet_size bytes (the
+    endpoint's maximum if 0). Raises USBError or TransferError if the
+    transfers could not be run.
+    """
+    if transfer_type == usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS:
+        if not packet_size:
+            packet_size = usb.get_max_iso_packet_size(usb.get_device(dev_handle), endpoint)
+            if packet_size < 0:
+                raise USBError(packet_size)
+        transfer_size = max(packet_size, transfer_size - transfer_size % packet_size)
+    bench = _Benchmark(dev_handle, endpoint, transfer_type, transfer_size, num_transfers,
+                       packet_size, ctx)
+    try:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        deadline = start + duration
+        bench.start()
+        while (now := time.perf_counter()) < deadline and bench._error is None:
+            bench._handle_events(min(deadline - now, 0.1))
+        bench.stop()
+        elapsed = time.perf_counter() - start
+        cpu_time = time.process_time() - cpu_start
+        bench._raise_error()
+    finally:
+        bench.close()
+
+    megabytes = bench.num_bytes / 1_000_000
+    latencies = sorted(bench.latencies)
+    return {
+        "endpoint":        f"0x{endpoint:02x}",
+        "transfer_type":   next(name for name, value in _transfer_types.items()
+                                if value == transfer_type),
+        "direction":       "in" if endpoint & usb.LIBUSB_ENDPOINT_IN else "out",
+        "transfer_size":   transfer_size,
+        "num_transfers":   num_transfers,
+        "seconds":         elapsed,
+        "bytes":           bench.num_bytes,
+        "transfers":       bench.num_xfers,
+        "errors":          bench.num_errors,
+        "mb_per_s":        megabytes / elapsed,
+        "transfers_per_s": bench.num_xfers / elapsed,
+        "cpu_s_per_mb":    cpu_time / megabytes if megabytes else None,
+        "latency_p50_us":  _percentile(latencies, 0.50) * 1e6 if latencies else None,
+        "latency_p99_us":  _percentile(latencies, 0.99) * 1e6 if latencies else None,
+    }
+
+
+def _percentile(values: Sequence[float], fraction: float) -> float:
+    # Nearest-rank percentile of sorted values.
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def _int_list(arg: str) -> list[int]:
+    return [int(item, 0) for item in arg.split(",") if item]
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m libusb.bench",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--device", metavar="VID:PID",
+                        help="device to benchmark (an emulated one if not given)")
+    parser.add_argument("--interface", type=int, default=0, metavar="N",
+                        help="interface to claim (default: %(default)s)")
+    parser.add_argument("--alt-setting", type=int, metavar="N",
+                        help="alternate setting to select")
+    parser.add_argument("--bulk-in", type=lambda arg: int(arg, 0), metavar="EP")
+    parser.add_argument("--bulk-out", type=lambda arg: int(arg, 0), metavar="EP")
+    parser.add_argument("--interrupt-in", type=lambda arg: int(arg, 0), metavar="EP")
+    parser.add_argument("--iso-in", type=lambda arg: int(arg, 0), metavar="EP")
+    parser.add_argument("--sizes", type=_int_list, default=[4096, 16384, 65536],
+                        metavar="N,...", help="bulk/isochronous transfer sizes")
+    parser.add_argument("--depths", type=_int_list, default=[1, 4, 8, 16],
+                        metavar="N,...", help="numbers of transfers in flight")
+    parser.add_argument("--interrupt-size", type=int, default=64, metavar="N",
+                        help="interrupt transfer size (default: %(default)s)")
+    parser.add_argument("--iso-packet-size", type=int, default=0, metavar="N",
+                        help="isochronous packet size (default: the endpoint's maximum)")
+    parser.add_argument("--duration", type=float, default=1.0, metavar="SECONDS",
+                        help="duration of each measurement (default: %(default)s)")
+    parser.add_argument("--emulate-bandwidth", type=float, default=0, metavar="MB/S",
+                        help="bandwidth of the emulated device (default: unlimited)")
+    parser.add_argument("--emulate-latency", type=float, default=0, metavar="US",
+                        help="completion latency of the emulated device (default: 0)")
+    parser.add_argument("--output", metavar="FILE", help="JSON output file (default: stdout)")
+    return parser
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    """Run the benchmarks given by the command line arguments."""
+    args = _parser().parse_args(argv)
+    endpoints = [(endpoint, transfer_type, sizes) for endpoint, transfer_type, sizes in (
+                 (args.bulk_in,      usb.LIBUSB_TRANSFER_TYPE_BULK,        args.sizes),
+                 (args.bulk_out,     usb.LIBUSB_TRANSFER_TYPE_BULK,        args.sizes),
+                 (args.interrupt_in, usb.LIBUSB_TRANSFER_TYPE_INTERRUPT,   [args.interrupt_size]),
+                 (args.iso_in,       usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS, args.sizes))
+                 if endpoint is not None]
+    report: dict[str, Any] = {
+        "device":   args.device or "emulated",
+        "python":   platform.python_version(),
+        "platform": platform.platform(),
+        "duration": args.duration,
+        "results":  [],
+    }
+
+    def run_all(dev_handle: ctx.POINTER[usb.device_handle],
+                ctx: ctx.POINTER[usb.context] | None, packet_size: int) -> None:
+        for endpoint, transfer_type, sizes in endpoints:
+            for transfer_size in sizes:
+                for num_transfers in args.depths:
+                    report["results"].append(run(dev_handle, endpoint, transfer_type,
+                                                 transfer_size, num_transfers,
+                                                 args.duration, packet_size, ctx))
+
+    if args.device is None:
+        if not endpoints:
+            endpoints = [(0x81, usb.LIBUSB_TRANSFER_TYPE_BULK,        args.sizes),
+                         (0x02, usb.LIBUSB_TRANSFER_TYPE_BULK,        args.sizes),
+                         (0x83, usb.LIBUSB_TRANSFER_TYPE_INTERRUPT,   [args.interrupt_size]),
+                         (0x84, usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS, args.sizes)]
+        report["emulation"] = {"bandwidth_mb_per_s": args.emulate_bandwidth,
+                               "latency_us": args.emulate_latency}
+        with EmulatedDevice(args.emulate_bandwidth * 1_000_000,
+                            args.emulate_latency / 1_000_000):
+            # A NULL device handle.
+            run_all(ct.POINTER(usb.device_handle)(), None, args.iso_packet_size or 1024)
+    else:
+        if not endpoints:
+            print("no endpoint to benchmark given", file=sys.stderr)
+            return 2
+        vid, pid = (int(x, 16) for x in args.device.split(":"))
+        context = ct.POINTER(usb.context)()
+        rc = usb.init(ct.byref(context))
+        if rc < 0:
+            raise USBError(rc)
+        try:
+            dev_handle = usb.open_device_with_vid_pid(context, vid, pid)
+            if not dev_handle:
+                print(f"device {vid:04x}:{pid:04x} not found", file=sys.stderr)
+                return 1
+            try:
+                usb.set_auto_detach_kernel_driver(dev_handle, 1)
+                rc = usb.claim_interface(dev_handle, args.interface)
+                if rc < 0:
+                    raise USBError(rc)
+                try:
+                    if args.alt_setting is not None:
+                        rc = usb.set_interface_alt_setting(dev_handle, args.interface,
+                                                           args.alt_setting)
+                        if rc < 0:
+                            raise USBError(rc)
+                    run_all(dev_handle, context, args.iso_packet_size)
+                finally:
+                    usb.release_interface(dev_handle, args.interface)
+            finally:
+                usb.close(dev_handle)
+        finally:
+            usb.exit(context)
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    return 0
+
+
+if __name__.rpartition(".")[-1] == "__main__":
+    sys.exit(main())
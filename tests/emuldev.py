@@ -0,0 +1,19 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+# Emulation of a device at the level of the libusb asynchronous transfer API
+# for the tests of the engines built on top of it (no hardware needed).
+
+from libusb import bench
+
+
+class EmulatedDevice(bench.EmulatedDevice):
+    """libusb.bench.EmulatedDevice completing every submitted transfer by the
+    next event handling, which records the data of OUT transfers in
+    self.sink and gives IN transfers the data returned by
+    self.source(endpoint, length) (zeros by default).
+    """
+
+    def __init__(self, source=None):
+        super().__init__(source=source or (lambda endpoint, length: bytes(length)),
+                         record=True)
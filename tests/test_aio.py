@@ -0,0 +1,163 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+import asyncio
+import threading
+import select
+import ctypes as ct
+
+import libusb as usb
+import libusb.aio
+
+from .emuldev import EmulatedDevice
+
+
+class EventHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = ct.POINTER(usb.context)()
+        rc = usb.init_context(ct.byref(self.ctx), None, 0)
+        if rc != usb.LIBUSB_SUCCESS:
+            self.skipTest(f"libusb.init_context failed: {usb.error_name(rc)}")
+
+    def tearDown(self):
+        usb.exit(self.ctx)
+
+    @unittest.skipUnless(hasattr(select, "poll"), "POSIX-only test")
+    def test_attach_detach(self):
+
+        async def main():
+            handler = usb.aio.EventHandler(self.ctx)
+            async with handler:
+                self.assertIs(handler.loop, asyncio.get_running_loop())
+                fds = list(handler._fds)
+                self.assertTrue(fds)
+                for fd in fds:
+                    self.assertTrue(handler.loop._selector.get_key(fd))
+                # Wake up the libusb's event handling and let the loop handle it.
+                usb.interrupt_event_handler(self.ctx)
+                self.assertTrue(select.select(fds, [], [], 0)[0])
+                for _ in range(10):
+                    await asyncio.sleep(0.01)
+                    if not select.select(fds, [], [], 0)[0]: break
+                self.assertFalse(select.select(fds, [], [], 0)[0])
+            self.assertFalse(handler._fds)
+            for fd in fds:
+                with self.assertRaises(KeyError):
+                    handler.loop._selector.get_key(fd)
+
+        asyncio.run(main())
+
+    @unittest.skipUnless(hasattr(select, "poll"), "POSIX-only test")
+    def test_attach_loop_in_other_thread(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            handler = usb.aio.EventHandler(self.ctx, loop)
+            handler.attach()
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+            self.assertEqual(handler._loop_thread, thread.ident)
+            fds = list(handler._fds)
+            self.assertTrue(fds)
+            handler.detach()
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+            self.assertFalse(handler._fds)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+class TransferCoroutinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = ct.POINTER(usb.context)()
+        rc = usb.init_context(ct.byref(self.ctx), None, 0)
+        if rc != usb.LIBUSB_SUCCESS:
+            self.skipTest(f"libusb.init_context failed: {usb.error_name(rc)}")
+
+    def tearDown(self):
+        usb.exit(self.ctx)
+
+    def run_transfer(self, coro):
+        # Runs the coroutine, the (emulated) events handled by the loop.
+
+        async def main():
+            async with usb.aio.EventHandler(self.ctx):
+                return await asyncio.wait_for(coro, 5)
+
+        return asyncio.run(main())
+
+    def test_bulk(self):
+        with EmulatedDevice(lambda endpoint, length: b"x" * (length // 2)) as device:
+            data = self.run_transfer(usb.aio.bulk_read(None, 0x82, 64))
+            self.assertEqual(data, b"x" * 32)
+            sent = self.run_transfer(usb.aio.bulk_write(None, 0x02, b"abc"))
+            self.assertEqual(sent, 3)
+            sent = self.run_transfer(usb.aio.interrupt_write(None, 0x01, bytearray(b"de")))
+            self.assertEqual(sent, 2)
+            data = self.run_transfer(usb.aio.interrupt_read(None, 0x81, 8))
+            self.assertEqual(data, b"x" * 4)
+            self.assertEqual(device.sink, {0x02: b"abc", 0x01: b"de"})
+
+    def test_control(self):
+        with EmulatedDevice(lambda endpoint, length: b"\x12\x01"[:length]) as device:
+            data = self.run_transfer(usb.aio.control(
+                None, usb.LIBUSB_ENDPOINT_IN, usb.LIBUSB_REQUEST_GET_DESCRIPTOR,
+                usb.LIBUSB_DT_DEVICE << 8, 0, 2))
+            self.assertEqual(data, b"\x12\x01")
+            sent = self.run_transfer(usb.aio.control(
+                None, usb.LIBUSB_REQUEST_TYPE_VENDOR, 0x01, 0, 0, b"\x01\x02\x03"))
+            self.assertEqual(sent, 3)
+            self.assertEqual(device.sink, {0x00: b"\x01\x02\x03"})
+
+    def test_transfer_error(self):
+        with EmulatedDevice() as device:
+            device.statuses.append(usb.LIBUSB_TRANSFER_STALL)
+            with self.assertRaises(usb.TransferStallError):
+                self.run_transfer(usb.aio.bulk_read(None, 0x82, 64))
+            device.statuses.append(usb.LIBUSB_TRANSFER_TIMED_OUT)
+            with self.assertRaises(TimeoutError):
+                self.run_transfer(usb.aio.bulk_write(None, 0x02, b"a", 10))
+            device.submit_error = usb.LIBUSB_ERROR_NO_DEVICE
+            with self.assertRaises(usb.USBError):
+                self.run_transfer(usb.aio.bulk_read(None, 0x82, 64))
+
+    def test_cancel(self):
+
+        async def main(device):
+            async with usb.aio.EventHandler(self.ctx):
+                device.hold = True
+                task = asyncio.ensure_future(usb.aio.bulk_read(None, 0x82, 64))
+                await asyncio.sleep(0.01)
+                self.assertEqual(len(device.submitted), 1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertFalse(device.submitted)
+                # The transfer is freed once it has called back.
+                for _ in range(100):
+                    if not usb.aio._Operation._pending: break
+                    await asyncio.sleep(0.01)
+                self.assertFalse(device.cancelled)
+                self.assertFalse(usb.aio._Operation._pending)
+
+        with EmulatedDevice() as device:
+            asyncio.run(main(device))
+
+    def test_events_handled_in_other_thread(self):
+
+        async def main(device):
+            task = asyncio.ensure_future(usb.aio.bulk_read(None, 0x82, 16))
+            await asyncio.sleep(0)
+            thread = threading.Thread(target=device.handle_events_timeout_completed,
+                                      args=(None, None, None))
+            thread.start()
+            data = await task
+            thread.join()
+            return data
+
+        with EmulatedDevice() as device:
+            self.assertEqual(asyncio.run(main(device)), bytes(16))
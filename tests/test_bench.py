@@ -0,0 +1,53 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+import tempfile
+import json
+import os
+
+import libusb as usb
+from libusb import bench
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_emulated(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bench.json")
+            self.assertEqual(bench.main(["--duration", "0.01", "--sizes", "1024,4096",
+                                         "--depths", "1,4", "--iso-packet-size", "512",
+                                         "--output", path]), 0)
+            with open(path, encoding="utf-8") as file:
+                report = json.load(file)
+        self.assertEqual(report["device"], "emulated")
+        results = report["results"]
+        self.assertEqual(len(results), 4 + 4 + 2 + 4)
+        self.assertEqual([(result["transfer_type"], result["direction"])
+                          for result in results[::2]],
+                         [("bulk", "in")] * 2 + [("bulk", "out")] * 2 +
+                         [("interrupt", "in")] + [("isochronous", "in")] * 2)
+        for result in results:
+            self.assertGreater(result["transfers"], 0)
+            self.assertEqual(result["bytes"],
+                             result["transfers"] * result["transfer_size"])
+            self.assertEqual(result["errors"], 0)
+            self.assertGreater(result["mb_per_s"], 0)
+            self.assertLessEqual(result["latency_p50_us"], result["latency_p99_us"])
+
+    def test_percentile(self):
+        values = list(range(100))
+        self.assertEqual(bench._percentile(values, 0.50), 49)
+        self.assertEqual(bench._percentile(values, 0.99), 98)
+        self.assertEqual(bench._percentile(values, 1.0), 99)
+        self.assertEqual(bench._percentile(values, 0.0), 0)
+        self.assertEqual(bench._percentile([5.0], 0.99), 5.0)
+        self.assertEqual(bench._percentile([1, 2, 3], 0.50), 2)
+
+    def test_emulated_bandwidth(self):
+        with bench.EmulatedDevice(bandwidth=10_000_000, latency=0.001):
+            result = bench.run(None, 0x81, usb.LIBUSB_TRANSFER_TYPE_BULK, 10000, 2,
+                               duration=0.1)
+        self.assertLess(result["mb_per_s"], 11)
+        # Data goes over the bus one transfer after another.
+        self.assertGreaterEqual(result["latency_p50_us"], 2000)
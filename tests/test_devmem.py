@@ -0,0 +1,78 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import sys
+import mmap
+import ctypes as ct
+
+import libusb as usb
+
+libusb = sys.modules["libusb._libusb"]
+
+
+class DeviceMemoryTestCase(unittest.TestCase):
+
+    def test_dma(self):
+        regions = []
+
+        def dev_mem_alloc(dev_handle, length):
+            regions.append((ct.c_ubyte * length)())
+            return ct.cast(regions[-1], ct.POINTER(ct.c_ubyte))
+
+        with mock.patch.object(libusb, "dev_mem_alloc", dev_mem_alloc), \
+             mock.patch.object(libusb, "dev_mem_free") as dev_mem_free:
+            with usb.DeviceMemory(None, 512, 5, region_size=1024) as memory:
+                self.assertTrue(memory.is_dma)
+                self.assertEqual(len(regions), 3)
+                buffers = [memory.acquire() for _ in range(5)]
+                self.assertEqual(address(buffers[1]), ct.addressof(regions[0]) + 512)
+                self.assertEqual(address(buffers[4]), ct.addressof(regions[2]))
+                with self.assertRaises(MemoryError):
+                    memory.acquire()
+                buffers[2][:3] = b"abc"
+                self.assertEqual(bytes(regions[1][:3]), b"abc")
+                memory.release(buffers[2])
+                self.assertEqual(memory.num_free, 1)
+            self.assertEqual(dev_mem_free.call_count, 3)
+
+    def test_fallback(self):
+        with mock.patch.object(libusb, "dev_mem_alloc",
+                               lambda dev_handle, length: ct.POINTER(ct.c_ubyte)()), \
+             mock.patch.object(libusb, "dev_mem_free") as dev_mem_free:
+            with usb.DeviceMemory(None, 100, 3) as memory:
+                self.assertFalse(memory.is_dma)
+                buffer = memory.acquire()
+                self.assertEqual(address(buffer) % mmap.PAGESIZE, 0)
+                self.assertEqual(len(buffer), 100)
+                self.assertFalse(buffer.readonly)
+                buffer[:] = bytes(range(100))
+                array = (ct.c_ubyte * len(buffer)).from_buffer(buffer)
+                self.assertEqual(bytes(array), bytes(range(100)))
+            dev_mem_free.assert_not_called()
+
+    def test_misuse(self):
+        with mock.patch.object(libusb, "dev_mem_alloc",
+                               lambda dev_handle, length: ct.POINTER(ct.c_ubyte)()):
+            memory = usb.DeviceMemory(None, 100, 3)
+            buffer = memory.acquire()
+            memory.release(buffer)
+            with self.assertRaises(ValueError):
+                buffer[0]  # released
+            with self.assertRaises(ValueError):
+                memory.release(buffer)  # twice
+            with self.assertRaises(ValueError):
+                memory.release(memoryview(bytearray(100)))  # foreign
+            buffer = memory.acquire()
+            memory.close()
+            with self.assertRaises(ValueError):
+                buffer[0] = 1  # freed
+            with self.assertRaises(ValueError):
+                memory.release(buffer)
+            with self.assertRaises(ValueError):
+                memory.acquire()
+
+
+def address(buffer):
+    return ct.addressof(ct.c_ubyte.from_buffer(buffer))
@@ -0,0 +1,181 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import threading
+import time
+import ctypes as ct
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+
+class CompletionQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transfers = [usb.alloc_transfer(0) for _ in range(6)]
+        self.buffer = (ct.c_ubyte * 8)()
+
+    def tearDown(self):
+        for transfer in self.transfers:
+            usb.free_transfer(transfer)
+
+    def submit(self, device, queue, transfers):
+        for transfer in transfers:
+            usb.fill_bulk_transfer(transfer, None, 0x81, self.buffer, 8,
+                                   queue.callback, None, 0)
+            device.submit_transfer(transfer)
+
+    def addresses(self, transfers):
+        return [ct.addressof(transfer.contents) for transfer in transfers]
+
+    def test_batches(self):
+        queue = usb.CompletionQueue(capacity=4)
+        with EmulatedDevice() as device:
+            self.submit(device, queue, self.transfers[:3])
+            completed = queue.handle_events()
+            self.assertEqual(self.addresses(completed), self.addresses(self.transfers[:3]))
+            self.assertEqual(completed[0][0].actual_length, 8)
+            self.assertEqual(queue.drain(), [])
+            # Wraps around the ring and overflows it.
+            self.submit(device, queue, self.transfers)
+            device.handle_events_timeout_completed(None, None, None)
+            self.assertEqual(len(queue), 6)
+            self.assertEqual(queue.num_overflows, 2)
+            self.assertEqual(self.addresses(queue.drain(5)),
+                             self.addresses(self.transfers[:5]))
+            self.assertEqual(self.addresses(queue.drain()),
+                             self.addresses(self.transfers[5:]))
+            self.assertEqual(queue.num_completed, 9)
+            self.assertFalse(queue.wait(0))
+
+    def test_worker_thread(self):
+        queue = usb.CompletionQueue()
+        completed = []
+
+        def worker():
+            while len(completed) < 6:
+                if queue.wait(5):
+                    completed.extend(queue.drain())
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        with EmulatedDevice() as device:
+            self.submit(device, queue, self.transfers)
+            device.handle_events_timeout_completed(None, None, None)
+        thread.join(5)
+        self.assertEqual(self.addresses(completed), self.addresses(self.transfers))
+
+
+class EventThreadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = ct.POINTER(usb.context)()
+        rc = usb.init_context(ct.byref(self.ctx), None, 0)
+        if rc != usb.LIBUSB_SUCCESS:
+            self.skipTest(f"libusb.init_context failed: {usb.error_name(rc)}")
+
+    def tearDown(self):
+        usb.exit(self.ctx)
+
+    def test_stop(self):
+        events = usb.EventThread(self.ctx, tick=30)
+        with events:
+            self.assertTrue(events.is_alive())
+            time.sleep(0.05)
+            start = time.monotonic()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(events.is_alive())
+        with self.assertRaises(RuntimeError):
+            events.wait_until(lambda: False)
+
+    def test_wait_until(self):
+        done = threading.Event()
+
+        def complete():
+            done.set()
+            # As on a transfer completion: the event handler wakes the waiters.
+            usb.interrupt_event_handler(self.ctx)
+
+        with usb.EventThread(self.ctx, tick=30) as events:
+            self.assertTrue(events.wait_until(lambda: True))
+            self.assertFalse(events.wait_until(done.is_set, timeout=0.05))
+            timer = threading.Timer(0.05, complete)
+            timer.start()
+            start = time.monotonic()
+            self.assertTrue(events.wait_until(done.is_set, timeout=20))
+            self.assertLess(time.monotonic() - start, 5)
+            timer.join()
+
+
+class TransferSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transfers = [usb.alloc_transfer(0) for _ in range(4)]
+        self.buffer = (ct.c_ubyte * 8)()
+        self.completed = []
+
+        @usb.transfer_cb_fn
+        def callback(transfer):
+            self.completed.append((ct.addressof(transfer.contents), transfer[0].status))
+
+        self.callback = callback
+        for transfer, endpoint in zip(self.transfers, (0x81, 0x81, 0x82, 0x02)):
+            usb.fill_bulk_transfer(transfer, None, endpoint, self.buffer, 8,
+                                   callback, None, 0)
+
+    def tearDown(self):
+        for transfer in self.transfers:
+            usb.free_transfer(transfer)
+
+    def address(self, index):
+        return ct.addressof(self.transfers[index].contents)
+
+    def test_cancel_groups(self):
+        with EmulatedDevice() as device:
+            scheduler = usb.TransferScheduler()
+            for transfer, tag in zip(self.transfers, ("a", "a", "b", "b")):
+                scheduler.submit(transfer, tag=tag)
+            self.assertEqual(len(scheduler), 4)
+            self.assertEqual(scheduler.cancel(endpoint=0x81),
+                             [self.address(0), self.address(1)])
+            self.assertEqual(scheduler.cancel(dev_handle=self.transfers[0][0].dev_handle,
+                                              endpoint=0x02), [self.address(3)])
+            self.assertEqual(len(device.cancelled), 3)
+            scheduler.cancel_and_wait(tag="b", timeout=5)
+            self.assertEqual(len(scheduler), 0)
+            self.assertEqual(sorted(self.completed),
+                             sorted((self.address(i), usb.LIBUSB_TRANSFER_CANCELLED)
+                                    for i in range(4)))
+            self.assertFalse(device.submitted)
+            # The original callbacks are restored.
+            self.assertEqual(ct.cast(self.transfers[2][0].callback, ct.c_void_p).value,
+                             ct.cast(self.callback, ct.c_void_p).value)
+
+    def test_deadline(self):
+        device = EmulatedDevice()
+        with mock.patch.object(device, "handle_events_timeout_completed",
+                               lambda ctx, tv, completed: self.handle_events(device)), \
+             device:
+            device.hold = True  # no completions but of the cancelled transfers
+            scheduler = usb.TransferScheduler()
+            now = time.monotonic()
+            scheduler.submit(self.transfers[0], now + 0.05)
+            scheduler.submit(self.transfers[1], now + 60)
+            self.assertLessEqual(scheduler.next_timeout(), 0.05)
+            while len(scheduler) == 2:
+                scheduler.handle_events(0.01)
+            self.assertEqual(self.completed,
+                             [(self.address(0), usb.LIBUSB_TRANSFER_TIMED_OUT)])
+            self.assertGreater(scheduler.next_timeout(), 30)
+            scheduler.cancel_and_wait()
+
+    def handle_events(self, device):
+        # Completes only the cancelled transfers.
+        time.sleep(0.005)
+        cancelled, device.cancelled = device.cancelled, []
+        for transfer in cancelled:
+            device._complete(transfer, usb.LIBUSB_TRANSFER_CANCELLED)
+        return 0
@@ -0,0 +1,178 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import threading
+import tempfile
+import time
+import sys
+import io
+import os
+import ctypes as ct
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+libusb = sys.modules["libusb._libusb"]
+transport = sys.modules["libusb._transport"]
+instrument = sys.modules["libusb._instrument"]
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = usb.LatencyHistogram()
+        self.assertEqual(histogram.percentile(0.5), 0)
+        for duration in range(1, 101):
+            histogram.add(duration * 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 100_000)
+        self.assertEqual(histogram.mean, 50_500)
+        for fraction in (0.01, 0.5, 0.9, 0.99):
+            value = histogram.percentile(fraction)
+            self.assertGreaterEqual(value, fraction * 100_000)
+            self.assertLessEqual(value, fraction * 100_000 * 1.25)
+        self.assertEqual(histogram.percentile(1.0), 100_000)
+        histogram.add(10**15)  # out of range
+        self.assertEqual(histogram.buckets[-1], 1)
+        copy = histogram.copy()
+        histogram.add(1)
+        self.assertEqual(copy.count, 101)
+        self.assertEqual(sum(copy.buckets), 101)
+
+    def test_bucket_bounds(self):
+        upper_bound = usb.LatencyHistogram._upper_bound
+        for duration in range(5000):
+            histogram = usb.LatencyHistogram()
+            histogram.add(duration)
+            index = histogram.buckets.index(1)
+            self.assertLessEqual(duration, upper_bound(index))
+            if index:
+                self.assertGreater(duration, upper_bound(index - 1))
+        # The last bucket starts at 7 * 2**38 ns.
+        histogram = usb.LatencyHistogram()
+        for duration in (7 * 2**38 - 1, 7 * 2**38, 2**41):
+            histogram.add(duration)
+        self.assertEqual(list(histogram.buckets[-2:]), [1, 2])
+
+
+class TransferLatencyTestCase(unittest.TestCase):
+
+    def test_latency(self):
+        submit_transfer = libusb.submit_transfer
+        with EmulatedDevice() as device:
+            self.assertEqual(transport.submit_transfer, device.submit_transfer)
+            with usb.TransferLatency() as latency:
+                self.assertNotEqual(transport.submit_transfer, device.submit_transfer)
+                self.assertEqual(transport.backend_submit_transfer, device.submit_transfer)
+                with usb.BulkReader(None, 0x81, 64, 4) as reader:
+                    for _ in range(20):
+                        reader.read()
+                    num_xfers = reader.num_xfers
+                device.statuses.append(usb.LIBUSB_TRANSFER_STALL)
+                with usb.BulkWriter(None, 0x02, 64, 2) as writer:
+                    writer.write(b"x" * 64)
+                    with self.assertRaises(usb.TransferStallError):
+                        writer.flush()
+            self.assertEqual(transport.submit_transfer, device.submit_transfer)
+            # The libusb module is left alone.
+            self.assertIs(libusb.submit_transfer, submit_transfer)
+            self.assertIs(usb.submit_transfer, submit_transfer)
+            # Not collecting anymore.
+            with usb.BulkReader(None, 0x81, 64, 4) as reader:
+                reader.read()
+        snapshot = latency.snapshot()
+        self.assertEqual(set(snapshot), {(None, 0x81, usb.LIBUSB_TRANSFER_TYPE_BULK),
+                                         (None, 0x02, usb.LIBUSB_TRANSFER_TYPE_BULK)})
+        stats = snapshot[(None, 0x81, usb.LIBUSB_TRANSFER_TYPE_BULK)]
+        self.assertEqual(stats.completion.count, num_xfers)  # cancelled not counted
+        self.assertEqual(stats.callback.count, num_xfers)
+        self.assertGreater(stats.completion.percentile(0.5), 0)
+        self.assertEqual(snapshot[(None, 0x02, usb.LIBUSB_TRANSFER_TYPE_BULK)]
+                         .completion.count, 1)
+        latency.reset()
+        self.assertEqual(latency.snapshot(), {})
+
+    def test_devices(self):
+        dev_handle = ct.pointer(usb.device_handle())
+        devs = [ct.pointer(usb.device()), ct.pointer(usb.device())]
+        dev = devs[0]
+        with mock.patch.object(libusb, "get_device", lambda dev_handle: dev), \
+             mock.patch.object(libusb, "get_bus_number",
+                               lambda dev: devs.index(dev) + 1), \
+             mock.patch.object(libusb, "get_device_address", lambda dev: 7), \
+             usb.TransferLatency():
+            self.assertIsNone(instrument._device(ct.POINTER(usb.device_handle)()))
+            self.assertEqual(instrument._device(dev_handle), (1, 7))
+            # The handle closed and its address reused for another device.
+            dev = devs[1]
+            self.assertEqual(instrument._device(dev_handle), (2, 7))
+        self.assertEqual(instrument._devices, {})
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            instrument._Instrument()
+
+
+class TransferTraceTestCase(unittest.TestCase):
+
+    def test_trace(self):
+        with EmulatedDevice(), usb.TransferTrace(size=8) as trace:
+            with usb.BulkReader(None, 0x81, 64, 2) as reader:
+                for _ in range(10):
+                    reader.read()
+            with usb.BulkWriter(None, 0x02, 32, 1) as writer:
+                writer.write(b"abc")
+            # One copy per callback, not per submission.
+            self.assertEqual(len(instrument._callbacks), 2)
+            self.assertEqual(instrument._in_flight, {})
+        self.assertEqual(instrument._callbacks, {})
+        records = trace.records()
+        self.assertEqual(len(trace), 8)
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[-1][1:], (None, 0x02, usb.LIBUSB_TRANSFER_TYPE_BULK,
+                                           3, 3, usb.LIBUSB_TRANSFER_COMPLETED))
+        self.assertEqual(records[-2].status, usb.LIBUSB_TRANSFER_CANCELLED)
+        self.assertEqual(records[0][1:], (None, 0x81, usb.LIBUSB_TRANSFER_TYPE_BULK,
+                                          64, 64, usb.LIBUSB_TRANSFER_COMPLETED))
+        times = [record.time for record in records]
+        self.assertEqual(times, sorted(times))
+        self.assertLess(abs(times[-1] - time.time()), 60)
+        stream = io.StringIO()
+        self.assertEqual(trace.dump(stream), 8)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0], "time,bus,address,endpoint,transfer_type,"
+                                   "length,actual_length,status")
+        self.assertTrue(lines[-1].endswith(",,,0x02,BULK,3,3,COMPLETED"))
+        with self.assertRaises(ValueError):
+            trace.dump()
+        trace.clear()
+        self.assertEqual(trace.records(), [])
+
+    def test_burst_dump(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.csv")
+            trace = usb.TransferTrace(dump_file=path, burst=3, burst_interval=10)
+            with EmulatedDevice() as device, trace:
+                for status in (usb.LIBUSB_TRANSFER_STALL, usb.LIBUSB_TRANSFER_NO_DEVICE):
+                    device.statuses.append(status)
+                    with usb.BulkReader(None, 0x81, 64, 1) as reader:
+                        with self.assertRaises(usb.TransferError):
+                            reader.read()
+                self.assertEqual(trace.num_burst_dumps, 0)
+                device.statuses.extend([usb.LIBUSB_TRANSFER_COMPLETED,
+                                        usb.LIBUSB_TRANSFER_STALL])
+                with usb.BulkReader(None, 0x81, 64, 1) as reader:
+                    reader.read()
+                    with self.assertRaises(usb.TransferStallError):
+                        reader.read()
+                self.assertEqual(trace.num_burst_dumps, 1)
+            for thread in threading.enumerate():
+                if thread.name == "TransferTrace dump":
+                    thread.join()
+            with open(path, encoding="utf-8") as file:
+                lines = file.read().splitlines()
+            self.assertEqual(len(lines), 1 + 4)
+            self.assertTrue(lines[-1].endswith(",STALL"))
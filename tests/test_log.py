@@ -0,0 +1,101 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import logging
+import sys
+
+import libusb as usb
+
+libusb = sys.modules["libusb._libusb"]
+
+
+class LogBridgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def set_log_cb(ctx, cb, mode):
+            self.calls.append(("set_log_cb", cb or None, mode))  # NULL as None
+
+        def set_option(ctx, option, value):
+            self.calls.append(("set_option", option, value))
+            return usb.LIBUSB_SUCCESS
+
+        mock.patch.object(libusb, "set_log_cb", set_log_cb, create=True).start()
+        mock.patch.object(libusb, "set_option", set_option).start()
+        self.addCleanup(mock.patch.stopall)
+        self.logger = logging.getLogger("libusb.test_log")
+        self.logger.setLevel(logging.WARNING)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+    def test_bridge(self):
+        bridge = usb.LogBridge(None, self.logger, interval=60)
+        bridge.start()
+        try:
+            self.assertEqual(self.calls, [
+                ("set_log_cb", bridge._callback, usb.LIBUSB_LOG_CB_GLOBAL),
+                ("set_option", usb.LIBUSB_OPTION_LOG_LEVEL, usb.LIBUSB_LOG_LEVEL_WARNING)])
+            with self.assertLogs(self.logger, logging.WARNING) as logs:
+                # As called by libusb.
+                bridge._callback(None, usb.LIBUSB_LOG_LEVEL_ERROR,
+                                 b"libusb: error [op_open] open failed\n")
+                bridge._callback(None, usb.LIBUSB_LOG_LEVEL_WARNING,
+                                 b"libusb: warning [op_claim] busy\n")
+                self.assertEqual(bridge.drain(), 2)
+            self.assertEqual(logs.output, [
+                "ERROR:libusb.test_log:libusb: error [op_open] open failed",
+                "WARNING:libusb.test_log:libusb: warning [op_claim] busy"])
+            # The level follows the logger's.
+            self.logger.setLevel(logging.DEBUG)
+            self.assertEqual(bridge.sync_level(), usb.LIBUSB_LOG_LEVEL_DEBUG)
+            self.assertEqual(self.calls[-1], ("set_option", usb.LIBUSB_OPTION_LOG_LEVEL,
+                                              usb.LIBUSB_LOG_LEVEL_DEBUG))
+            del self.calls[:]
+            bridge.sync_level()  # unchanged
+            self.assertEqual(self.calls, [])
+            bridge._callback(None, usb.LIBUSB_LOG_LEVEL_DEBUG,
+                             b"[ 0.000100] [00001234] libusb: debug [f] x\n")
+            with self.assertLogs(self.logger, logging.DEBUG) as logs:
+                bridge.close()  # logs the queued messages
+        finally:
+            bridge.close()
+        # The level libusb would keep logging at to stderr is reset.
+        self.assertEqual(self.calls, [
+            ("set_log_cb", None, usb.LIBUSB_LOG_CB_GLOBAL),
+            ("set_option", usb.LIBUSB_OPTION_LOG_LEVEL, usb.LIBUSB_LOG_LEVEL_NONE)])
+        self.assertEqual(logs.output, [
+            "DEBUG:libusb.test_log:[ 0.000100] [00001234] libusb: debug [f] x"])
+
+    def test_rate_limit_and_drops(self):
+        bridge = usb.LogBridge(None, self.logger, capacity=4, rate_limit=3600)
+        for number in range(5):
+            bridge._log_cb(None, usb.LIBUSB_LOG_LEVEL_ERROR, b"libusb: error [f] same\n")
+        self.assertEqual(bridge.dropped, 1)
+        with self.assertLogs(self.logger) as logs:
+            self.assertEqual(bridge.drain(), 4)
+        self.assertEqual(logs.output, ["ERROR:libusb.test_log:libusb: error [f] same"])
+        self.assertEqual(bridge.suppressed, 3)
+        # Repetitions after the rate limit interval are logged with their count.
+        bridge.rate_limit = 1e-9
+        bridge._log_cb(None, usb.LIBUSB_LOG_LEVEL_ERROR, b"libusb: error [f] same\n")
+        with self.assertLogs(self.logger) as logs:
+            bridge.drain()
+        self.assertEqual(logs.output, ["ERROR:libusb.test_log:libusb: error [f] same"
+                                       " (3 repetitions suppressed)"])
+
+    def test_context(self):
+        context = object()  # passed to the patched functions only
+        with usb.LogBridge(context, self.logger, interval=0.001) as bridge:
+            pass
+        self.assertEqual(self.calls[0], ("set_log_cb", bridge._callback,
+                                         usb.LIBUSB_LOG_CB_CONTEXT))
+        self.assertEqual(self.calls[-1], ("set_option", usb.LIBUSB_OPTION_LOG_LEVEL,
+                                          usb.LIBUSB_LOG_LEVEL_NONE))
+        # Started again, the level is set again.
+        del self.calls[:]
+        bridge.start()
+        bridge.close()
+        self.assertEqual(self.calls[1], ("set_option", usb.LIBUSB_OPTION_LOG_LEVEL,
+                                         usb.LIBUSB_LOG_LEVEL_WARNING))
@@ -0,0 +1,90 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+import urllib.request
+import threading
+import tempfile
+import io
+import os
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+
+class TransferMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics = usb.TransferMetrics()
+        with EmulatedDevice() as device, metrics:
+            with usb.BulkReader(None, 0x81, 64, 2) as reader:
+                for _ in range(5):
+                    reader.read()
+                device.statuses.extend([usb.LIBUSB_TRANSFER_TIMED_OUT,
+                                        usb.LIBUSB_TRANSFER_STALL])
+                with self.assertRaises(usb.TransferStallError):
+                    while True: reader.read()
+            with usb.BulkWriter(None, 0x02, 32, 1) as writer:
+                writer.write(b"abc")
+
+            def write():
+                with usb.BulkWriter(None, 0x02, 32, 1) as writer:
+                    writer.write(b"defg")
+
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join()
+
+    def test_counters(self):
+        counters = self.metrics.counters()
+        self.assertEqual(list(counters), [(None, 0x02), (None, 0x81)])
+        bulk_in = counters[(None, 0x81)]
+        self.assertEqual(bulk_in["timed_out"], 1)
+        self.assertEqual(bulk_in["stall"], 1)
+        self.assertEqual(bulk_in["bytes"], 64 * bulk_in["completed"])
+        # All but the stalled completion and the cancelled one resubmitted.
+        self.assertEqual(bulk_in["resubmits"], bulk_in["completed"] + 1)
+        self.assertEqual(bulk_in["cancelled"], 1)
+        bulk_out = counters[(None, 0x02)]
+        self.assertEqual(bulk_out["completed"], 2)  # counted by two threads
+        self.assertEqual(bulk_out["bytes"], 7)
+        self.assertEqual(bulk_out["resubmits"], 0)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.counters(), {})
+
+    def test_render(self):
+        text = self.metrics.render()
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], "# EOF")
+        self.assertTrue(text.endswith("\n"))
+        self.assertIn("# TYPE libusb_transfers counter", lines)
+        self.assertIn('libusb_transfers_total{device="",endpoint="0x02",status="completed"} 2',
+                      lines)
+        self.assertIn('libusb_transfer_bytes_total{device="",endpoint="0x02"} 7', lines)
+        self.assertIn('libusb_transfer_errors_total{device="",endpoint="0x81",status="stall"} 1',
+                      lines)
+        self.assertIn('libusb_transfer_timeouts_total{device="",endpoint="0x81"} 1', lines)
+        self.assertIn('libusb_transfer_cancellations_total{device="",endpoint="0x81"} 1',
+                      lines)
+        stream = io.StringIO()
+        self.metrics.write(stream)
+        self.assertEqual(stream.getvalue(), text)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "libusb.prom")
+            self.metrics.write(path)
+            with open(path, encoding="utf-8") as file:
+                self.assertEqual(file.read(), text)
+            self.assertEqual(os.listdir(tmpdir), ["libusb.prom"])
+
+    def test_serve(self):
+        server = self.metrics.serve()
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            with urllib.request.urlopen(url, timeout=10) as response:
+                self.assertEqual(response.headers["Content-Type"],
+                                 usb.TransferMetrics.content_type)
+                self.assertEqual(response.read().decode("utf-8"), self.metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,81 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+import threading
+import ctypes as ct
+
+import libusb as usb
+
+
+class TransferPoolTestCase(unittest.TestCase):
+
+    def test_reuse(self):
+        with usb.TransferPool(64, max_idle=2) as pool:
+            transfer = pool.acquire()
+            self.assertEqual(transfer[0].length, 64)
+            self.assertEqual(transfer[0].num_iso_packets, 0)
+            address = ct.addressof(transfer.contents)
+            usb.fill_bulk_transfer(transfer, None, 0x82, transfer[0].buffer, 64,
+                                   None, 5, 1000)
+            transfer[0].flags = usb.LIBUSB_TRANSFER_SHORT_NOT_OK
+            pool.release(transfer)
+            transfer = pool.acquire()
+            self.assertEqual(ct.addressof(transfer.contents), address)
+            self.assertEqual(transfer[0].flags, 0)
+            self.assertEqual(transfer[0].endpoint, 0)
+            self.assertIsNone(transfer[0].user_data)
+            self.assertEqual(transfer[0].length, 64)
+            iso = pool.acquire(4)
+            self.assertEqual(iso[0].num_iso_packets, 4)
+            self.assertEqual((pool.hits, pool.misses), (1, 2))
+            pool.release(iso)
+            pool.release(transfer)
+            self.assertEqual(pool.num_idle, 2)
+            self.assertEqual(pool.in_use, 0)
+            self.assertEqual(pool.high_water, 2)
+        self.assertEqual(pool.num_idle, 0)
+
+    def test_bounded(self):
+        with usb.TransferPool(max_idle=2) as pool:
+            transfers = [pool.acquire() for _ in range(5)]
+            self.assertEqual(pool.high_water, 5)
+            for transfer in transfers:
+                pool.release(transfer)
+            self.assertEqual(pool.num_idle, 2)
+            self.assertEqual(pool.in_use, 0)
+            with self.assertRaises(ValueError):
+                pool.release(transfers[0])  # released already
+            transfer = usb.alloc_transfer(0)
+            with self.assertRaises(ValueError):
+                pool.release(transfer)
+            usb.free_transfer(transfer)
+
+    def test_close_locked(self):
+        pool = usb.TransferPool(64)
+        pool.release(pool.acquire())
+        with pool._lock:
+            # An acquire() holding the lock still sees the pool open.
+            thread = threading.Thread(target=pool.close)
+            thread.start()
+            thread.join(0.05)
+            self.assertFalse(pool._closed)
+            self.assertTrue(pool._idle[0])
+        thread.join()
+        self.assertTrue(pool._closed)
+        self.assertEqual(pool._owned, {})
+        with self.assertRaises(ValueError):
+            pool.acquire()
+
+    def test_free_transfer(self):
+        with usb.TransferPool(16) as pool:
+            transfer = pool.acquire()
+            transfer[0].flags = (usb.LIBUSB_TRANSFER_FREE_TRANSFER |
+                                 usb.LIBUSB_TRANSFER_FREE_BUFFER)
+            # As from the callback of the transfer: libusb frees it afterwards.
+            pool.release(transfer)
+            self.assertEqual(transfer[0].flags, usb.LIBUSB_TRANSFER_FREE_TRANSFER)
+            self.assertEqual(pool.num_idle, 0)
+            self.assertEqual(pool.in_use, 0)
+            transfer[0].flags = 0
+            usb.free_transfer(transfer)
@@ -0,0 +1,311 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import sys
+import itertools
+import ctypes as ct
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+
+def counter_source():
+    counter = itertools.count()
+    return lambda endpoint, length: bytes([next(counter) % 256]) * length
+
+
+class BulkReaderTestCase(unittest.TestCase):
+
+    def test_read(self):
+        with EmulatedDevice(counter_source()) as device, \
+             usb.BulkReader(None, 0x82, 64, 4) as reader:
+            self.assertEqual(reader.in_flight, 4)
+            received = [reader.read() for _ in range(10)]
+            self.assertEqual(received, [bytes([i]) * 64 for i in range(10)])
+            self.assertEqual(reader.in_flight, 4)
+            self.assertEqual(reader.num_xfers, reader.num_bytes // 64)
+        self.assertEqual(reader.in_flight, 0)
+        self.assertFalse(device.submitted)
+
+    def test_iterate_until_stopped(self):
+        with EmulatedDevice() as device:
+            reader = usb.BulkReader(None, 0x81, 16, 2)
+            with reader:
+                chunks = []
+                for data in reader:
+                    chunks.append(data)
+                    if len(chunks) == 3:
+                        reader.stop()
+            self.assertEqual(len(chunks), 2 + 2)
+            self.assertFalse(device.submitted)
+
+    def test_transfer_error(self):
+        with EmulatedDevice() as device, \
+             usb.BulkReader(None, 0x82, 32, 3) as reader:
+            device.statuses.extend([usb.LIBUSB_TRANSFER_COMPLETED,
+                                    usb.LIBUSB_TRANSFER_STALL])
+            self.assertEqual(len(reader.read()), 32)
+            with self.assertRaises(usb.TransferError) as exc:
+                reader.read()
+            self.assertEqual(exc.exception.status, usb.LIBUSB_TRANSFER_STALL)
+            with self.assertRaises(EOFError):
+                reader.read()
+
+    def test_submit_error(self):
+        with EmulatedDevice() as device:
+            device.submit_error = usb.LIBUSB_ERROR_NO_DEVICE
+            reader = usb.BulkReader(None, 0x82, 32, 3)
+            with self.assertRaises(usb.USBError) as exc:
+                reader.start()
+            self.assertEqual(exc.exception.code, usb.LIBUSB_ERROR_NO_DEVICE)
+            reader.close()
+
+    def test_out_endpoint(self):
+        with self.assertRaises(ValueError):
+            usb.BulkReader(None, 0x02)
+
+
+class BulkWriterTestCase(unittest.TestCase):
+
+    def test_write(self):
+        data = bytes(range(256)) * 10
+        with EmulatedDevice() as device:
+            with usb.BulkWriter(None, 0x02, 100, 3) as writer:
+                self.assertEqual(writer.write(data), len(data))
+                self.assertEqual(writer.write(bytearray(b"abc")), 3)
+                self.assertEqual(writer.write(memoryview(data)[5:10]), 5)
+                self.assertLessEqual(writer.in_flight, 3)
+            self.assertEqual(bytes(device.sink[0x02]), data + b"abc" + data[5:10])
+            self.assertEqual(writer.num_bytes, len(data) + 8)
+            self.assertEqual(writer.in_flight, 0)
+
+    def test_write_no_copy(self):
+        data = bytearray(b"x" * 1000)
+        with EmulatedDevice() as device:
+            with usb.BulkWriter(None, 0x02, 100, 2) as writer:
+                writer.write(data, copy=False)
+                writer.write(b"0123456789", copy=False)
+                writer.write(memoryview(b"0123456789")[2:4], copy=False)
+                writer.flush()
+                self.assertEqual(writer.num_xfers, 3)
+            self.assertEqual(bytes(device.sink[0x02]), bytes(data) + b"0123456789" + b"23")
+
+    def test_transfer_error(self):
+        with EmulatedDevice() as device:
+            writer = usb.BulkWriter(None, 0x02, 10, 2)
+            writer.start()
+            device.statuses.append(usb.LIBUSB_TRANSFER_NO_DEVICE)
+            with self.assertRaises(usb.TransferError) as exc:
+                writer.write(b"a" * 100)
+            self.assertEqual(exc.exception.status, usb.LIBUSB_TRANSFER_NO_DEVICE)
+            with self.assertRaises(ValueError):
+                writer.write(b"a")
+            writer.close()
+
+    def test_close_timeout(self):
+        with EmulatedDevice() as device:
+            writer = usb.BulkWriter(None, 0x02, 10, 2)
+            writer.start()
+            device.hold = True
+            writer.write(b"a" * 20)
+            with self.assertRaises(TimeoutError):
+                writer.close(timeout=0.01)
+            self.assertEqual(writer.in_flight, 0)
+            self.assertFalse(device.submitted)
+            # Leaving the with block by an exception does not flush.
+            device.hold = False
+            with self.assertRaises(KeyError):
+                with usb.BulkWriter(None, 0x02, 10, 2) as writer:
+                    writer.write(b"a" * 20)
+                    raise KeyError()
+            self.assertEqual(writer.in_flight, 0)
+            self.assertNotIn(0x02, device.sink)
+
+    def test_in_endpoint(self):
+        with self.assertRaises(ValueError):
+            usb.BulkWriter(None, 0x82)
+
+
+class IsoStreamTestCase(unittest.TestCase):
+
+    def test_read(self):
+        with EmulatedDevice(counter_source()) as device, \
+             usb.IsoStream(None, 0x86, 8, 4, 2, buffer_size=256) as stream:
+            self.assertEqual(stream.in_flight, 2)
+            data = stream.read()
+            self.assertEqual(data, b"".join(bytes([i]) * 8 for i in range(8)))
+            buffer = bytearray(20)
+            self.assertEqual(stream.readinto(buffer), 20)
+            self.assertEqual(bytes(buffer), bytes([8]) * 8 + bytes([9]) * 8 + bytes([10]) * 4)
+            self.assertEqual(stream.read(4), bytes([10]) * 4)
+            self.assertEqual(stream.num_packets, 16)
+            self.assertEqual(stream.pop_gaps(), [])
+        self.assertFalse(device.submitted)
+
+    def test_gaps(self):
+        with EmulatedDevice(lambda endpoint, length: b"abc") as device, \
+             usb.IsoStream(None, 0x86, 8, 4, 1, buffer_size=16) as stream:
+            device.packet_statuses.extend([usb.LIBUSB_TRANSFER_COMPLETED] * 2 +
+                                          [usb.LIBUSB_TRANSFER_ERROR])
+            device.handle_events_timeout_completed(None, None, None)
+            # 2 empty packets, 1 failed, 1 short.
+            self.assertEqual(stream.read(), b"abc")
+            gaps = stream.pop_gaps()
+            self.assertEqual([(gap.packet, gap.position, gap.status, gap.actual_length)
+                              for gap in gaps],
+                             [(0, 0, usb.LIBUSB_TRANSFER_COMPLETED, 0),
+                              (1, 0, usb.LIBUSB_TRANSFER_COMPLETED, 0),
+                              (2, 0, usb.LIBUSB_TRANSFER_ERROR, 0),
+                              (3, 0, usb.LIBUSB_TRANSFER_COMPLETED, 3)])
+            self.assertEqual(stream.num_gaps, 4)
+            # The ring buffer holds 2 of 4 full packets.
+            device.source = lambda endpoint, length: b"abcdefgh"
+            device.handle_events_timeout_completed(None, None, None)
+            gaps = stream.pop_gaps()
+            self.assertEqual([(gap.packet, gap.position, gap.overrun) for gap in gaps],
+                             [(6, 19, True), (7, 19, True)])
+            self.assertEqual(stream.read(), b"abcdefgh" * 2)
+
+    def test_transfer_error(self):
+        with EmulatedDevice() as device, \
+             usb.IsoStream(None, 0x86, 8, 4, 2) as stream:
+            device.statuses.append(usb.LIBUSB_TRANSFER_NO_DEVICE)
+            with self.assertRaises(usb.TransferNoDeviceError):
+                stream.read()
+            with self.assertRaises(EOFError):
+                stream.read()
+
+    def test_out_endpoint(self):
+        with self.assertRaises(ValueError):
+            usb.IsoStream(None, 0x06, 8)
+
+
+class StreamMuxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        libusb = sys.modules["libusb._libusb"]
+        self.alloc_streams = mock.patch.object(libusb, "alloc_streams",
+                                               return_value=3).start()
+        self.free_streams = mock.patch.object(libusb, "free_streams",
+                                              return_value=0).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_streams(self):
+        received = []
+        with EmulatedDevice(counter_source()) as device:
+            with usb.StreamMux(None, (0x81, 0x02), 4, 16, 2) as mux:
+                self.assertEqual(self.alloc_streams.call_args.args[1], 4)
+                self.assertEqual(mux.num_streams, 3)
+                self.assertEqual(mux.in_flight, 3 * 2)
+                mux.set_consumer(0x81, 2, lambda *args: received.append(args))
+                first = mux.read(0x81, 1)
+                self.assertEqual(len(first), 16)
+                self.assertEqual(mux.read(0x81, 3)[0], first[0] + 4)
+                self.assertEqual([args[:2] for args in received], [(0x81, 2)] * 2)
+                mux.write(0x02, 1, b"a" * 40)
+                mux.write(0x02, 3, b"b" * 10)
+                with self.assertRaises(ValueError):
+                    mux.write(0x81, 1, b"c")
+                with self.assertRaises(ValueError):
+                    mux.read(0x81, 4)
+            self.assertEqual(device.sink, {(0x02, 1): b"a" * 40, (0x02, 3): b"b" * 10})
+            self.assertFalse(device.submitted)
+        self.free_streams.assert_called_once()
+
+    def test_alloc_error(self):
+        self.alloc_streams.return_value = usb.LIBUSB_ERROR_NOT_SUPPORTED
+        with self.assertRaises(usb.USBError):
+            usb.StreamMux(None, (0x81,), 4)
+
+
+class ControlPipelineTestCase(unittest.TestCase):
+
+    def test_run(self):
+        with EmulatedDevice(counter_source()) as device, \
+             usb.ControlPipeline(None, depth=3, max_length=16) as pipeline:
+            requests = [(usb.LIBUSB_ENDPOINT_IN | usb.LIBUSB_REQUEST_TYPE_VENDOR,
+                         0x01, 0, index, 2) for index in range(5)]
+            requests.append((usb.LIBUSB_REQUEST_TYPE_VENDOR, 0x02, 0, 0, b"abc"))
+            results = pipeline.run(requests)
+            self.assertEqual(results, [bytes([i]) * 2 for i in range(5)] + [3])
+            self.assertEqual(device.sink, {0x00: b"abc"})
+            self.assertEqual(pipeline.num_xfers, 6)
+
+    def test_depth(self):
+        with EmulatedDevice() as device, \
+             usb.ControlPipeline(None, depth=2) as pipeline:
+            requests = [pipeline.request(0x40, 0x01, i, 0) for i in range(5)]
+            self.assertEqual(len(device.submitted), 2)
+            setup = usb.control_transfer_get_setup(device.submitted[1])[0]
+            self.assertEqual((setup.bmRequestType, setup.bRequest, setup.wValue),
+                             (0x40, 0x01, 1))
+            self.assertFalse(requests[0].done)
+            self.assertEqual(pipeline.flush(), [0] * 5)
+            self.assertTrue(all(request.done for request in requests))
+
+    def test_request_error(self):
+        with EmulatedDevice() as device, \
+             usb.ControlPipeline(None) as pipeline:
+            device.statuses.extend([usb.LIBUSB_TRANSFER_COMPLETED,
+                                    usb.LIBUSB_TRANSFER_STALL])
+            requests = [pipeline.request(0xC0, 0x01, 0, 0, 4) for _ in range(3)]
+            with self.assertRaises(usb.TransferStallError):
+                pipeline.flush()
+            self.assertEqual(requests[0].result(), bytes(4))
+            with self.assertRaises(usb.TransferStallError):
+                requests[1].result()
+            self.assertEqual(requests[2].result(), bytes(4))
+            with self.assertRaises(ValueError):
+                pipeline.request(0x40, 0x01, 0, 0, b"x" * 300)
+
+
+class InterruptPollerTestCase(unittest.TestCase):
+
+    devices = [ct.cast(ct.c_void_p(address), ct.POINTER(usb.device_handle))
+               for address in (0x1000, 0x2000)]
+
+    def test_subscribers(self):
+        received = []
+        with EmulatedDevice(counter_source()) as device, \
+             usb.InterruptPoller() as poller:
+            poller.add(self.devices[0], 0x81, 4, received.append, num_transfers=3)
+            poller.add(self.devices[1], 0x81, 4)
+            self.assertEqual(len(device.submitted), 3 + 2)
+            poller.poll()
+            self.assertEqual(received, [bytes([i]) * 4 for i in range(3)])
+            self.assertEqual(poller.read(self.devices[1], 0x81), bytes([3]) * 4)
+            self.assertEqual(poller.read(self.devices[1], 0x81), bytes([4]) * 4)
+            with self.assertRaises(ValueError):
+                poller.add(self.devices[0], 0x81, 4)
+            poller.remove(self.devices[0], 0x81)
+            with self.assertRaises(ValueError):
+                poller.read(self.devices[0], 0x81)
+        self.assertFalse(device.submitted)
+
+    def test_coalesce(self):
+        with EmulatedDevice(counter_source()), \
+             usb.InterruptPoller() as poller:
+            poller.add(self.devices[0], 0x82, 1, num_transfers=4, coalesce=True)
+            poller.poll()
+            poller.poll()
+            self.assertEqual(poller.read(self.devices[0], 0x82), bytes([7]))
+            self.assertEqual(poller.overruns(self.devices[0], 0x82), 7)
+
+    def test_error(self):
+        errors = []
+        with EmulatedDevice() as device, \
+             usb.InterruptPoller(error_handler=lambda *args: errors.append(args)) as poller:
+            poller.add(self.devices[0], 0x81, 8)
+            poller.add(self.devices[1], 0x81, 8)
+            device.statuses.append(usb.LIBUSB_TRANSFER_NO_DEVICE)
+            poller.poll()
+            poller.poll()
+            self.assertEqual(len(errors), 1)
+            self.assertIs(errors[0][0], self.devices[0])
+            self.assertIsInstance(errors[0][2], usb.TransferNoDeviceError)
+            with self.assertRaises(usb.TransferNoDeviceError):
+                poller.read(self.devices[0], 0x81)
+            self.assertEqual(poller.read(self.devices[1], 0x81), bytes(8))
@@ -0,0 +1,179 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import sys
+import ctypes as ct
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+sync = sys.modules["libusb._sync"]
+
+
+class SyncIOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def transfer(dev_handle, endpoint, data, length, actual_length, timeout):
+            self.calls.append((endpoint, data, length, timeout))
+            if endpoint & usb.LIBUSB_ENDPOINT_IN:
+                ct.memmove(data, b"0123456789", min(length, 10))
+                actual_length[0] = min(length, 10)
+            else:
+                actual_length[0] = length
+            return usb.LIBUSB_SUCCESS
+
+        def control_transfer(dev_handle, bmRequestType, bRequest, wValue, wIndex,
+                             data, wLength, timeout):
+            self.calls.append((bmRequestType, data, wLength, timeout))
+            if bmRequestType & usb.LIBUSB_ENDPOINT_IN:
+                ct.memmove(data, b"abc", min(wLength, 3))
+                return min(wLength, 3)
+            return wLength
+
+        for name, func in (("_bulk_transfer", transfer),
+                           ("_interrupt_transfer", transfer),
+                           ("_control_transfer", control_transfer)):
+            mock.patch.object(sync, name, func).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_read_into(self):
+        buffer = bytearray(64)
+        self.assertEqual(usb.read_into(None, 0x81, buffer), 10)
+        self.assertEqual(buffer[:11], b"0123456789\0")
+        view = memoryview(buffer)[20:24]
+        self.assertEqual(usb.read_into(None, 0x81, view, 50, interrupt=True), 4)
+        self.assertEqual(buffer[20:24], b"0123")
+        self.assertEqual(self.calls[-1][2:], (4, 50))
+        with self.assertRaises(TypeError):
+            usb.read_into(None, 0x81, b"read-only")
+
+    def test_write(self):
+        data = b"x" * 64
+        self.assertEqual(usb.write(None, 0x02, data), 64)
+        self.assertIs(self.calls[-1][1], data)  # passed as it is
+        self.assertEqual(usb.write(None, 0x02, bytearray(b"abc")), 3)
+        self.assertEqual(usb.write(None, 0x02, memoryview(data)[:5]), 5)
+        self.assertEqual(bytes(self.calls[-1][1]), b"x" * 5)
+
+    def test_control(self):
+        self.assertEqual(usb.control_in(None, usb.LIBUSB_REQUEST_TYPE_VENDOR, 1, 0, 0, 8),
+                         b"abc")
+        self.assertEqual(self.calls[-1][0],
+                         usb.LIBUSB_REQUEST_TYPE_VENDOR | usb.LIBUSB_ENDPOINT_IN)
+        buffer = bytearray(2)
+        self.assertEqual(usb.control_in(None, 0, 1, 0, 0, buffer), 2)
+        self.assertEqual(buffer, b"ab")
+        self.assertEqual(usb.control_out(None, usb.LIBUSB_ENDPOINT_IN, 1, 0, 0,
+                                         b"1234"), 4)
+        self.assertEqual(self.calls[-1][0], 0)
+        self.assertEqual(usb.control_out(None, 0, 1, 0, 0), 0)
+        self.assertIsNone(self.calls[-1][1])
+
+    def test_control_length(self):
+        num_calls = len(self.calls)
+        for length in (0x10000, 70000, -1):
+            with self.assertRaises(ValueError):
+                usb.control_in(None, 0, 1, 0, 0, length)
+        with self.assertRaises(ValueError):
+            usb.control_in(None, 0, 1, 0, 0, bytearray(0x10000))
+        with self.assertRaises(ValueError):
+            usb.control_out(None, 0, 1, 0, 0, b"x" * 70000)
+        self.assertEqual(len(self.calls), num_calls)
+        self.assertEqual(usb.control_out(None, 0, 1, 0, 0, b"x" * 0xFFFF), 0xFFFF)
+
+    def test_error(self):
+        with mock.patch.object(sync, "_bulk_transfer",
+                               return_value=usb.LIBUSB_ERROR_PIPE):
+            with self.assertRaises(usb.USBError) as exc:
+                usb.write(None, 0x02, b"a")
+            self.assertEqual(exc.exception.code, usb.LIBUSB_ERROR_PIPE)
+
+
+class WritevTestCase(unittest.TestCase):
+
+    def test_packet_aligned(self):
+        payload = bytearray(b"p" * 21)
+        data = b"d" * 20
+        pieces = sync._packet_aligned([b"head", payload, memoryview(b"trailer"), data], 8)
+        self.assertEqual([bytes(view[start:stop]) for view, start, stop in pieces],
+                         [b"headpppp", b"p" * 16, b"ptrailer", b"d" * 16, b"dddd"])
+        self.assertIs(pieces[1][0].obj, payload)  # not copied
+        self.assertEqual(pieces[1][1:], (4, 20))
+        self.assertIs(pieces[3][0].obj, data)
+        self.assertEqual([stop - start for _, start, stop in
+                          sync._packet_aligned([b"a" * 16, b"", b"b" * 3], 8)], [16, 3])
+        self.assertEqual([stop - start for _, start, stop in
+                          sync._packet_aligned([b"a" * 3, b"b" * 2, b"c" * 4], 8)], [8, 1])
+
+    def test_writev(self):
+        submitted = []
+        device = EmulatedDevice()
+        submit_transfer = device.submit_transfer
+
+        def submit(transfer):
+            submitted.append((transfer[0].length, transfer[0].flags))
+            return submit_transfer(transfer)
+
+        with mock.patch.object(device, "submit_transfer", submit), device:
+            data = [b"head", bytearray(b"p" * 21), memoryview(b"trailer")]
+            self.assertEqual(usb.writev(None, 0x02, data, max_packet_size=8), 32)
+            self.assertEqual(device.sink[0x02], b"".join(data))
+            self.assertEqual(submitted, [(8, 0), (16, 0),
+                                         (8, usb.LIBUSB_TRANSFER_ADD_ZERO_PACKET)])
+            submitted.clear()
+            self.assertEqual(usb.writev(None, 0x02, [b"abc", b"de"],
+                                        max_packet_size=8), 5)
+            self.assertEqual(submitted, [(5, 0)])
+            self.assertEqual(usb.writev(None, 0x02, [], max_packet_size=8), 0)
+
+    def test_writev_in_place(self):
+        data = bytes(range(20))
+        addresses = []
+        device = EmulatedDevice()
+        submit_transfer = device.submit_transfer
+
+        def submit(transfer):
+            addresses.append(ct.cast(transfer[0].buffer, ct.c_void_p).value)
+            return submit_transfer(transfer)
+
+        with mock.patch.object(device, "submit_transfer", submit), device:
+            self.assertEqual(usb.writev(None, 0x02, [b"abc", data],
+                                        max_packet_size=8), 23)
+            self.assertEqual(device.sink[0x02], b"abc" + data)
+        address = ct.cast(ct.c_char_p(data), ct.c_void_p).value
+        self.assertEqual(addresses[1], address + 5)
+
+    def test_writev_events_error(self):
+        device = EmulatedDevice()
+        handle_events = device.handle_events_timeout_completed
+        results = [usb.LIBUSB_ERROR_IO]
+
+        def handle_events_timeout_completed(ctx, tv, completed):
+            if results:
+                return results.pop()
+            return handle_events(ctx, tv, completed)
+
+        with mock.patch.object(device, "handle_events_timeout_completed",
+                               handle_events_timeout_completed), device:
+            with self.assertRaises(usb.USBError) as exc:
+                usb.writev(None, 0x02, [b"a" * 8, b"b" * 8], max_packet_size=8)
+            self.assertEqual(exc.exception.code, usb.LIBUSB_ERROR_IO)
+            # The cancelled transfers have been reaped.
+            self.assertFalse(device.submitted)
+            self.assertFalse(device.cancelled)
+            self.assertEqual(sync._orphaned, [])
+
+    def test_writev_error(self):
+        with EmulatedDevice() as device:
+            device.statuses.extend([usb.LIBUSB_TRANSFER_COMPLETED,
+                                    usb.LIBUSB_TRANSFER_STALL])
+            with self.assertRaises(usb.TransferStallError):
+                usb.writev(None, 0x02, [b"a" * 8, b"b" * 8, b"c" * 8],
+                           max_packet_size=8)
+            self.assertEqual(len(device.cancelled), 0)
+            self.assertFalse(device.submitted)
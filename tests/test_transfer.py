@@ -0,0 +1,171 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+import importlib.util
+import ctypes as ct
+import gc
+import sys
+
+import libusb as usb
+
+
+@usb.transfer_cb_fn
+def transfer_cb(transfer):
+    pass
+
+
+class TransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transfer = usb.alloc_transfer(4)
+        self.buffer = (ct.c_ubyte * 64)()
+
+    def tearDown(self):
+        usb.free_transfer(self.transfer)
+
+    def test_fill_bulk_transfer(self):
+        for fill_bulk_transfer in (usb.fill_bulk_transfer,
+                                   usb.fill_bulk_transfer_cfunc):
+            fill_bulk_transfer(self.transfer, None, 0x82, self.buffer, 32,
+                               transfer_cb, None, 1000)
+            transf = self.transfer[0]
+            self.assertEqual(transf.endpoint, 0x82)
+            self.assertEqual(transf.type, usb.LIBUSB_TRANSFER_TYPE_BULK)
+            self.assertEqual(transf.length, 32)
+            self.assertEqual(transf.timeout, 1000)
+            self.assertIsNone(transf.user_data)
+            self.assertEqual(ct.addressof(transf.buffer.contents),
+                             ct.addressof(self.buffer))
+
+    def test_fill_transfer_user_data_and_callback(self):
+        usb.fill_interrupt_transfer(self.transfer, None, 0x81, self.buffer, 8,
+                                    None, self.buffer, 0)
+        transf = self.transfer[0]
+        self.assertEqual(transf.type, usb.LIBUSB_TRANSFER_TYPE_INTERRUPT)
+        self.assertEqual(transf.user_data, ct.addressof(self.buffer))
+        self.assertFalse(transf.callback)
+        called = []
+        usb.fill_interrupt_transfer(self.transfer, None, 0x81, self.buffer, 8,
+                                    lambda transfer: called.append(transfer[0].endpoint), 7, 0)
+        self.assertEqual(transf.user_data, 7)
+        self.assertTrue(transf.callback)
+        # The wrapped callable stays alive while the transfer is not refilled.
+        gc.collect()
+        self.transfer[0].callback(self.transfer)
+        self.assertEqual(called, [0x81])
+        usb.fill_interrupt_transfer(self.transfer, None, 0x81, self.buffer, 8,
+                                    None, None, 0)
+        self.assertFalse(transf.callback)
+
+    def test_free_transfer_drops_callback(self):
+        libusb = sys.modules["libusb._libusb"]
+        transfer = usb.alloc_transfer(0)
+        address = ct.addressof(transfer.contents)
+        usb.fill_bulk_transfer(transfer, None, 0x82, self.buffer, 8,
+                               lambda transfer: None, None, 0)
+        self.assertIn(address, libusb._callbacks)
+        usb.free_transfer(transfer)
+        self.assertNotIn(address, libusb._callbacks)
+
+    def test_fill_control_transfer(self):
+        for fill_control_setup, fill_control_transfer in (
+            (usb.fill_control_setup, usb.fill_control_transfer),
+            (usb.fill_control_setup_cfunc, usb.fill_control_transfer_cfunc)):
+            fill_control_setup(self.buffer, 0xC0, 0x01, 0x1234, 0x0002, 8)
+            fill_control_transfer(self.transfer, None, self.buffer,
+                                  transfer_cb, None, 500)
+            transf = self.transfer[0]
+            self.assertEqual(bytes(self.buffer[:usb.LIBUSB_CONTROL_SETUP_SIZE]),
+                             bytes.fromhex("c001341202000800"))
+            self.assertEqual(transf.type, usb.LIBUSB_TRANSFER_TYPE_CONTROL)
+            self.assertEqual(transf.endpoint, 0)
+            self.assertEqual(transf.length, usb.LIBUSB_CONTROL_SETUP_SIZE + 8)
+
+    def test_fill_iso_transfer(self):
+        for fill_iso_transfer, set_iso_packet_lengths in (
+            (usb.fill_iso_transfer, usb.set_iso_packet_lengths),
+            (usb.fill_iso_transfer_cfunc, usb.set_iso_packet_lengths_cfunc)):
+            fill_iso_transfer(self.transfer, None, 0x86, self.buffer, 64, 4,
+                              transfer_cb, None, 0)
+            set_iso_packet_lengths(self.transfer, 16)
+            transf = self.transfer[0]
+            self.assertEqual(transf.type, usb.LIBUSB_TRANSFER_TYPE_ISOCHRONOUS)
+            self.assertEqual(transf.num_iso_packets, 4)
+            iso_packet_desc = (usb.iso_packet_descriptor * 4).from_address(
+                ct.addressof(transf) + usb.transfer.iso_packet_desc.offset)
+            self.assertEqual([desc.length for desc in iso_packet_desc], [16] * 4)
+
+    def test_transfer_data_views(self):
+        usb.fill_bulk_transfer(self.transfer, None, 0x02, self.buffer, 16,
+                               transfer_cb, None, 0)
+        view = usb.transfer_get_buffer(self.transfer)
+        self.assertEqual(len(view), 16)
+        view[:4] = b"abcd"
+        self.assertEqual(bytes(self.buffer[:4]), b"abcd")
+        self.transfer[0].actual_length = 3
+        data = usb.transfer_get_data(self.transfer)
+        self.assertTrue(data.readonly)
+        self.assertEqual(data, b"abc")
+        self.transfer[0].buffer = None
+        self.transfer[0].actual_length = 0
+        self.assertEqual(usb.transfer_get_data(self.transfer), b"")
+        with self.assertRaises(ValueError):
+            usb.transfer_get_buffer(self.transfer)
+
+    def fill_iso_packets(self):
+        usb.fill_iso_transfer(self.transfer, None, 0x86, self.buffer, 64, 4,
+                              transfer_cb, None, 0)
+        transf = self.transfer[0]
+        iso_packet_desc = (usb.iso_packet_descriptor * 4).from_address(
+            ct.addressof(transf) + usb.transfer.iso_packet_desc.offset)
+        for desc, length, actual_length in zip(iso_packet_desc,
+                                               (8, 16, 24, 16), (8, 3, 0, 16)):
+            desc.length = length
+            desc.actual_length = actual_length
+        iso_packet_desc[2].status = usb.LIBUSB_TRANSFER_ERROR
+        self.buffer[:] = range(64)
+
+    def test_get_iso_packet_buffer(self):
+        self.fill_iso_packets()
+        for packet, offset in ((0, 0), (2, 24), (ct.c_uint(3), 48)):
+            self.assertEqual(ct.cast(usb.get_iso_packet_buffer(self.transfer, packet),
+                                     ct.c_void_p).value,
+                             ct.addressof(self.buffer) + offset)
+        self.assertFalse(usb.get_iso_packet_buffer(self.transfer, 4))
+        self.assertEqual(ct.cast(usb.get_iso_packet_buffer_simple(self.transfer, 3),
+                                 ct.c_void_p).value,
+                         ct.addressof(self.buffer) + 24)
+
+    def test_get_iso_packets(self):
+        self.fill_iso_packets()
+        packets = usb.get_iso_packets(self.transfer)
+        self.assertEqual([packet[:4] for packet in packets],
+                         [(0, 8, 8, 0), (8, 16, 3, 0),
+                          (24, 24, 0, usb.LIBUSB_TRANSFER_ERROR), (48, 16, 16, 0)])
+        self.assertEqual(packets[1].data, bytes([8, 9, 10]))
+        self.assertEqual(packets[3].data, bytes(range(48, 64)))
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "NumPy is not installed")
+    def test_get_iso_packets_array(self):
+        self.fill_iso_packets()
+        packets = usb.get_iso_packets_array(self.transfer)
+        self.assertEqual(packets["offset"].tolist(), [0, 8, 24, 48])
+        self.assertEqual(packets["actual_length"].tolist(), [8, 3, 0, 16])
+        self.assertEqual(packets["status"][2], usb.LIBUSB_TRANSFER_ERROR)
+
+    def test_set_iso_packet_lengths_from(self):
+        self.fill_iso_packets()
+        transf = self.transfer[0]
+        iso_packet_desc = (usb.iso_packet_descriptor * 4).from_address(
+            ct.addressof(transf) + usb.transfer.iso_packet_desc.offset)
+        usb.set_iso_packet_lengths_from(self.transfer, [1, 2, 3, 4])
+        self.assertEqual([(desc.length, desc.actual_length) for desc in iso_packet_desc],
+                         [(1, 8), (2, 3), (3, 0), (4, 16)])
+        self.assertEqual(iso_packet_desc[2].status, usb.LIBUSB_TRANSFER_ERROR)
+        usb.set_iso_packet_lengths_from(self.transfer, range(10, 14), reset=True)
+        self.assertEqual([(desc.length, desc.actual_length, desc.status)
+                          for desc in iso_packet_desc],
+                         [(10, 0, 0), (11, 0, 0), (12, 0, 0), (13, 0, 0)])
+        with self.assertRaises(ValueError):
+            usb.set_iso_packet_lengths_from(self.transfer, [1, 2, 3])
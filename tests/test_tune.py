@@ -0,0 +1,125 @@
+# Copyright (c) 2016 Adam Karpierz
+# SPDX-License-Identifier: Zlib
+
+import unittest
+from unittest import mock
+import tempfile
+import sys
+import os
+
+import libusb as usb
+
+from .emuldev import EmulatedDevice
+
+libusb = sys.modules["libusb._libusb"]
+tune   = sys.modules["libusb._tune"]
+
+
+class TransferTunerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.speed = usb.LIBUSB_SPEED_SUPER
+        self.transfer_type = usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_BULK
+        self.max_raw_io = usb.LIBUSB_ERROR_NOT_SUPPORTED
+
+        def get_device_descriptor(dev, desc):
+            desc._obj.idVendor, desc._obj.idProduct = 0x1234, 0xABCD
+            return usb.LIBUSB_SUCCESS
+
+        patches = {
+            "get_device":              lambda dev_handle: None,
+            "get_device_speed":        lambda dev: self.speed,
+            "get_device_descriptor":   get_device_descriptor,
+            "get_max_packet_size":     lambda dev, endpoint: 1024,
+            "get_max_iso_packet_size": lambda dev, endpoint: 3072,
+            "get_max_alt_packet_size": lambda dev, interface, alt_setting, endpoint: 192,
+            "get_max_raw_io_transfer_size": lambda dev_handle, endpoint: self.max_raw_io,
+        }
+        for name, func in patches.items():
+            mock.patch.object(libusb, name, func, create=True).start()
+        mock.patch.object(tune, "_endpoint_type",
+                          lambda *args: self.transfer_type).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_suggest(self):
+        tuner = usb.TransferTuner()
+        self.assertEqual(tuner.suggest(None, 0x81), (65536, 8, 0, None))
+        self.speed = usb.LIBUSB_SPEED_HIGH
+        self.assertEqual(tuner.suggest(None, 0x81), (16384, 8, 0, None))
+        self.speed = usb.LIBUSB_SPEED_LOW
+        self.assertEqual(tuner.suggest(None, 0x81), (1024, 2, 0, None))  # >= packet
+        self.speed = usb.LIBUSB_SPEED_SUPER_PLUS
+        self.max_raw_io = 100000
+        self.assertEqual(tuner.suggest(None, 0x81).transfer_size, 99328)
+        self.transfer_type = usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_ISOCHRONOUS
+        self.assertEqual(tuner.suggest(None, 0x81), (3072 * 32, 4, 32, None))
+        self.assertEqual(tuner.suggest(None, 0x81, interface=1, alt_setting=2),
+                         (192 * 32, 4, 32, None))
+        self.speed = usb.LIBUSB_SPEED_FULL
+        self.assertEqual(tuner.suggest(None, 0x81), (3072 * 8, 4, 8, None))
+        self.transfer_type = usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_INTERRUPT
+        self.assertEqual(tuner.suggest(None, 0x81), (3072, 4, 0, None))
+
+    def test_tune(self):
+        measured = []
+
+        def measure(settings):
+            measured.append(settings[:2])
+            # Peaks at 128 KiB transfers and 16 of them in flight.
+            return (1e6 - abs(settings.transfer_size - 131072)
+                    - 1000 * abs(settings.num_transfers - 16))
+
+        tuner = usb.TransferTuner()
+        best = tuner.tune(None, 0x81, measure)
+        self.assertEqual(best[:2], (131072, 16))
+        self.assertEqual(measured[:5], [(16384, 8), (32768, 8), (65536, 8),
+                                        (131072, 8), (262144, 8)])
+        self.assertEqual(measured[5:], [(131072, 2), (131072, 4),
+                                        (131072, 16), (131072, 32)])
+        self.assertEqual(len(tuner.results["1234:abcd/0x81"]), 9)
+        self.assertEqual(tuner.cached(None, 0x81), best)
+        self.assertIsNone(tuner.cached(None, 0x82))
+        # Cached per VID:PID and endpoint.
+        measured.clear()
+        self.assertEqual(tuner.tune(None, 0x81, measure), best)
+        self.assertEqual(measured, [])
+        best = tuner.tune(None, 0x81, measure, candidates=[(512, 1), (4096, 2)],
+                          refresh=True)
+        self.assertEqual(best[:2], (4096, 2))
+        self.assertEqual(measured, [(512, 1), (4096, 2)])
+        with self.assertRaises(ValueError):
+            tuner.tune(None, 0x82, measure, candidates=[])
+        # Periodic endpoints are not measured by default.
+        self.transfer_type = usb.LIBUSB_ENDPOINT_TRANSFER_TYPE_INTERRUPT
+        self.assertEqual(tuner.tune(None, 0x83), (3072, 4, 0, None))
+        self.assertIsNone(tuner.cached(None, 0x83))
+
+    def test_tune_measured(self):
+        tuner = usb.TransferTuner()
+        candidates = [(1024, 1), (4096, 4)]
+        with EmulatedDevice() as device:
+            best = tuner.tune(None, 0x81, duration=0.01, candidates=candidates)
+            self.assertIn(best[:2], candidates)
+            self.assertGreater(best.throughput, 0)
+            best = tuner.tune(None, 0x02, duration=0.01, candidates=candidates)
+            self.assertGreater(best.throughput, 0)
+            self.assertTrue(device.sink[0x02])
+
+    def test_measure_stalled_out_endpoint(self):
+        with EmulatedDevice() as device:
+            device.hold = True
+            throughput = tune._measure_bulk(None, 0x02, usb.TransferSettings(64, 2),
+                                            0.01, None)
+            self.assertEqual(throughput, 0)
+            self.assertFalse(device.submitted)
+            self.assertNotIn(0x02, device.sink)
+
+    def test_cache_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tuning.json")
+            tuner = usb.TransferTuner(path)
+            best = tuner.tune(None, 0x81, lambda settings: settings.transfer_size,
+                              candidates=[(512, 1), (4096, 2)])
+            self.assertEqual(usb.TransferTuner(path).cached(None, 0x81), best)
+            tuner.clear()
+            self.assertIsNone(usb.TransferTuner(path).cached(None, 0x81))